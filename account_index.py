@@ -0,0 +1,143 @@
+import os
+import math
+from collections import defaultdict
+
+from dotenv import load_dotenv
+
+from lifetime_index import load_lifetime_index, normalize_text, split_items
+from reference_data import ACCOUNT_TITLES_PATH, get_account_texts, get_account_titles, get_reference_store
+from tracing import span
+
+# .envから環境変数を読み込む
+load_dotenv()
+
+# 品目ごとにプロンプトへ載せる勘定科目の候補数（0なら絞り込まず全件を載せる）
+ACCOUNT_TOP_K = int(os.getenv("ACCOUNT_TOP_K", "5"))
+# 品目の1位候補の一致度がこれを下回る場合は、取りこぼしを避けるため勘定科目一覧を全件載せる
+ACCOUNT_MIN_SCORE = float(os.getenv("ACCOUNT_MIN_SCORE", "0.15"))
+# 1位候補の一致度に対してこの割合に満たない候補は載せない（偶然の文字一致による候補を除く）
+ACCOUNT_RELATIVE_SCORE = float(os.getenv("ACCOUNT_RELATIVE_SCORE", "0.3"))
+# 固定資産の判定で品目によらず候補に入れる科目（税抜経理の仮払消費税、少額資産の区分）
+BASE_ACCOUNT_TITLES = ("仮払消費税等", "一括償却資産", "消耗品費")
+# 科目名の一致を解説の一致より重く数える
+TITLE_WEIGHT = 3.0
+
+
+def _ngrams(text: str, n: int = 2) -> set:
+    text = normalize_text(text)
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class AccountIndex:
+    """
+    勘定科目一覧の科目名・解説のn-gram転置インデックス
+    品目名（と耐用年数表で対応する分類名）とのIDF重み付き一致度で候補の科目を選ぶ
+    """
+
+    def __init__(self, rows: list):
+        self.rows = [row for row in rows if (row.get("勘定科目") or "").strip()]
+        self.titles = [row["勘定科目"].strip() for row in self.rows]
+        self.postings = defaultdict(dict)  # n-gram -> {科目番号: 重み}
+        for i, row in enumerate(self.rows):
+            for gram in _ngrams(row.get("解説") or ""):
+                self.postings[gram][i] = 1.0
+            for gram in _ngrams(self.titles[i]):
+                self.postings[gram][i] = TITLE_WEIGHT
+        total = max(1, len(self.rows))
+        self.idf = {gram: math.log(1 + total / len(ids)) for gram, ids in self.postings.items()}
+
+    def search(self, query: str, k: int = ACCOUNT_TOP_K) -> list:
+        """
+        クエリに近い科目を最大k件、(科目番号, 一致度) で返す
+        一致度はクエリのn-gramの重みのうち、科目側で一致した割合（科目名の一致は TITLE_WEIGHT 倍）
+        """
+        grams = _ngrams(query)
+        norm = sum(self.idf.get(gram, 0.0) for gram in grams) * TITLE_WEIGHT
+        if not norm:
+            return []
+        scores = defaultdict(float)
+        for gram in grams:
+            for i, weight in self.postings.get(gram, {}).items():
+                scores[i] += self.idf[gram] * weight
+        ranked = sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+        return [(i, score / norm) for i, score in ranked[:k]]
+
+    def render(self, indices: list) -> str:
+        return "".join(f"{self.rows[i]['勘定科目']}: {(self.rows[i].get('解説') or '').rstrip(' -')}\n" for i in indices)
+
+
+def build_account_index(path: str) -> AccountIndex:
+    return AccountIndex(get_account_titles(path))
+
+
+def get_account_index(path: str = ACCOUNT_TITLES_PATH) -> AccountIndex:
+    """
+    勘定科目一覧のインデックス（CSVが変わるまで使い回す）
+    """
+    return get_reference_store().get(path, build_account_index)
+
+
+def _expand_query(item: str, lifetime_index) -> str:
+    # 「ノートPC」のように科目の解説に現れない品目名は、耐用年数表で対応する分類名（器具及び備品 など）を足して探す
+    if lifetime_index is None:
+        return item
+    record = lifetime_index.exact_match(item)
+    records = [record] if record is not None else lifetime_index.search(item, k=1)
+    labels = [f"{r.category} {r.heading}".strip() for r in records]
+    return " ".join([item, *labels])
+
+
+def shortlist_account_titles(
+    text: str,
+    path: str = ACCOUNT_TITLES_PATH,
+    k: int = ACCOUNT_TOP_K,
+    min_score: float = ACCOUNT_MIN_SCORE,
+) -> list | None:
+    """
+    証憑テキストの品目ごとに勘定科目の候補を上位k件ずつ選び、科目名のリストを返す
+    品目が取り出せない・いずれかの品目で1位候補の一致度が低いなど、絞り込みに自信がない場合は None を返す
+    """
+    items = split_items(text)
+    if k <= 0 or not items:
+        return None
+    index = get_account_index(path)
+    try:
+        lifetime_index = load_lifetime_index("document")
+    except OSError as e:
+        print(f"耐用年数インデックスを使わずに勘定科目を絞り込みます: {e}")
+        lifetime_index = None
+
+    selected = [title for title in BASE_ACCOUNT_TITLES if title in index.titles]
+    for item in items:
+        hits = index.search(_expand_query(item, lifetime_index), k)
+        if not hits or hits[0][1] < min_score:
+            return None
+        for i, score in hits:
+            if score >= hits[0][1] * ACCOUNT_RELATIVE_SCORE and index.titles[i] not in selected:
+                selected.append(index.titles[i])
+    return selected
+
+
+def get_account_candidates_text(text: str, path: str = ACCOUNT_TITLES_PATH) -> str:
+    """
+    証憑の品目に関連する勘定科目だけをプロンプト用のテキストにする（絞り込めない場合は全件）
+    """
+    with span("account_shortlist") as attrs:
+        titles = shortlist_account_titles(text, path)
+        attrs["fallback"] = titles is None
+        if titles is None:
+            return get_account_texts(path)
+        index = get_account_index(path)
+        attrs["candidates"] = len(titles)
+        order = {title: i for i, title in enumerate(index.titles)}
+        # 科目は勘定科目一覧の並び順で載せる
+        return "【勘定科目一覧】（証憑の品目に関連する候補）\n" + index.render(sorted(order[t] for t in titles))
+
+
+if __name__ == "__main__":
+    index = get_account_index()
+    lifetime_index = load_lifetime_index("document")
+    for item in ["ノートパソコン", "エアコン", "応接セット", "営業用トラック", "会計ソフト", "事務所の内装工事"]:
+        query = _expand_query(item, lifetime_index)
+        hits = ", ".join(f"{index.titles[i]}({score:.2f})" for i, score in index.search(query))
+        print(f"{item}: {hits}")
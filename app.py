@@ -1,24 +1,54 @@
 import streamlit as st
 import os
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.documentintelligence import DocumentIntelligenceClient
 from dotenv import load_dotenv
-from chat_response import generate_response
-from asset_judge import asset_judge, parse_llm_output_to_dataframe
-from asset_extract_items import asset_extract_items
-from make_df import parse_extracted_items_to_dataframe, parse_llm_output_to_dataframe
-from refine_rag_response_from_df import refine_rag_response_from_df 
-import pandas as pd
+from lazy_import import lazy_module, lazy_object
+from judgement_cache import get_judgement_cache
+from tracing import start_trace, start_metrics_server
+
+# langchain・Azure SDK・pandas などを読み込むモジュールは、その機能を最初に使うときに読み込む
+# （アップロード前の初回表示を速くする。読み込み済みなら再実行時は本物をそのまま使う）
+pd = lazy_module("pandas")
+analyze_document = lazy_object("doc_analysis", "analyze_document")
+generate_response_stream = lazy_object("chat_response", "generate_response_stream")
+asset_judge_stream = lazy_object("asset_judge", "asset_judge_stream")
+asset_extract_items = lazy_object("asset_extract_items", "asset_extract_items")
+parse_extracted_items_to_dataframe = lazy_object("make_df", "parse_extracted_items_to_dataframe")
+parse_llm_output_to_dataframe = lazy_object("make_df", "parse_llm_output_to_dataframe")
+LLMOutputRowStream = lazy_object("make_df", "LLMOutputRowStream")
+refine_rag_response_from_df_stream = lazy_object("refine_rag_response_from_df", "refine_rag_response_from_df_stream")
+load_journal_index = lazy_object("journal_index", "load_journal_index")
+ConversationMemory = lazy_object("conversation_memory", "ConversationMemory")
 
 
 # .envから環境変数を読み込む
 load_dotenv()
-AZURE_ENDPOINT = os.getenv("DOC_ENDPOINT")
-AZURE_KEY = os.getenv("DOC_API_KEY")
+# AZURE_BACKEND=fake の場合はAzureに接続せず偽バックエンドで動かす（オフラインでの動作確認用）
+if os.getenv("AZURE_BACKEND"):
+    from fake_backends import install_from_env
+    install_from_env()
+# METRICS_PORT を指定した場合は処理時間・トークン数などをPrometheus形式で公開する
+start_metrics_server()
 
 st.set_page_config(page_title="固定資産判定アプリ", layout="wide")
 st.title("固定資産判定アプリ")
 
+show_timings = st.sidebar.checkbox("処理時間の内訳を表示", value=False)
+
+
+def show_trace_panel(key: str):
+    """
+    直近の処理（key）のステージごとの所要時間・トークン数・キャッシュ命中を折りたたみ表示する
+    """
+    trace = st.session_state.get("traces", {}).get(key)
+    if not show_timings or trace is None:
+        return
+    with st.expander(f"処理時間の内訳（合計 {trace.duration_ms / 1000:.2f}秒）"):
+        st.dataframe(pd.DataFrame(trace.rows()), use_container_width=True, hide_index=True)
+
+
+def remember_trace(key: str, trace):
+    st.session_state.setdefault("traces", {})[key] = trace
+
 # --- docs_for_indexのファイル一覧表示 ---
 docs_dir = "document/docs_for_index"
 if not os.path.exists(docs_dir):
@@ -49,20 +79,49 @@ if uploaded_index_file is not None:
     st.sidebar.success(f"{uploaded_index_file.name} を docs_for_index に保存しました。")
 
 # --- インデックス再作成ボタン（サイドバーへ移動） ---
-import subprocess, sys
-if st.sidebar.button("インデックス再作成"):
-    with st.spinner("FAISSインデックスを再作成中..."):
-        try:
-            result = subprocess.run(
-                # sys.executable は「いま動いている仮想環境の Python 」
-                [sys.executable, "faiss_index_builder.py"],
-                capture_output=True, text=True, check=True
-            )
-            st.sidebar.success("インデックス再作成が完了しました。")
-            st.sidebar.text_area("出力ログ", result.stdout + "\n" + result.stderr, height=200)
-        except subprocess.CalledProcessError as e:
-            st.sidebar.error("インデックス再作成中にエラーが発生しました。")
-            st.sidebar.text_area("エラーログ", e.stdout + "\n" + e.stderr, height=200)
+# 再作成はバックグラウンドで実行し、完了したら検索用のインデックスと入れ替える（再作成中も判定・チャットは使える）
+from index_jobs import get_index_job_manager, progress_fraction
+
+index_jobs = get_index_job_manager()
+if st.sidebar.button("インデックス再作成", disabled=index_jobs.is_running()):
+    if index_jobs.start():
+        st.sidebar.info("インデックスの再作成を開始しました。")
+    else:
+        st.sidebar.warning("インデックスの再作成は実行中です。")
+
+
+def show_index_job_status():
+    """
+    直近のインデックス再作成の状態・進捗（処理したチャンク数・残り時間の目安）・エラーを表示する
+    """
+    state = index_jobs.state()
+    status = state.get("status")
+    progress = state.get("progress") or {}
+    if status == "running":
+        eta = state.get("eta_seconds")
+        st.progress(
+            progress_fraction(progress),
+            text=f"インデックス再作成中: ファイル {progress.get('parse_count', 0)}/{progress.get('total_files', 0)}"
+                 f"・埋め込み済みチャンク {progress.get('embed_count', 0)}/{progress.get('chunk_count', 0)}"
+                 + (f"・残り約{eta:.0f}秒" if eta is not None else ""),
+        )
+    elif status == "succeeded":
+        elapsed = state["finished_at"] - state["started_at"]
+        message = "新しいインデックスに差し替えました" if state.get("swapped") else "変更がないため、インデックスはそのままです"
+        st.success(f"インデックス再作成完了（{elapsed:.0f}秒, チャンク {progress.get('embed_count', 0)}件）: {message}")
+    elif status in ("failed", "interrupted"):
+        st.error(f"インデックス再作成に失敗しました: {state.get('error')}")
+
+    # 実行中から完了に変わったら画面全体を再実行する（定期更新を止め、再作成ボタンを押せるようにする）
+    was_running = st.session_state.get("index_job_running", False)
+    st.session_state["index_job_running"] = status == "running"
+    if was_running and status != "running":
+        st.rerun()
+
+
+with st.sidebar:
+    # 実行中は2秒ごとに状態を読み直す（サイドバーのこの部分だけを再実行する）
+    st.fragment(run_every=2 if index_jobs.is_running() else None)(show_index_job_status)()
 
 st.sidebar.markdown("---")
 
@@ -73,7 +132,9 @@ if uploaded_example_accounting_entry is not None:
     save_path = os.path.join(doc_uploaded_example_accounting_entry_dir, uploaded_example_accounting_entry.name)
     with open(save_path, "wb") as f:
         f.write(uploaded_example_accounting_entry.read())
-    st.sidebar.success(f"{uploaded_example_accounting_entry.name} を example_accounting_entry に保存しました。")
+    # 仕訳例の行単位インデックスに追加（判定時は品目に類似する行だけをプロンプトに載せる）
+    journal_index = load_journal_index(doc_uploaded_example_accounting_entry_dir)
+    st.sidebar.success(f"{uploaded_example_accounting_entry.name} を example_accounting_entry に保存しました。（仕訳例 {len(journal_index.rows)}行）")
 
 # --- 対になる証憑アップローダ ---
 st.sidebar.subheader("関連証憑データアップロード")
@@ -112,75 +173,10 @@ uploaded_qa_file = st.file_uploader(
 # PDFアップロード時のみ解析し、セッションに保存
 if uploaded_qa_file is not None and "qa_file_name" not in st.session_state:
     try:
-        with st.spinner("PDFを解析中..."):
-            # 一時ファイルとして保存
-            with open("temp_upload.pdf", "wb") as f:
-                f.write(uploaded_qa_file.read())
-
-            # Azure Document Intelligenceクライアント作成
-            client = DocumentIntelligenceClient(
-                endpoint=AZURE_ENDPOINT,
-                credential=AzureKeyCredential(AZURE_KEY)
-            )
-
-            # PDFファイルを開いて送信
-            with open("temp_upload.pdf", "rb") as doc:
-                poller = client.begin_analyze_document(
-                    "prebuilt-layout",
-                    doc,
-                    output_content_format="markdown",
-                    content_type="application/octet-stream",
-                )
-                result = poller.result()
-
-            # --- 取得データの構造を確認 ---
-            import json
-            from pprint import pformat
-
-            def safe_obj_to_dict(obj):
-                # Azure SDKのモデルは__dict__やvars()で属性を取得できる
-                try:
-                    return {k: safe_obj_to_dict(v) if hasattr(v, "__dict__") else v for k, v in vars(obj).items()}
-                except Exception:
-                    return str(obj)
-
-            # --- テーブル情報があればpandas.DataFrameで表示 ---
-            import pandas as pd
-            # --- 構造を持ったテキストとしてparagraphsとtablesを統合 ---
-            def extract_structured_text(result):
-                texts = []
-
-                # テーブル情報をMarkdown形式で抽出
-                tables = getattr(result, "tables", [])
-                for table in tables:
-                    nrows = table.row_count
-                    ncols = table.column_count
-                    cells = [["" for _ in range(ncols)] for _ in range(nrows)]
-                    for cell in table.cells:
-                        r, c = cell.row_index, cell.column_index
-                        cells[r][c] = cell.content
-                    # Markdownテーブル形式
-                    if nrows > 0 and ncols > 0:
-                        header = "| " + " | ".join(cells[0]) + " |"
-                        sep = "| " + " | ".join(["---"] * ncols) + " |"
-                        body = "\n".join(["| " + " | ".join(row) + " |" for row in cells[1:]])
-                        table_md = "\n".join([header, sep, body])
-                        texts.append(table_md)
-
-                # 段落情報を階層付きで抽出
-                paragraphs = getattr(result, "paragraphs", [])
-                for para in paragraphs:
-                    # heading_levelがあれば見出しとして出力
-                    heading_level = getattr(para, "role", None)
-                    if heading_level and hasattr(para, "content"):
-                        texts.append(f"## {para.content}")
-                    else:
-                        texts.append(para.content)
-
-                return "\n\n".join(texts)
-
-            extracted_text = extract_structured_text(result)
-
+        with st.spinner("PDFを解析中..."), start_trace("upload", file=uploaded_qa_file.name) as trace:
+            remember_trace("upload", trace)
+            # ファイル内容（SHA-256）＋モデルIDで解析結果をキャッシュし、再アップロード時は即座に返す
+            extracted_text, _ = analyze_document(uploaded_qa_file.getvalue(), model_id="prebuilt-layout")
 
             # セッションに保存
             st.session_state["extracted_text"] = extracted_text
@@ -190,15 +186,13 @@ if uploaded_qa_file is not None and "qa_file_name" not in st.session_state:
             with st.spinner("LLMで品目と金額を抽出中..."):
                 extracted_result = asset_extract_items(extracted_text)
                 st.session_state["extracted_items"] = extracted_result
-
-            # 一時ファイル削除
-            os.remove("temp_upload.pdf")
     except Exception as e:
         import traceback
         error_message = "PDF解析中にエラーが発生しました。\n" + traceback.format_exc()
         st.error(error_message)
 if "extracted_items" in st.session_state:
     st.subheader("LLMによる品目・金額抽出結果")
+    show_trace_panel("upload")
     # st.markdown(st.session_state["extracted_text"])
     try:
         df_extracted = parse_extracted_items_to_dataframe(st.session_state["extracted_items"])
@@ -224,67 +218,100 @@ if "extracted_text" in st.session_state:
             elif isinstance(document_text, pd.DataFrame):
                 document_text = document_text.to_csv(index=False)
 
-            rag_response = asset_judge(
-                user_chat="以下のテキストから品目ごとに金額、勘定科目、法定耐用年数、根拠を抽出してください。",
-                document_text=document_text
-            )
+            # 判定結果はストリーミングで受け取り、品目ごとの行が確定した時点で表に追加する
+            live_table = st.empty()
+            row_stream = LLMOutputRowStream()
+            rag_response = ""
+            with start_trace("asset_judge") as trace:
+                remember_trace("asset_judge", trace)
+                for token in asset_judge_stream(
+                    user_chat="以下のテキストから品目ごとに金額、勘定科目、法定耐用年数、根拠を抽出してください。",
+                    document_text=document_text
+                ):
+                    rag_response += token
+                    if row_stream.feed(token):
+                        live_table.dataframe(row_stream.dataframe(), use_container_width=True)
+                row_stream.close()
+            live_table.empty()
             st.session_state["rag_response"] = rag_response
 
+            cache_stats = get_judgement_cache().stats()
+            st.caption(
+                f"判定キャッシュ: 命中率 {cache_stats['hit_rate']:.0%}"
+                f"（{cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']}品目）"
+                f"・省略したLLM呼び出し {cache_stats['calls_bypassed']}回"
+                f"・節約トークン（概算） {cache_stats['bypassed_tokens']:,}"
+            )
+
 if "rag_response" in st.session_state:
     st.subheader("固定資産判定結果")
+    show_trace_panel("asset_judge")
     # st.markdown(st.session_state["rag_response"]) 
     # 表形式に変換して表示
     try:
+        from table_diff import ROW_KEY, with_row_keys, strip_row_keys, diff_tables
+
         df = parse_llm_output_to_dataframe(st.session_state["rag_response"])
         # st.subheader("固定資産判定結果")
-        edited_df = st.data_editor(df, use_container_width=True, num_rows="dynamic")
+        # 行キー（非表示）で元の行と編集後の行を対応付ける（行の追加・削除・並べ替えがあっても正しく比較できる）
+        edited_df = st.data_editor(
+            with_row_keys(df), column_config={ROW_KEY: None}, use_container_width=True, num_rows="dynamic"
+        )
 
         # オプションで、保存ボタンを表示して、保存処理を追加可能
         if st.button("修正内容を保存"):
-            st.session_state["edited_df"] = edited_df
+            st.session_state["edited_df"] = strip_row_keys(edited_df)
             st.success("修正内容を保存しました")
 
             # --- 差分検出＆ChangeTitleテーブルへ挿入 ---
-            from db_control.crud import myinsert
+            from db_control.crud import insert_many
             from db_control.mymodels import ChangeTitle
             from datetime import datetime
 
-            def safe_to_float(value):
-                try:
-                    return float(str(value).replace(",", "").replace("円", "").strip())
-                except:
-                    return 0.0
-
-            original_df = parse_llm_output_to_dataframe(st.session_state["rag_response"])
-            edited_df = st.session_state["edited_df"]
-
-            # 比較と差分検出
-            for idx in range(len(original_df)):
-                original_row = original_df.iloc[idx]
-                edited_row = edited_df.iloc[idx]
-
-                if not original_row.equals(edited_row):
-                    change_log = {
-                        "OperationTimestamp": datetime.now().isoformat(),
-                        "TargetRecordID": str(idx),
-                        "Old_ItemName": str(original_row.get("品目", "")),
-                        "New_ItemName": str(edited_row.get("品目", "")),
-                        "Old_Amount": safe_to_float(original_row.get("金額", 0)),
-                        "New_Amount": safe_to_float(edited_row.get("金額", 0)),
-                        "Old_AccountTitle": str(original_row.get("勘定科目", "")),
-                        "New_AccountTitle": str(edited_row.get("勘定科目", "")),
-                        "Old_LegalUsefulLife": str(original_row.get("法定耐用年数", "")),
-                        "New_LegalUsefulLife": str(edited_row.get("法定耐用年数", "")),
-                        "Old_Basis": str(original_row.get("根拠", "")),
-                        "New_Basis": str(edited_row.get("根拠", "")),
-                        "Remarks": "Streamlit経由で修正"
-                    }
-                    myinsert(ChangeTitle, change_log)
+            # 比較と差分検出（列単位でまとめて比較し、差分は1つのトランザクションで保存する）
+            diff = diff_tables(with_row_keys(df), edited_df)
+            change_logs = diff.to_change_logs(datetime.now().isoformat())
+            # 人による修正は次回以降の判定でLLMより優先して使う
+            get_judgement_cache().record_corrections(diff.corrected_rows())
+            if change_logs:
+                insert_many(ChangeTitle, change_logs)
+                summary = diff.summary()
+                st.caption(
+                    f"修正履歴に{len(change_logs)}件を記録しました"
+                    f"（変更{summary['modified']}行・追加{summary['inserted']}行・削除{summary['deleted']}行）"
+                )
     except Exception as e:
         st.error("表形式での変換に失敗しました。出力形式を確認してください。")
         st.exception(e)
 
 
+# --- 修正履歴（新しい順にページ単位で表示。履歴が増えても表示する分だけを読み込む） ---
+# st.expander は閉じていても中身を毎回実行するため、表示を選んだときだけDBに問い合わせる
+if st.checkbox("修正履歴を表示", value=False, key="show_history"):
+    from db_control.crud import select_page
+    from db_control.mymodels import ChangeTitle
+
+    history_item = st.text_input("品目名で絞り込み（修正後の品目名と完全一致）", key="history_item")
+    # 各ページの先頭位置（before_id）を積んでおき、前後のページに移動する
+    history_cursors = st.session_state.setdefault("history_cursors", [None])
+    if st.session_state.get("history_filter") != history_item:
+        st.session_state["history_filter"] = history_item
+        history_cursors[:] = [None]
+    history_rows, next_before_id = select_page(
+        ChangeTitle,
+        page_size=50,
+        before_id=history_cursors[-1],
+        filters={"New_ItemName": history_item} if history_item else None,
+    )
+    st.dataframe(pd.DataFrame(history_rows), use_container_width=True, hide_index=True)
+    col_prev, col_next = st.columns(2)
+    if col_prev.button("前のページ", disabled=len(history_cursors) == 1, key="history_prev"):
+        history_cursors.pop()
+        st.rerun()
+    if col_next.button("次のページ", disabled=next_before_id is None, key="history_next"):
+        history_cursors.append(next_before_id)
+        st.rerun()
+
 # --- 台帳書き込み用出力 ---
 if "rag_response" in st.session_state:
     if st.button("固定資産台帳への書き込み用データを作成する"):
@@ -306,8 +333,12 @@ if "rag_response" in st.session_state:
                 df = None
 
             if df is not None:
-                final_response = refine_rag_response_from_df(df)
+                # 最終出力はトークン単位で表示しながら受け取る
+                with start_trace("refine") as trace:
+                    remember_trace("refine", trace)
+                    final_response = st.write_stream(refine_rag_response_from_df_stream(df))
                 st.session_state["final_rag_response"] = final_response
+                show_trace_panel("refine")
 
                 st.markdown("### 固定資産台帳用の最終出力結果")
 
@@ -321,6 +352,46 @@ if "rag_response" in st.session_state:
                     st.exception(e)
                     st.text_area("テキスト表示（参考）", final_response, height=400)
 
+# --- 一括処理（月末締め用） ---
+st.markdown("---")
+with st.expander("証憑の一括処理（複数ファイル）"):
+    batch_files = st.file_uploader(
+        "固定資産判定を行いたい証憑をまとめてアップロードしてください",
+        type=["pdf", "jpg", "jpeg", "png", "bmp", "tiff"],
+        accept_multiple_files=True,
+        key="batch_files"
+    )
+    batch_concurrency = st.number_input("同時処理数", min_value=1, max_value=16, value=4, key="batch_concurrency")
+    if batch_files and st.button("一括処理を開始"):
+        from batch_process import run_batch
+
+        progress_bar = st.progress(0.0, text="一括処理中...")
+
+        def show_batch_progress(done, total, name):
+            progress_bar.progress(done / total, text=f"{done}/{total} 件完了（{name}）")
+
+        # 中断しても同じ出力先で再実行すれば処理済みの証憑は飛ばされる
+        ledger_df, timings_df = run_batch(
+            [(f.name, f.getvalue()) for f in batch_files],
+            output_dir="batch_output",
+            concurrency=int(batch_concurrency),
+            on_progress=show_batch_progress,
+        )
+        st.session_state["batch_ledger_df"] = ledger_df
+        st.session_state["batch_timings_df"] = timings_df
+
+    if "batch_ledger_df" in st.session_state:
+        st.markdown("#### 統合台帳データ")
+        st.dataframe(st.session_state["batch_ledger_df"], use_container_width=True)
+        st.download_button(
+            "台帳データをCSVでダウンロード",
+            st.session_state["batch_ledger_df"].to_csv(index=False).encode("utf-8-sig"),
+            file_name="ledger.csv",
+            mime="text/csv",
+        )
+        st.markdown("#### ファイル別所要時間")
+        st.dataframe(st.session_state["batch_timings_df"], use_container_width=True)
+
 # --- チャットボット機能 ---
 st.markdown("---")
 st.header("チャットボット")
@@ -331,11 +402,11 @@ if "chat_history" not in st.session_state:
 user_input = st.text_input("不明点あれば質問を入力してください", key="chat_input")
 if st.button("送信"):
     if user_input:
+        if "chat_memory" not in st.session_state:
+            # 直近の往復はそのまま、古い往復は要約と関連検索で渡す（会話が長くなってもプロンプトが伸びない）
+            st.session_state.chat_memory = ConversationMemory()
         # 会話履歴を構築
-        old_chat = ""
-        for speaker, message in st.session_state.chat_history:
-            prefix = "ユーザー: " if speaker == "ユーザー" else "ボット: "
-            old_chat += f"{prefix}{message}\n"
+        old_chat = st.session_state.chat_memory.build_context(user_input)
 
         # --- 修正済みの DataFrame があればそれを使う ---
         df_chat_source = st.session_state.get("edited_df")  # ← rag_responseを編集したDataFrame
@@ -344,12 +415,16 @@ if st.button("送信"):
         else:
             document_text = st.session_state.get("rag_response", "")
 
-        # 応答生成
-        with st.spinner("AIが応答を生成中..."):
-            bot_reply = generate_response(user_input, old_chat=old_chat, document_text=document_text)
+        # 応答生成（トークンが届いた順に表示し、完了後は下の履歴表示に任せる）
+        live_reply = st.empty()
+        with live_reply.container(), start_trace("chat") as trace:
+            remember_trace("chat", trace)
+            bot_reply = st.write_stream(generate_response_stream(user_input, old_chat=old_chat, document_text=document_text))
+        live_reply.empty()
 
         st.session_state.chat_history.append(("ユーザー", user_input))
         st.session_state.chat_history.append(("ボット", bot_reply))
+        st.session_state.chat_memory.add_turn(user_input, bot_reply)
 # チャット履歴表示（最大幅で表示）
 for speaker, message in st.session_state.chat_history:
     with st.container():
@@ -363,3 +438,6 @@ for speaker, message in st.session_state.chat_history:
                 f'<div style="text-align: left; background-color: #f6f6f6; padding: 8px; border-radius: 8px; margin-bottom: 4px; width:100%;"><b>🤖 {speaker}:</b> {message}</div>',
                 unsafe_allow_html=True
             )
+
+# 直近のチャット応答の処理時間
+show_trace_panel("chat")
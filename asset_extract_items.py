@@ -1,5 +1,5 @@
 import os
-import openai
+from llm_client import chat_completion
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -9,12 +9,6 @@ def asset_extract_items(document_text: str) -> str:
     テキストから品目と金額のみをLLMで抽出して返す
     """
 
-    # OpenAIクライアント設定
-    client = openai.AzureOpenAI(
-        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-        api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview"),
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    )
     deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
 
     # プロンプト
@@ -33,7 +27,7 @@ def asset_extract_items(document_text: str) -> str:
 - 不明な場合や該当なしの場合は「該当情報なし」と記載してください
     """
 
-    response = client.chat.completions.create(
+    response = chat_completion(
         model=deployment,
         messages=[
             {"role": "system", "content": "あなたは日本の会計に精通したAIです。"},
@@ -1,128 +1,102 @@
 import os
-import openai
+import asyncio
 from dotenv import load_dotenv
 from make_df import parse_llm_output_to_dataframe
 
-from collect_law_texts import collect_law_texts_list
-from extract_lifetime_azure import extract_lifetime_info_azure
-from langchain_community.vectorstores.faiss import FAISS
-from langchain_community.embeddings.azure_openai import AzureOpenAIEmbeddings
-import pandas as pd
+from async_llm import run_sync
+from extract_lifetime_azure import extract_lifetime_info_azure_async
+from retrieval_service import get_retrieval_service
+from llm_client import chat_completion, chat_completion_async, iter_completion_text, format_api_error
+from reference_data import get_account_titles
+from account_index import get_account_candidates_text
+from law_index import retrieve_law_articles
+from lifetime_index import split_items
+from journal_index import retrieve_journal_examples
+from judgement_cache import get_judgement_cache, parse_item_amounts, format_judgement_rows
+from prompt_budget import PromptBudget, PromptSection, count_tokens
+from tracing import span, start_trace
 import re
-import csv
 
 
 # .env 読み込み
 load_dotenv()
 
+SYSTEM_PROMPT = "あなたは日本の会計に精通した経理アシスタントAIです。"
+# 会計基準・実務資料から取り出すチャンク数
+RETRIEVE_TOP_K = 4
+
 def load_account_titles(csv_path: str) -> list:
     """
     勘定科目一覧CSVを読み込み、リストで返す
     """
-    account_list = []
-    import streamlit as st
-    with open(csv_path, encoding="utf-8-sig") as f:
-        reader = csv.DictReader(f)
-        for i, row in enumerate(reader):
-            # st.write("CSVヘッダー:", list(row.keys()))
-            account_list.append(row)
-    return account_list
+    return get_account_titles(csv_path)
 
-def asset_judge(user_chat: str, old_chat: str = "", document_text :str = "") -> str:
+def retrieve_context(user_chat: str, document_text: str = "") -> str:
     """
-    ユーザーからの質問文を受け取り、法令・PDF情報・耐用年数データをもとに
-    会計的な観点から勘定科目と耐用年数を出力する回答を返す
-
-    Parameters:
-        user_chat (str): ユーザーの質問文（例: "エアコンとPCの仕訳教えて"）
-
-    Returns:
-        str: 回答文
+    会計基準・実務資料のインデックスから質問・証憑に関連するチャンクを取得してテキストで返す
+    証憑の品目ごとのサブクエリも加え、BM25とベクトル検索の結果を統合する
     """
-    
-        
-    # === STEP 1: FAISSインデックスから類似コンテキスト取得 ===
-    # 埋め込みモデル読み込み（Azure OpenAI埋め込みに変更）
-    embedding_model = AzureOpenAIEmbeddings(
-        chunk_size=2048,
-        azure_deployment="text-embedding-3-large-astena"
-    )
-    index = FAISS.load_local(
-        folder_path="storage",
-        embeddings=embedding_model,
-        allow_dangerous_deserialization=True
-    )
+    # インデックスと埋め込みモデルはプロセス内で共有（storage/ 更新時のみ再読み込み）
+    retrieval = get_retrieval_service("storage")
 
     query_text = user_chat + "\n" + document_text
-    print("クエリの内容:")
-    print(query_text)
-    retrieved_docs = index.similarity_search(query_text, k=2)
+    sub_queries = split_items(document_text) if document_text.strip() else []
+    retrieved_docs = retrieval.hybrid_search(query_text, sub_queries, k=RETRIEVE_TOP_K)
     retrieved_context = "\n".join([doc.page_content for doc in retrieved_docs])
-    print("類似度の高いチャンク:")
-    print(retrieved_context)
-
-    # === STEP 2: 法定耐用年数の情報抽出 ===
-    law_list = collect_law_texts_list("document")
-    account_list = load_account_titles("document/勘定科目一覧.csv")
-    lifetime_info = extract_lifetime_info_azure(user_chat, law_list)
-
-    # 勘定科目一覧をテキスト化
-    account_texts = "【勘定科目一覧】\n"
-    for row in account_list:
-        account_texts += f"{row['勘定科目']}: {row['解説']}\n"
-
-    # === STEP 3: 減価償却に関する法令テキスト読込 ===
-    txt_file = "減価償却に関する法令.txt"
-    txt_path = os.path.join("document", txt_file)
-    txt_content = ""
-    if os.path.exists(txt_path):
-        with open(txt_path, encoding="utf-8") as f:
-            txt_content = f.read()
-    else:
-        txt_content = "（法令テキストが見つかりませんでした）"
-
-    # === STEP 4: 仕訳例を読込 ===
-    example_dir = "document/example_accounting_entry/"
-    os.makedirs(example_dir, exist_ok=True)
-
-    # エクセル読み込み
-    excel_files = [f for f in os.listdir(example_dir) if f.endswith(('.xlsx', '.xls'))]
-
-    dataframes = {}
-    for file in excel_files:
-        file_path = os.path.join(example_dir, file)
-        try:
-            df = pd.read_excel(file_path)
-            dataframes[file] = df
-            print(f"\n {file} の内容:")
-            print(df.head())
-        except Exception as e:
-            print(f"{file} の読み込み中にエラーが発生しました: {e}")
-   
-    # 複数Excelファイルの仕訳例を文字列化してまとめる
-    accounting_examples_text = ""
-    for file, df in dataframes.items():
-        accounting_examples_text += f"\n■ {file} の仕訳例:\n"
-        accounting_examples_text += df.to_string(index=False)
-        accounting_examples_text += "\n"
-    print("仕訳実績:")
-    print(accounting_examples_text)
-
-
-    # === STEP 5: Azure OpenAIへ問い合わせ ===
-    api_key = os.environ.get("AZURE_OPENAI_API_KEY")
-    azure_endpoint = os.environ.get("AZURE_OPENAI_ENDPOINT")
-    deployment = os.environ.get("AZURE_OPENAI_DEPLOYMENT")
-    api_version = os.environ.get("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
-
-    client = openai.AzureOpenAI(
-        api_key=api_key,
-        api_version=api_version,
-        azure_endpoint=azure_endpoint,
-    )
+    return retrieved_context
+
+
+def load_account_texts(query_text: str, csv_path: str = "document/勘定科目一覧.csv") -> str:
+    """
+    勘定科目一覧のうち、証憑の品目ごとに候補となる科目だけをプロンプト用のテキストにする
+    （品目から候補を絞り込めない場合は全件を載せる）
+    """
+    return get_account_candidates_text(query_text, csv_path)
+
+
+def load_law_text(query_text: str) -> str:
+    """
+    減価償却に関する法令のうち、質問・証憑の品目に関連する条文（項単位）だけを取り出す
+    """
+    return retrieve_law_articles(query_text)
+
+
+def load_accounting_examples(query_text: str, example_dir: str = "document/example_accounting_entry/") -> str:
+    """
+    仕訳例の中から、証憑の品目に類似する行だけをプロンプト用のテキストにまとめる
+    （仕訳例が増えてもプロンプトに載せる行数は一定）
+    """
+    return retrieve_journal_examples(query_text, example_dir)
+
+
+def build_judge_prompt(
+    user_chat: str,
+    old_chat: str,
+    document_text: str,
+    account_texts: str,
+    retrieved_context: str,
+    lifetime_info: str,
+    txt_content: str,
+    accounting_examples_text: str,
+) -> str:
+    """
+    固定資産判定用のプロンプトを組み立てる
+    """
+    # セクションごとの上限と、全体の予算を超えた場合に削る優先度（小さいものから削る）
+    budget = PromptBudget("asset_judge")
+    s = budget.fit([
+        PromptSection("document_text", document_text, priority=10, max_tokens=8000),
+        PromptSection("user_chat", user_chat, priority=9, max_tokens=2000),
+        PromptSection("lifetime_info", lifetime_info, priority=8, max_tokens=3000, min_tokens=1000),
+        PromptSection("account_texts", account_texts, priority=7, max_tokens=8000, min_tokens=3000),
+        PromptSection("retrieved_context", retrieved_context, priority=5, max_tokens=3000, min_tokens=500),
+        PromptSection("accounting_examples_text", accounting_examples_text, priority=4, max_tokens=2000, min_tokens=500),
+        PromptSection("txt_content", txt_content, priority=2, max_tokens=6000, min_tokens=1000),
+        PromptSection("old_chat", old_chat, priority=1, max_tokens=3000, keep="tail"),
+    ])
 
     # f-string内で複雑な式展開を避けるため、履歴部分を事前に組み立てる
-    history_text = f"【過去の会話履歴】\n{old_chat}" if old_chat.strip() else ""
+    history_text = f"【過去の会話履歴】\n{s['old_chat']}" if old_chat.strip() else ""
 
     prompt = f"""
         あなたは日本の会計に精通した経理アシスタントAIです。
@@ -139,25 +113,25 @@ def asset_judge(user_chat: str, old_chat: str = "", document_text :str = "") ->
         - 金額はすべて税抜金額のみを記載してください。税込金額しかない場合は税抜計算を行った上で表示させてください。税抜計算式（÷1.1など）など余計な表示しないでください
 
         勘定科目一覧：
-        {account_texts}
+        {s['account_texts']}
 
         【情報】有形固定資産に関連する会計基準・実務資料の抜粋:
-        {retrieved_context}
+        {s['retrieved_context']}
 
         【情報】対象品目に対する法定耐用年数（xmlファイルなどから抽出）:
-        {lifetime_info}
+        {s['lifetime_info']}
 
-        【情報】減価償却に関する法令（法令テキスト）:
-        {txt_content}
+        【情報】減価償却に関する法令（関連する条文の抜粋）:
+        {s['txt_content']}
 
         【情報】仕訳例:
-        {accounting_examples_text}
+        {s['accounting_examples_text']}
 
         【ユーザーの質問】
-        {user_chat}
+        {s['user_chat']}
 
         【対象となる証憑テキスト】
-        {document_text}
+        {s['document_text']}
 
         【過去のチャット情報】
         {history_text}
@@ -174,41 +148,171 @@ def asset_judge(user_chat: str, old_chat: str = "", document_text :str = "") ->
         - 不明な場合は「該当情報なし」と明記してください。
         - 補足説明があれば端的に記載してください。
         """
+    budget.finalize(prompt)
+
+    return prompt
 
-    try:
-        response = client.chat.completions.create(
-            model=deployment,
-            messages=[
-                {"role": "system", "content": "あなたは日本の会計に精通した経理アシスタントAIです。"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.2,
-            max_tokens=2048
+
+async def prepare_judge_prompt_async(user_chat: str, old_chat: str = "", document_text :str = "") -> str:
+    """
+    互いに依存しない「FAISS検索」「耐用年数の抽出（LLM）」「仕訳例・勘定科目・法令テキストの読込」を
+    並行して実行し、最終問い合わせ用のプロンプトを組み立てる
+    """
+    # === STEP 1〜4: 検索・耐用年数抽出・参照データ読込を並行実行 ===
+    (
+        retrieved_context,
+        lifetime_info,
+        account_texts,
+        txt_content,
+        accounting_examples_text,
+    ) = await asyncio.gather(
+        asyncio.to_thread(retrieve_context, user_chat, document_text),
+        # 耐用年数表は保存済みインデックスから品目ごとの候補行だけを引く
+        extract_lifetime_info_azure_async(document_text or user_chat),
+        asyncio.to_thread(load_account_texts, document_text or user_chat),
+        asyncio.to_thread(load_law_text, user_chat + "\n" + document_text),
+        asyncio.to_thread(load_accounting_examples, document_text or user_chat),
+    )
+    with span("prompt_build"):
+        return build_judge_prompt(
+            user_chat, old_chat, document_text, account_texts,
+            retrieved_context, lifetime_info, txt_content, accounting_examples_text,
         )
-        print(response)
-
-        response_text = response.choices[0].message.content
-        # 表形式に変換
-        # df = parse_llm_output_to_dataframe(response_text)
-        # # 表示
-        # print("\n=== 表形式に整形（asset_judge用） ===")
-        # print(df)
-
-        return response_text
-    
-    except Exception as e:
-        # 詳細なエラー内容を返す
-        import traceback
-        error_message = f"OpenAI APIリクエストでエラーが発生しました。\n"
-        error_message += f"型: {type(e)}\n"
-        error_message += f"内容: {str(e)}\n"
-        tb = traceback.format_exc()
-        error_message += f"トレースバック:\n{tb}\n"
-        # openaiのAPIエラーの場合、response属性があれば詳細も出す
-        if hasattr(e, "response") and hasattr(e.response, "text"):
-            error_message += f"APIレスポンス: {e.response.text}\n"
-        return error_message
-    
+
+
+def _split_cached_items(document_text: str, use_cache: bool) -> tuple:
+    """
+    品目ごとに判定キャッシュを引き、(キャッシュ済みの判定テキスト, LLMに渡す証憑テキスト, 未知の品目) を返す
+    品目が読み取れない場合はキャッシュを使わず、証憑テキストをそのまま返す
+    """
+    items = parse_item_amounts(document_text) if use_cache else []
+    if not items:
+        return "", document_text, []
+    with span("judgement_cache", items=len(items)) as attrs:
+        cached_rows, unknown = get_judgement_cache().split(items)
+        attrs["cached_items"] = len(cached_rows)
+        attrs["cache_hit"] = not unknown
+    if cached_rows:
+        print(f"判定キャッシュ: {len(cached_rows)}/{len(items)}品目はLLMを使わずに判定しました")
+    unknown_text = "".join(f"品目名: {name}\n金額: {amount}\n" for name, amount in unknown)
+    return format_judgement_rows(cached_rows), unknown_text, unknown
+
+
+def _record_judgements(unknown: list, prompt: str, response_text: str) -> None:
+    # LLMで判定した未知の品目を判定キャッシュに登録する
+    if unknown:
+        rows = parse_llm_output_to_dataframe(response_text).to_dict("records")
+        get_judgement_cache().record_llm_output(
+            unknown, rows, token_cost=count_tokens(prompt) + count_tokens(response_text)
+        )
+
+
+async def asset_judge_async(
+    user_chat: str,
+    old_chat: str = "",
+    document_text :str = "",
+    raise_errors: bool = False,
+    use_cache: bool = True,
+) -> str:
+    """
+    asset_judge の非同期版
+    参照情報を並行して集めたうえで、最終の問い合わせを行う
+    raise_errors=True の場合はAPIエラーを文字列にせずそのまま送出する（バッチ処理の再試行用）
+    use_cache=True の場合、判定キャッシュにある品目はLLMに送らず、未知の品目だけを判定する
+    """
+    with start_trace("asset_judge"):
+        cached_text, document_text, unknown = _split_cached_items(document_text, use_cache)
+        if cached_text and not unknown:
+            return cached_text
+
+        prompt = await prepare_judge_prompt_async(user_chat, old_chat, document_text)
+
+        # === STEP 5: Azure OpenAIへ問い合わせ ===
+        deployment = os.environ.get("AZURE_OPENAI_DEPLOYMENT")
+
+        try:
+            response = await chat_completion_async(
+                model=deployment,
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.2,
+                max_tokens=2048
+            )
+
+            response_text = response.choices[0].message.content
+            _record_judgements(unknown, prompt, response_text)
+            return "\n".join(t for t in (cached_text, response_text) if t)
+
+        except Exception as e:
+            if raise_errors:
+                raise
+            # 詳細なエラー内容を返す
+            return format_api_error(e)
+
+
+def asset_judge_stream(user_chat: str, old_chat: str = "", document_text :str = "", use_cache: bool = True):
+    """
+    asset_judge のストリーミング版。判定結果のトークンを届いた順に返すジェネレータ
+    （make_df.LLMOutputRowStream に流し込むと、品目ごとの行が確定した時点で取り出せる）
+    判定キャッシュにある品目の結果は最初にまとめて返す
+    """
+    with start_trace("asset_judge"):
+        cached_text, document_text, unknown = _split_cached_items(document_text, use_cache)
+        if cached_text:
+            yield cached_text + "\n"
+            if not unknown:
+                return
+
+        prompt = run_sync(prepare_judge_prompt_async(user_chat, old_chat, document_text))
+
+        deployment = os.environ.get("AZURE_OPENAI_DEPLOYMENT")
+
+        try:
+            stream = chat_completion(
+                model=deployment,
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.2,
+                max_tokens=2048,
+                stream=True
+            )
+            response_text = ""
+            with span("llm_stream") as attrs:
+                for token in iter_completion_text(stream):
+                    response_text += token
+                    yield token
+                attrs["completion_tokens"] = count_tokens(response_text)
+            _record_judgements(unknown, prompt, response_text)
+        except Exception as e:
+            # 詳細なエラー内容を返す
+            yield format_api_error(e)
+
+
+def asset_judge(
+    user_chat: str,
+    old_chat: str = "",
+    document_text :str = "",
+    raise_errors: bool = False,
+    use_cache: bool = True,
+) -> str:
+    """
+    ユーザーからの質問文を受け取り、法令・PDF情報・耐用年数データをもとに
+    会計的な観点から勘定科目と耐用年数を出力する回答を返す
+    （内部では asset_judge_async を共有イベントループで実行する）
+
+    Parameters:
+        user_chat (str): ユーザーの質問文（例: "エアコンとPCの仕訳教えて"）
+
+    Returns:
+        str: 回答文
+    """
+    return run_sync(asset_judge_async(
+        user_chat, old_chat=old_chat, document_text=document_text, raise_errors=raise_errors, use_cache=use_cache
+    ))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,50 @@
+import asyncio
+import threading
+import httpx
+import openai
+from dotenv import load_dotenv
+
+# .envから環境変数を読み込む
+load_dotenv()
+
+_loop = None
+_client = None
+_lock = threading.Lock()
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """
+    プロセスで共有するイベントループ（専用スレッドで常駐）を返す
+    AsyncAzureOpenAI の接続プールはイベントループに紐づくため、常に同じループ上で実行する
+    """
+    global _loop
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="async-llm-loop", daemon=True)
+            thread.start()
+            _loop = loop
+    return _loop
+
+
+def run_sync(coro):
+    """
+    同期コード（Streamlitなど）からコルーチンを共有イベントループで実行し、結果を返す
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+
+def get_async_client() -> openai.AsyncAzureOpenAI:
+    """
+    共有の AsyncAzureOpenAI クライアントを返す（run_sync で実行されるコルーチン内から使う）
+    """
+    global _client
+    with _lock:
+        if _client is None:
+            from llm_client import _client_settings, http_limits, http_timeout
+
+            _client = openai.AsyncAzureOpenAI(
+                **_client_settings(),
+                http_client=httpx.AsyncClient(limits=http_limits(), timeout=http_timeout()),
+            )
+    return _client
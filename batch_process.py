@@ -0,0 +1,175 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+from dotenv import load_dotenv
+
+from doc_analysis import analyze_document
+from asset_extract_items import asset_extract_items
+from asset_judge import asset_judge
+from make_df import parse_llm_output_to_dataframe
+from refine_rag_response_from_df import refine_rag_response_from_df
+from llm_client import call_with_retry
+
+# .envから環境変数を読み込む
+load_dotenv()
+
+BATCH_STATE_FILE = "batch_state.json"
+VOUCHER_EXTENSIONS = (".pdf", ".jpg", ".jpeg", ".png", ".bmp", ".tiff")
+JUDGE_INSTRUCTION = "以下のテキストから品目ごとに金額、勘定科目、法定耐用年数、根拠を抽出してください。"
+
+
+class BatchState:
+    """
+    バッチ処理の進捗（ファイルごとの結果・所要時間・エラー）をディスクに保存し、再実行時に再開できるようにする
+    キーはファイル内容のSHA-256（同じ証憑はファイル名が違っても1度だけ処理する）
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def is_done(self, key: str) -> bool:
+        return self.entries.get(key, {}).get("status") == "done"
+
+    def update(self, key: str, entry: dict) -> None:
+        with self._lock:
+            self.entries[key] = entry
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+def process_voucher(name: str, file_bytes: bytes, retries: int = 5) -> dict:
+    """
+    1件の証憑について 解析 → 品目抽出 → 固定資産判定 → 台帳用整理 を行い、行データとステージ別の所要時間を返す
+    retries は文書解析の再試行回数（LLMの呼び出しは llm_client の中で LLM_RETRIES 回まで再試行する）
+    """
+    timings = {}
+
+    start = time.perf_counter()
+    extracted_text, _ = call_with_retry(analyze_document, file_bytes, retries=retries)
+    timings["analyze"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    extracted_items = asset_extract_items(extracted_text)
+    timings["extract"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rag_response = asset_judge(JUDGE_INSTRUCTION, document_text=extracted_items, raise_errors=True)
+    timings["judge"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    judged_df = parse_llm_output_to_dataframe(rag_response)
+    final_response = rag_response
+    if not judged_df.empty:
+        final_response = refine_rag_response_from_df(judged_df)
+    timings["refine"] = time.perf_counter() - start
+
+    rows = parse_llm_output_to_dataframe(final_response).to_dict("records")
+    return {"name": name, "rows": rows, "timings": timings, "rag_response": rag_response}
+
+
+def run_batch(
+    inputs: list,
+    output_dir: str = "batch_output",
+    concurrency: int = 4,
+    retries: int = 5,
+    on_progress=None,
+) -> tuple:
+    """
+    複数の証憑（(ファイル名, バイト列) のリスト）を並行して処理し、統合した台帳データを返す
+    進捗は output_dir/batch_state.json に保存され、同じ output_dir で再実行すると完了済みの証憑は飛ばす
+
+    Returns:
+        tuple: (台帳用DataFrame, ファイル別所要時間DataFrame)
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    state = BatchState(os.path.join(output_dir, BATCH_STATE_FILE))
+
+    jobs = {}
+    for name, file_bytes in inputs:
+        jobs.setdefault(hashlib.sha256(file_bytes).hexdigest(), (name, file_bytes))
+    pending = {key: job for key, job in jobs.items() if not state.is_done(key)}
+    print(f"証憑数: {len(jobs)}（処理済み {len(jobs) - len(pending)} / 未処理 {len(pending)}）")
+
+    completed = len(jobs) - len(pending)
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = {
+            pool.submit(process_voucher, name, file_bytes, retries): (key, name)
+            for key, (name, file_bytes) in pending.items()
+        }
+        for future in as_completed(futures):
+            key, name = futures[future]
+            try:
+                result = future.result()
+                state.update(key, {"status": "done", **result})
+                print(f"完了: {name}（{sum(result['timings'].values()):.1f}秒）")
+            except Exception as e:
+                state.update(key, {"status": "error", "name": name, "error": f"{type(e).__name__}: {e}"})
+                print(f"エラー: {name}: {e}")
+            completed += 1
+            if on_progress:
+                on_progress(completed, len(jobs), name)
+
+    ledger_rows = []
+    timing_rows = []
+    for key in jobs:
+        entry = state.entries.get(key, {})
+        for row in entry.get("rows", []):
+            ledger_rows.append({"ファイル名": entry["name"], **row})
+        timing_rows.append({
+            "ファイル名": entry.get("name", jobs[key][0]),
+            "状態": entry.get("status", ""),
+            **{f"{stage}_秒": round(sec, 2) for stage, sec in entry.get("timings", {}).items()},
+            "エラー": entry.get("error", ""),
+        })
+    ledger_df = pd.DataFrame(ledger_rows)
+    timings_df = pd.DataFrame(timing_rows)
+    ledger_df.to_csv(os.path.join(output_dir, "ledger.csv"), index=False, encoding="utf-8-sig")
+    timings_df.to_csv(os.path.join(output_dir, "timings.csv"), index=False, encoding="utf-8-sig")
+    return ledger_df, timings_df
+
+
+def collect_voucher_files(input_dir: str) -> list:
+    """
+    ディレクトリ内の証憑ファイルを (ファイル名, バイト列) のリストで返す
+    """
+    inputs = []
+    for filename in sorted(os.listdir(input_dir)):
+        if filename.lower().endswith(VOUCHER_EXTENSIONS):
+            with open(os.path.join(input_dir, filename), "rb") as f:
+                inputs.append((filename, f.read()))
+    return inputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="証憑の一括固定資産判定（月末締め用）")
+    parser.add_argument("input_dir", help="証憑ファイル（PDF/画像）を置いたディレクトリ")
+    parser.add_argument("--output", default="batch_output", help="台帳・進捗の出力先ディレクトリ")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時に処理する証憑数")
+    parser.add_argument("--retries", type=int, default=5, help="文書解析がレート制限などで失敗したときの再試行回数（LLMの再試行回数は LLM_RETRIES）")
+    args = parser.parse_args()
+
+    ledger_df, timings_df = run_batch(
+        collect_voucher_files(args.input_dir),
+        output_dir=args.output,
+        concurrency=args.concurrency,
+        retries=args.retries,
+    )
+    print("\n=== ファイル別所要時間 ===")
+    print(timings_df.to_string(index=False))
+    print(f"\n台帳出力: {os.path.join(args.output, 'ledger.csv')}（{len(ledger_df)}行）")
+    has_error = "状態" in timings_df and (timings_df["状態"] == "error").any()
+    sys.exit(1 if has_error else 0)
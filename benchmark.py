@@ -0,0 +1,305 @@
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import functools
+import tracemalloc
+import contextlib
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+import fake_backends
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BASE_DIR, "benchmark_results")
+SAMPLE_ITEMS = ["ノートPC", "エアコン", "複合機", "応接セット", "サーバー", "プロジェクター", "金庫", "冷蔵庫"]
+
+
+class Recorder:
+    """
+    シナリオ・規模・ステージごとの所要時間と、実行ごとのプロンプトトークン数・メモリを記録する
+    """
+
+    def __init__(self):
+        self.scenario = ""
+        self.size = 0
+        self.durations = defaultdict(list)   # (scenario, size, stage) -> [秒]
+        self.runs = defaultdict(list)        # (scenario, size) -> [{"prompt_tokens", "llm_calls", "peak_mb"}]
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.durations[(self.scenario, self.size, stage)].append(seconds)
+
+    @contextlib.contextmanager
+    def run(self):
+        fake_backends.call_log.drain()
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        yield
+        self.add("total", time.perf_counter() - start)
+        calls = fake_backends.call_log.drain()
+        llm_calls = [c for c in calls if c["kind"] == "llm"]
+        self.runs[(self.scenario, self.size)].append({
+            "prompt_tokens": sum(c["prompt_tokens"] for c in llm_calls),
+            "llm_calls": len(llm_calls),
+            "embedding_calls": sum(1 for c in calls if c["kind"] == "embedding"),
+            "peak_mb": tracemalloc.get_traced_memory()[1] / 1024 / 1024,
+        })
+
+    def summary(self) -> list:
+        rows = []
+        for (scenario, size, stage), values in sorted(self.durations.items()):
+            runs = self.runs.get((scenario, size), [])
+            rows.append({
+                "scenario": scenario,
+                "size": size,
+                "stage": stage,
+                "n": len(values),
+                "p50_ms": float(np.percentile(values, 50)) * 1000,
+                "p95_ms": float(np.percentile(values, 95)) * 1000,
+                "mean_ms": float(np.mean(values)) * 1000,
+                "prompt_tokens": float(np.mean([r["prompt_tokens"] for r in runs])) if runs and stage == "total" else None,
+                "llm_calls": float(np.mean([r["llm_calls"] for r in runs])) if runs and stage == "total" else None,
+                "peak_mb": max(r["peak_mb"] for r in runs) if runs and stage == "total" else None,
+            })
+        return rows
+
+
+@contextlib.contextmanager
+def timed(recorder: Recorder, module, name: str, stage: str = None):
+    """
+    module.name（同期関数・コルーチン関数）の所要時間をステージとして記録するよう一時的に差し替える
+    """
+    original = getattr(module, name)
+    stage = stage or name
+
+    if asyncio.iscoroutinefunction(original):
+        @functools.wraps(original)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await original(*args, **kwargs)
+            finally:
+                recorder.add(stage, time.perf_counter() - start)
+    else:
+        @functools.wraps(original)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                recorder.add(stage, time.perf_counter() - start)
+
+    setattr(module, name, wrapper)
+    try:
+        yield
+    finally:
+        setattr(module, name, original)
+
+
+# --- 合成データ ---
+def synthetic_items(n: int) -> list:
+    return [(f"{SAMPLE_ITEMS[i % len(SAMPLE_ITEMS)]}{i // len(SAMPLE_ITEMS) or ''}", f"{(i % 9 + 1) * 55_000:,}円") for i in range(n)]
+
+
+def synthetic_extracted_items(n: int) -> str:
+    return "\n".join(f"品目名: {name}\n金額: {amount}" for name, amount in synthetic_items(n))
+
+
+def synthetic_voucher(n: int) -> bytes:
+    return ("品名,金額\n" + "\n".join(f"{name},{amount.replace(',', '').replace('円', '')}"
+                                      for name, amount in synthetic_items(n))).encode("utf-8")
+
+
+def synthetic_history(turns: int) -> str:
+    return "\n".join(f"ユーザー: {name}の耐用年数は？\nボット: {name}は器具及び備品で4年です。"
+                     for name, _ in synthetic_items(turns))
+
+
+def prepare_workdir(workdir: str, corpus_docs: int, journal_rows: int) -> None:
+    """
+    ベンチマーク用の作業ディレクトリに参照データ（法令・勘定科目・耐用年数表）と合成コーパスを用意する
+    """
+    document_dir = os.path.join(workdir, "document")
+    os.makedirs(os.path.join(document_dir, "docs_for_index"), exist_ok=True)
+    os.makedirs(os.path.join(document_dir, "example_accounting_entry"), exist_ok=True)
+    for name in os.listdir(os.path.join(BASE_DIR, "document")):
+        if name.endswith((".xml", ".txt", ".csv")):
+            shutil.copy2(os.path.join(BASE_DIR, "document", name), document_dir)
+
+    with open(os.path.join(BASE_DIR, "document", "減価償却に関する法令.txt"), encoding="utf-8") as f:
+        law_text = f.read()
+    for i in range(corpus_docs):
+        with open(os.path.join(document_dir, "docs_for_index", f"doc_{i:05d}.txt"), "w", encoding="utf-8") as f:
+            f.write(f"資料{i}\n" + law_text[(i * 997) % len(law_text):] + law_text[:(i * 997) % len(law_text)])
+
+    rows = [
+        {"品目名": name, "金額": amount, "勘定科目": "工具器具備品", "法定耐用年数": "4年"}
+        for name, amount in synthetic_items(journal_rows)
+    ]
+    pd.DataFrame(rows).to_excel(
+        os.path.join(document_dir, "example_accounting_entry", "固定資産台帳_合成.xlsx"), index=False
+    )
+
+
+# --- シナリオ ---
+def bench_faiss_build(recorder: Recorder, size: int, repeat: int, workers: int) -> None:
+    import faiss_index_builder
+
+    for _ in range(repeat):
+        with recorder.run():
+            faiss_index_builder.rebuild_index(
+                data_dir="document/docs_for_index", storage_dir="storage", full_rebuild=True, workers=workers
+            )
+
+
+def bench_asset_judge(recorder: Recorder, size: int, repeat: int) -> None:
+    import asset_judge
+
+    document_text = synthetic_extracted_items(size)
+    with contextlib.ExitStack() as stack:
+        for name in ("retrieve_context", "extract_lifetime_info_azure_async", "load_account_texts",
+                     "load_law_text", "load_accounting_examples", "build_judge_prompt", "chat_completion_async"):
+            stack.enter_context(timed(recorder, asset_judge, name))
+        for _ in range(repeat):
+            with recorder.run():
+                asset_judge.asset_judge(
+                    "以下のテキストから品目ごとに金額、勘定科目、法定耐用年数、根拠を抽出してください。",
+                    document_text=document_text, raise_errors=True, use_cache=False,
+                )
+
+
+def bench_generate_response(recorder: Recorder, size: int, repeat: int) -> None:
+    import chat_response
+
+    old_chat = synthetic_history(size)
+    with contextlib.ExitStack() as stack:
+        for name in ("extract_lifetime_info_azure", "retrieve_law_articles", "build_chat_prompt", "chat_completion"):
+            stack.enter_context(timed(recorder, chat_response, name))
+        for _ in range(repeat):
+            with recorder.run():
+                chat_response.generate_response("ノートPCとエアコンの耐用年数を教えて", old_chat=old_chat)
+
+
+def bench_upload_flow(recorder: Recorder, size: int, repeat: int) -> None:
+    # app.py の「証憑アップロード → 品目抽出 → 固定資産判定 → 表への整形」と同じ順に実行する
+    from doc_analysis import analyze_document
+    from asset_extract_items import asset_extract_items
+    from asset_judge import asset_judge
+    from make_df import parse_llm_output_to_dataframe
+
+    voucher = synthetic_voucher(size)
+    for _ in range(repeat):
+        with recorder.run():
+            start = time.perf_counter()
+            extracted_text, _ = analyze_document(voucher, use_cache=False)
+            recorder.add("analyze_document", time.perf_counter() - start)
+
+            start = time.perf_counter()
+            extracted_items = asset_extract_items(extracted_text)
+            recorder.add("asset_extract_items", time.perf_counter() - start)
+
+            start = time.perf_counter()
+            rag_response = asset_judge(
+                "以下のテキストから品目ごとに金額、勘定科目、法定耐用年数、根拠を抽出してください。",
+                document_text=extracted_items, raise_errors=True, use_cache=False,
+            )
+            recorder.add("asset_judge", time.perf_counter() - start)
+
+            start = time.perf_counter()
+            parse_llm_output_to_dataframe(rag_response)
+            recorder.add("parse_llm_output", time.perf_counter() - start)
+
+
+SCENARIOS = ("faiss_build", "asset_judge", "generate_response", "upload_flow")
+
+
+def print_report(rows: list, baseline: list = None) -> None:
+    base = {(r["scenario"], r["size"], r["stage"]): r for r in baseline or []}
+    print(f"\n{'scenario':<18} {'size':>5} {'stage':<34} {'n':>3} {'p50(ms)':>9} {'p95(ms)':>9} "
+          f"{'tokens':>8} {'peakMB':>7}  {'p50差':>7}")
+    for r in rows:
+        previous = base.get((r["scenario"], r["size"], r["stage"]))
+        delta = f"{(r['p50_ms'] / previous['p50_ms'] - 1) * 100:+.0f}%" if previous and previous["p50_ms"] else ""
+        tokens = f"{r['prompt_tokens']:.0f}" if r["prompt_tokens"] is not None else ""
+        peak = f"{r['peak_mb']:.1f}" if r["peak_mb"] is not None else ""
+        print(f"{r['scenario']:<18} {r['size']:>5} {r['stage']:<34} {r['n']:>3} {r['p50_ms']:>9.1f} "
+              f"{r['p95_ms']:>9.1f} {tokens:>8} {peak:>7}  {delta:>7}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="偽バックエンドでのパイプライン遅延ベンチマーク（Azureに接続しない）")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5, 20, 80],
+                        help="合成データの規模（品目数・会話の往復数・コーパスのファイル数の基準）")
+    parser.add_argument("--repeat", type=int, default=5, help="規模ごとの実行回数")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="LLM呼び出しの固定遅延（秒）")
+    parser.add_argument("--llm-seconds-per-token", type=float, default=0.002, help="出力1トークンあたりの遅延（秒）")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="埋め込みリクエストの固定遅延（秒）")
+    parser.add_argument("--doc-latency", type=float, default=0.8, help="Document Intelligence の遅延（秒）")
+    parser.add_argument("--workers", type=int, default=2, help="インデックス作成時のファイル解析プロセス数")
+    parser.add_argument("--workdir", default=None, help="作業ディレクトリ（省略時は一時ディレクトリ）")
+    parser.add_argument("--baseline", default=None, help="比較対象の結果JSON（p50の増減を表示）")
+    parser.add_argument("--output", default=None, help="結果JSONの出力先")
+    args = parser.parse_args()
+
+    fake_backends.install(fake_backends.FakeConfig(
+        llm_latency=args.llm_latency,
+        llm_seconds_per_token=args.llm_seconds_per_token,
+        embedding_latency=args.embedding_latency,
+        doc_latency=args.doc_latency,
+    ))
+    # 作業ディレクトリへ移動する前に、指定されたパスを絶対パスにしておく
+    output = os.path.abspath(args.output) if args.output else os.path.join(
+        RESULTS_DIR, f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    )
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="asset_bench_")
+    # 各モジュールは相対パス（document/, storage/, cache/）を使うため、作業ディレクトリに移動して実行する
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    print(f"作業ディレクトリ: {workdir}")
+
+    recorder = Recorder()
+    tracemalloc.start()
+    for size in args.sizes:
+        prepare_workdir(workdir, corpus_docs=size, journal_rows=size * 20)
+        recorder.size = size
+        for scenario in args.scenarios:
+            recorder.scenario = scenario
+            print(f"\n=== {scenario} (size={size}) ===")
+            if scenario == "faiss_build":
+                bench_faiss_build(recorder, size, args.repeat, args.workers)
+                continue
+            from retrieval_service import resolve_index_dir
+            if not os.path.exists(os.path.join(resolve_index_dir("storage"), "index.faiss")):
+                import faiss_index_builder
+                faiss_index_builder.rebuild_index(data_dir="document/docs_for_index", storage_dir="storage")
+            {
+                "asset_judge": bench_asset_judge,
+                "generate_response": bench_generate_response,
+                "upload_flow": bench_upload_flow,
+            }[scenario](recorder, size, args.repeat)
+    tracemalloc.stop()
+
+    rows = recorder.summary()
+    baseline = None
+    if baseline_path:
+        with open(baseline_path, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    print_report(rows, baseline)
+
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"args": vars(args), "results": rows}, f, ensure_ascii=False, indent=2)
+    print(f"\n結果: {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,5 @@
 import os
+from reference_data import get_xml_texts
 
 def collect_xml_texts(directory: str):
     """
@@ -16,8 +17,9 @@ def collect_law_texts_list(directory: str):
     """
     指定ディレクトリ内のxmlファイルをすべて読み込み、
     'ファイル名' と '内容' を持つ辞書のリストを返す（law_list形式）
+    （内容は参照データストアにキャッシュされ、ファイルが変わった場合のみ読み直す）
     """
-    xml_dict = collect_xml_texts(directory)
+    xml_dict = get_xml_texts(directory)
     return [{"ファイル名": name, "内容": content} for name, content in xml_dict.items()]
 
 if __name__ == "__main__":
@@ -0,0 +1,138 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from dotenv import load_dotenv
+
+from llm_client import chat_completion
+from prompt_budget import truncate_tokens
+from retrieval_service import get_retrieval_service
+
+# .envから環境変数を読み込む
+load_dotenv()
+
+SUMMARY_SYSTEM_PROMPT = "あなたは会計に関する会話の記録係です。"
+
+
+def _format_turn(user_message: str, bot_message: str) -> str:
+    return f"ユーザー: {user_message}\nボット: {bot_message}"
+
+
+class ConversationMemory:
+    """
+    チャットボットの会話履歴を、直近N往復はそのまま、それより古い往復は要約に畳み込んで保持する
+    古い往復は埋め込みベクトルも保持し、現在の質問に関連するものだけをそのまま取り出せるようにする
+    要約の更新はバックグラウンドで行うため、会話が長くなっても1回の応答にかかる時間は増えない
+    """
+
+    def __init__(self, recent_turns: int = 3, retrieve_k: int = 2, summary_max_tokens: int = 800):
+        self.recent_turns = recent_turns
+        self.retrieve_k = retrieve_k
+        self.summary_max_tokens = summary_max_tokens
+        self.turns = []         # (ユーザー発言, ボット応答)
+        self.vectors = {}       # 往復の番号 -> 正規化済み埋め込みベクトル
+        self.summary = ""
+        self.summarized = 0     # 要約に畳み込み済みの往復数
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="conversation-memory")
+
+    def add_turn(self, user_message: str, bot_message: str) -> None:
+        """
+        1往復を追加し、直近N往復からあふれた往復をバックグラウンドで要約・埋め込みする
+        """
+        with self._lock:
+            self.turns.append((user_message, bot_message))
+            overflow = len(self.turns) - self.recent_turns
+        if overflow > 0:
+            self._executor.submit(self._fold, overflow)
+
+    def _fold(self, until: int) -> None:
+        with self._lock:
+            start = self.summarized
+            pending = self.turns[start:until]
+            summary = self.summary
+        if not pending:
+            return
+        texts = [_format_turn(u, b) for u, b in pending]
+
+        try:
+            vectors = get_retrieval_service("storage").get_embeddings().embed_documents(texts)
+            vectors = {start + i: self._normalize(v) for i, v in enumerate(vectors)}
+        except Exception as e:
+            print(f"会話履歴の埋め込みに失敗しました: {e}")
+            vectors = {}
+
+        try:
+            summary = self._summarize(summary, texts)
+        except Exception as e:
+            # 要約に失敗した場合も会話を失わないよう、末尾に追記して上限で切り詰める
+            print(f"会話履歴の要約に失敗しました: {e}")
+            summary = truncate_tokens(summary + "\n" + "\n".join(texts), self.summary_max_tokens, keep="tail")
+
+        with self._lock:
+            self.vectors.update(vectors)
+            self.summary = summary
+            self.summarized = max(self.summarized, until)
+
+    def _summarize(self, summary: str, texts: list) -> str:
+        prompt = f"""
+これまでの会話の要約に、新しいやり取りの内容を反映した要約を作成してください。
+
+【これまでの要約】
+{summary or "（なし）"}
+
+【新しいやり取り】
+{chr(10).join(texts)}
+
+- 品目名・金額・勘定科目・法定耐用年数など、後の質問で参照されそうな事実は残してください
+- 箇条書きで簡潔に記載してください
+"""
+        response = chat_completion(
+            model=os.environ.get("AZURE_OPENAI_DEPLOYMENT"),
+            messages=[
+                {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.0,
+            max_tokens=self.summary_max_tokens,
+        )
+        return truncate_tokens(response.choices[0].message.content, self.summary_max_tokens)
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _relevant_turns(self, question: str, candidates: list) -> list:
+        # 要約済みの往復のうち、質問との類似度が高いものを会話の順に返す
+        if not candidates or self.retrieve_k <= 0:
+            return []
+        try:
+            query = self._normalize(get_retrieval_service("storage").get_embeddings().embed_query(question))
+        except Exception as e:
+            print(f"会話履歴の検索に失敗しました: {e}")
+            return []
+        scored = sorted(candidates, key=lambda i: -float(self.vectors[i] @ query))
+        return sorted(scored[:self.retrieve_k])
+
+    def build_context(self, question: str) -> str:
+        """
+        現在の質問に対して、要約・関連する過去のやり取り・直近の会話をまとめた履歴テキストを返す
+        """
+        with self._lock:
+            turns = list(self.turns)
+            summary = self.summary
+            # 要約が追いついていない往復は直近の会話としてそのまま載せる
+            recent_start = min(self.summarized, max(0, len(turns) - self.recent_turns))
+            candidates = [i for i in self.vectors if i < recent_start]
+
+        parts = []
+        if summary:
+            parts.append(f"【これまでの会話の要約】\n{summary}")
+        relevant = self._relevant_turns(question, candidates)
+        if relevant:
+            parts.append("【関連する過去のやり取り】\n" + "\n".join(_format_turn(*turns[i]) for i in relevant))
+        if turns[recent_start:]:
+            parts.append("【直近の会話】\n" + "\n".join(_format_turn(u, b) for u, b in turns[recent_start:]))
+        return "\n\n".join(parts)
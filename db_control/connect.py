@@ -1,12 +1,48 @@
-# uname() error回避
-import platform
-print(platform.uname())
+import os
+from contextlib import contextmanager
 
-from sqlalchemy import create_engine
-import sqlalchemy
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
 
-import os
 main_path = os.path.dirname(os.path.abspath(__file__))
-path = os.chdir(main_path)
-print(path)
-engine = create_engine("sqlite:///Account.db", echo=True)
+# SQL文のログ出力（DB_ECHO=1 のときのみ。既定では出さない）
+DB_ECHO = os.getenv("DB_ECHO", "0") == "1"
+# カレントディレクトリを変更すると呼び出し側の相対パス（document/ など）が壊れるため、DBは絶対パスで指定する
+# Streamlitは複数スレッドから使うため、接続はプールで共有する
+engine = create_engine(
+    f"sqlite:///{os.path.join(main_path, 'Account.db')}",
+    echo=DB_ECHO,
+    connect_args={"check_same_thread": False, "timeout": 30},
+    pool_size=5,
+    max_overflow=10,
+    pool_pre_ping=True,
+)
+
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WALにすると書き込み中も読み取りがブロックされない。WALではsynchronous=NORMALでも破損しない
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+# セッションはこのファクトリから作る（呼び出しごとに sessionmaker を作らない）
+SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
+
+
+@contextmanager
+def session_scope():
+    """
+    1つのトランザクションを表すセッション。正常終了でコミット、例外時はロールバックして閉じる
+    """
+    session = SessionLocal()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
@@ -1,48 +1,70 @@
-# uname() error回避
-import platform
-print("platform", platform.uname())
- 
-
-from sqlalchemy import create_engine, insert, delete, update, select
+from sqlalchemy import create_engine, insert, delete, update, select, func
 import sqlalchemy
-from sqlalchemy.orm import sessionmaker
+import threading
 import json
-import pandas as pd
 
-from db_control.connect import engine
- 
+from db_control.connect import engine, SessionLocal, session_scope
 
-def myinsert(mymodel, values):
-    # session構築
-    Session = sessionmaker(bind=engine)
-    session = Session()
+# 一覧取得の1ページあたりの件数の上限
+MAX_PAGE_SIZE = 500
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+
+def ensure_schema():
+    """
+    テーブルと索引がなければ作成する（既存のテーブルにも、後から追加した索引を作る）
+    """
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if not _schema_ready:
+            from db_control.mymodels import Base
+            Base.metadata.create_all(bind=engine)
+            for table in Base.metadata.tables.values():
+                for index in table.indexes:
+                    index.create(bind=engine, checkfirst=True)
+            _schema_ready = True
 
+
+def _to_dict(row) -> dict:
+    return {column.name: getattr(row, column.key) for column in row.__table__.columns}
+
+
+def myinsert(mymodel, values):
+    ensure_schema()
     query = insert(mymodel).values(values)
     try:
-        # トランザクションを開始
-        with session.begin():
-            # データの挿入
-            result = session.execute(query)
+        # トランザクションを開始してデータを挿入
+        with session_scope() as session:
+            session.execute(query)
     except sqlalchemy.exc.IntegrityError:
         print("一意制約違反により、挿入に失敗しました")
-        session.rollback()
- 
-    # セッションを閉じる
-    session.close()
     return "inserted"
- 
+
+
+def insert_many(mymodel, rows: list) -> int:
+    """
+    複数行を1つのトランザクションでまとめて挿入し、挿入した件数を返す
+    （1行ずつ myinsert するとその都度コミットが発生するため、差分の一括保存にはこちらを使う）
+    """
+    if not rows:
+        return 0
+    ensure_schema()
+    with session_scope() as session:
+        session.execute(insert(mymodel), rows)
+    return len(rows)
+
+
 def myselect(mymodel, filter_field: str, filter_value):
-    Session = sessionmaker(bind=engine)
-    session = Session()
+    ensure_schema()
+    session = SessionLocal()
     try:
-        with session.begin():
-            column = getattr(mymodel, filter_field)
-            query = session.query(mymodel).filter(column == filter_value)
-            result = query.all()
-            result_dict = [row.__dict__ for row in result]
-            for row in result_dict:
-                row.pop('_sa_instance_state', None)
-            result_json = json.dumps(result_dict, ensure_ascii=False)
+        column = getattr(mymodel, filter_field)
+        result = session.execute(select(mymodel).where(column == filter_value)).scalars().all()
+        result_json = json.dumps([_to_dict(row) for row in result], ensure_ascii=False)
     except Exception as e:
         print("エラー:", e)
         result_json = None
@@ -51,54 +73,104 @@ def myselect(mymodel, filter_field: str, filter_value):
     return result_json
 
 
-def myselectAll(mymodel):
-    # session構築
-    Session = sessionmaker(bind=engine)
-    session = Session()
+def iter_rows(mymodel, batch_size: int = 1000, order_by: str = None, after_id: int = None, id_field: str = "LogID"):
+    """
+    テーブルの全行を batch_size 件ずつ読み出しながら dict で返すジェネレータ
+    （全件をメモリに載せないため、大きな履歴テーブルでも使える）
+    after_id を指定した場合は id_field がそれより大きい行だけを返す（前回の続きから読む場合）
+    """
+    ensure_schema()
     query = select(mymodel)
+    if after_id is not None:
+        query = query.where(getattr(mymodel, id_field) > after_id)
+    if order_by:
+        query = query.order_by(getattr(mymodel, order_by))
+    session = SessionLocal()
     try:
-        # トランザクションを開始
-        with session.begin():
-            df = pd.read_sql_query(query, con=engine)
-            result_json = df.to_json(orient='records', force_ascii=False)
+        for row in session.execute(query.execution_options(yield_per=batch_size)).scalars():
+            yield _to_dict(row)
+    finally:
+        session.close()
 
-    except sqlalchemy.exc.IntegrityError:
-        print("一意制約違反により、挿入に失敗しました")
-        result_json = None
 
-    # セッションを閉じる
-    session.close()
+def myselectAll(mymodel):
+    # 全件をJSON文字列で返す（件数が多い場合は iter_rows / select_page を使う）
+    try:
+        result_json = json.dumps(list(iter_rows(mymodel)), ensure_ascii=False)
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        print("エラー:", e)
+        result_json = None
     return result_json
 
-def myupdate(mymodel, key_field: str, values: dict):
-    Session = sessionmaker(bind=engine)
-    session = Session()
 
+def select_page(
+    mymodel,
+    page_size: int = 50,
+    before_id: int = None,
+    filters: dict = None,
+    since: str = None,
+    until: str = None,
+    id_field: str = "LogID",
+    timestamp_field: str = "OperationTimestamp",
+) -> tuple:
+    """
+    新しい順に1ページ分の行を返す（キーセット方式のページング）
+    次のページは、返された next_before_id を before_id に渡して取得する（最後のページでは None）
+    OFFSETを使わないため、何ページ目でも索引をたどるだけで取得できる
+
+    Parameters:
+        filters (dict): 列名 -> 値 の完全一致条件（例: {"New_ItemName": "ノートPC"}）
+        since / until (str): timestamp_field の範囲（ISO形式の文字列, since以上・until未満）
+
+    Returns:
+        tuple: (行のdictのリスト, next_before_id)
+    """
+    ensure_schema()
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    id_column = getattr(mymodel, id_field)
+    query = select(mymodel)
+    for field, value in (filters or {}).items():
+        query = query.where(getattr(mymodel, field) == value)
+    if since:
+        query = query.where(getattr(mymodel, timestamp_field) >= since)
+    if until:
+        query = query.where(getattr(mymodel, timestamp_field) < until)
+    if before_id is not None:
+        query = query.where(id_column < before_id)
+    # 1件多く取得して、次のページがあるかを判定する
+    query = query.order_by(id_column.desc()).limit(page_size + 1)
+    with SessionLocal() as session:
+        rows = [_to_dict(row) for row in session.execute(query).scalars()]
+    next_before_id = rows[page_size - 1][id_field] if len(rows) > page_size else None
+    return rows[:page_size], next_before_id
+
+
+def count_rows(mymodel, filters: dict = None) -> int:
+    ensure_schema()
+    query = select(func.count()).select_from(mymodel)
+    for field, value in (filters or {}).items():
+        query = query.where(getattr(mymodel, field) == value)
+    with SessionLocal() as session:
+        return session.execute(query).scalar_one()
+
+
+def myupdate(mymodel, key_field: str, values: dict):
     key_value = values.pop(key_field)
     try:
-        with session.begin():
+        with session_scope() as session:
             query = update(mymodel).where(getattr(mymodel, key_field) == key_value).values(**values)
             session.execute(query)
     except Exception as e:
         print("更新エラー:", e)
-        session.rollback()
-    finally:
-        session.close()
     return "updated"
 
+
 def mydelete(mymodel, customer_id):
-    # session構築
-    Session = sessionmaker(bind=engine)
-    session = Session()
     query = delete(mymodel).where(mymodel.customer_id==customer_id)
     try:
-        # トランザクションを開始
-        with session.begin():
-            result = session.execute(query)
+        # トランザクションを開始して削除
+        with session_scope() as session:
+            session.execute(query)
     except sqlalchemy.exc.IntegrityError:
         print("一意制約違反により、挿入に失敗しました")
-        session.rollback()
- 
-    # セッションを閉じる
-    session.close()
-    return customer_id + " is deleted"
\ No newline at end of file
+    return customer_id + " is deleted"
@@ -9,10 +9,11 @@ class Base(DeclarativeBase):
 class ChangeTitle(Base):
     __tablename__ = 'ChangeTitle'
     LogID: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    OperationTimestamp: Mapped[str] = mapped_column()
+    # 期間指定・品目名での履歴検索用に索引を張る
+    OperationTimestamp: Mapped[str] = mapped_column(index=True)
     TargetRecordID: Mapped[str] = mapped_column()
     Old_ItemName: Mapped[str] = mapped_column()
-    New_ItemName: Mapped[str] = mapped_column()
+    New_ItemName: Mapped[str] = mapped_column(index=True)
     Old_Amount: Mapped[float] = mapped_column()
     New_Amount: Mapped[float] = mapped_column()
     Old_AccountTitle: Mapped[str] = mapped_column()
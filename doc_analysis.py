@@ -0,0 +1,172 @@
+import os
+import io
+import json
+import time
+import hashlib
+from dotenv import load_dotenv
+
+from lazy_import import lazy_object
+from tracing import span
+
+# .envから環境変数を読み込む
+load_dotenv()
+
+DOC_ANALYSIS_CACHE_DIR = os.getenv("DOC_ANALYSIS_CACHE_DIR", "cache/doc_analysis")
+# 有効期限（最後に使ってからの秒数, デフォルト30日）と合計サイズ上限（デフォルト200MB）
+DOC_ANALYSIS_CACHE_TTL = int(os.getenv("DOC_ANALYSIS_CACHE_TTL", str(30 * 24 * 3600)))
+DOC_ANALYSIS_CACHE_MAX_BYTES = int(os.getenv("DOC_ANALYSIS_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+DEFAULT_MODEL_ID = "prebuilt-layout"
+
+# Azure SDK は実際に解析・キャッシュ復元するときに読み込む
+AzureKeyCredential = lazy_object("azure.core.credentials", "AzureKeyCredential")
+DocumentIntelligenceClient = lazy_object("azure.ai.documentintelligence", "DocumentIntelligenceClient")
+AnalyzeResult = lazy_object("azure.ai.documentintelligence.models", "AnalyzeResult")
+
+
+# --- 構造を持ったテキストとしてparagraphsとtablesを統合 ---
+def extract_structured_text(result):
+    texts = []
+
+    # テーブル情報をMarkdown形式で抽出
+    tables = getattr(result, "tables", None) or []
+    for table in tables:
+        nrows = table.row_count
+        ncols = table.column_count
+        cells = [["" for _ in range(ncols)] for _ in range(nrows)]
+        for cell in table.cells:
+            r, c = cell.row_index, cell.column_index
+            cells[r][c] = cell.content
+        # Markdownテーブル形式
+        if nrows > 0 and ncols > 0:
+            header = "| " + " | ".join(cells[0]) + " |"
+            sep = "| " + " | ".join(["---"] * ncols) + " |"
+            body = "\n".join(["| " + " | ".join(row) + " |" for row in cells[1:]])
+            table_md = "\n".join([header, sep, body])
+            texts.append(table_md)
+
+    # 段落情報を階層付きで抽出
+    paragraphs = getattr(result, "paragraphs", None) or []
+    for para in paragraphs:
+        # heading_levelがあれば見出しとして出力
+        heading_level = getattr(para, "role", None)
+        if heading_level and hasattr(para, "content"):
+            texts.append(f"## {para.content}")
+        else:
+            texts.append(para.content)
+
+    return "\n\n".join(texts)
+
+
+def cache_key(file_bytes: bytes, model_id: str = DEFAULT_MODEL_ID) -> str:
+    """
+    ファイル内容のSHA-256とモデルIDからキャッシュキーを作る
+    """
+    return f"{hashlib.sha256(file_bytes).hexdigest()}-{model_id}"
+
+
+def _cache_path(key: str, cache_dir: str) -> str:
+    return os.path.join(cache_dir, f"{key}.json")
+
+
+def load_cached_analysis(key: str, cache_dir: str = DOC_ANALYSIS_CACHE_DIR, ttl: int = DOC_ANALYSIS_CACHE_TTL) -> dict | None:
+    """
+    有効期限内のキャッシュがあれば {"text", "result", "created_at"} を返す
+    有効期限はファイルの更新時刻（最終利用時刻）から数える（prune_analysis_cache と同じ基準）
+    """
+    path = _cache_path(key, cache_dir)
+    try:
+        if time.time() - os.stat(path).st_mtime > ttl:
+            os.remove(path)
+            return None
+        with open(path, encoding="utf-8") as f:
+            entry = json.load(f)
+        # 最終利用時刻として更新（期限切れ・サイズ超過時の削除はこの時刻で判定する）
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    return entry
+
+
+def save_cached_analysis(key: str, result_dict: dict, text: str, cache_dir: str = DOC_ANALYSIS_CACHE_DIR) -> None:
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _cache_path(key, cache_dir)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"created_at": time.time(), "text": text, "result": result_dict}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def prune_analysis_cache(
+    cache_dir: str = DOC_ANALYSIS_CACHE_DIR,
+    ttl: int = DOC_ANALYSIS_CACHE_TTL,
+    max_bytes: int = DOC_ANALYSIS_CACHE_MAX_BYTES,
+) -> int:
+    """
+    期限切れ（最後に使ってから ttl 秒以上）のエントリを削除し、合計サイズが上限を超えていれば利用の古い順に削除する
+    削除した件数を返す（他のプロセスが先に削除したファイルは数えない）
+    """
+    if not os.path.isdir(cache_dir):
+        return 0
+    now = time.time()
+    entries = []
+    removed = 0
+    for name in os.listdir(cache_dir):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+            if now - stat.st_mtime > ttl:
+                os.remove(path)
+                removed += 1
+                continue
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        total -= size
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def analyze_document(file_bytes: bytes, model_id: str = DEFAULT_MODEL_ID, use_cache: bool = True) -> tuple:
+    """
+    Azure Document Intelligenceで証憑を解析し、(構造化テキスト, 解析結果) を返す
+    同じファイル内容・モデルの解析結果はディスクキャッシュから即座に返す
+    （ファイルはメモリから直接送信するため、一時ファイルは作らない）
+    """
+    with span("ocr", model_id=model_id, bytes=len(file_bytes)) as attrs:
+        key = cache_key(file_bytes, model_id)
+        attrs["cache_hit"] = False
+        if use_cache:
+            entry = load_cached_analysis(key)
+            if entry is not None:
+                attrs["cache_hit"] = True
+                print(f"Document Intelligence: キャッシュを使用しました（{key[:12]}）")
+                return entry["text"], AnalyzeResult(entry["result"])
+
+        # Azure Document Intelligenceクライアント作成
+        client = DocumentIntelligenceClient(
+            endpoint=os.getenv("DOC_ENDPOINT"),
+            credential=AzureKeyCredential(os.getenv("DOC_API_KEY"))
+        )
+        poller = client.begin_analyze_document(
+            model_id,
+            io.BytesIO(file_bytes),
+            output_content_format="markdown",
+            content_type="application/octet-stream",
+        )
+        result = poller.result()
+        text = extract_structured_text(result)
+
+        if use_cache:
+            save_cached_analysis(key, result.as_dict(), text)
+            prune_analysis_cache()
+        return text, result
@@ -0,0 +1,171 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from tracing import span
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "cache/embeddings.sqlite3")
+# 上限を超えたら最終アクセスの古いものから削除する（デフォルト512MB）
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+
+def normalize_for_key(text: str) -> str:
+    """
+    キャッシュキー用にテキストを正規化する（NFKC・前後空白除去・連続空白の圧縮）
+    """
+    text = unicodedata.normalize("NFKC", text or "")
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    任意の Embeddings 実装をラップし、埋め込みベクトルをディスク（SQLite）にキャッシュする
+    キーは (モデル名, デプロイメント名, 用途(document/query), 正規化テキストのSHA-256)
+    """
+
+    def __init__(
+        self,
+        underlying: Embeddings,
+        path: str = EMBEDDING_CACHE_PATH,
+        max_bytes: int = EMBEDDING_CACHE_MAX_BYTES,
+        dtype: str = "float32",
+    ):
+        if dtype not in ("float32", "float16"):
+            raise ValueError("dtype は float32 または float16 を指定してください。")
+        self.underlying = underlying
+        self.path = path
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self.model = str(getattr(underlying, "model", "") or getattr(underlying, "model_name", "") or "")
+        # 出力次元数を削減した埋め込みは別のキーにする
+        dimensions = getattr(underlying, "dimensions", None)
+        if isinstance(dimensions, int):
+            self.model += f"@{dimensions}"
+        self.deployment = str(
+            getattr(underlying, "azure_deployment", "") or getattr(underlying, "deployment", "") or ""
+        )
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY, dtype TEXT NOT NULL, dim INTEGER NOT NULL,"
+            " vector BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings(last_access)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    def _key(self, kind: str, text: str) -> str:
+        digest = hashlib.sha256(normalize_for_key(text).encode("utf-8")).hexdigest()
+        return f"{self.model}|{self.deployment}|{kind}|{digest}"
+
+    def _lookup(self, keys: list) -> dict:
+        found = {}
+        unique = list(dict.fromkeys(keys))
+        now = time.time()
+        with self._lock:
+            # SQLiteの変数上限を避けるため分割して問い合わせる
+            for start in range(0, len(unique), 500):
+                batch = unique[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, dtype, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, dtype, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=dtype).astype(np.float32).tolist()
+                if rows:
+                    self._conn.executemany(
+                        "UPDATE embeddings SET last_access = ? WHERE key = ?", [(now, r[0]) for r in rows]
+                    )
+            self._conn.commit()
+        return found
+
+    def _store(self, items: list) -> None:
+        now = time.time()
+        rows = []
+        for key, vector in items:
+            blob = np.asarray(vector, dtype=self.dtype).tobytes()
+            rows.append((key, self.dtype.name, len(vector), blob, len(blob), now))
+        with self._lock:
+            for row in rows:
+                old = self._conn.execute("SELECT size FROM embeddings WHERE key = ?", (row[0],)).fetchone()
+                self._total_bytes -= old[0] if old else 0
+                self._total_bytes += row[4]
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        # LRU: 最終アクセスが古い順に上限を下回るまで削除する
+        while self._total_bytes > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM embeddings ORDER BY last_access LIMIT 256"
+            ).fetchall()
+            if not rows:
+                self._total_bytes = 0
+                break
+            for key, size in rows:
+                if self._total_bytes <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                self._total_bytes -= size
+
+    def _embed(self, kind: str, texts: list, embed_func) -> list:
+        with span("embedding", kind=kind, texts=len(texts)) as attrs:
+            keys = [self._key(kind, t) for t in texts]
+            found = self._lookup(keys)
+            # 未キャッシュのテキストだけを（重複を除いて）埋め込む
+            missing = {}
+            for key, text in zip(keys, texts):
+                if key not in found and key not in missing:
+                    missing[key] = text
+            misses = sum(1 for k in keys if k in missing)
+            with self._lock:
+                self.hits += len(texts) - misses
+                self.misses += misses
+            attrs["cache_hit"] = not missing
+            attrs["cache_misses"] = misses
+            if missing:
+                vectors = embed_func(list(missing.values()))
+                new_items = list(zip(missing.keys(), vectors))
+                self._store(new_items)
+                found.update({k: list(v) for k, v in new_items})
+            return [found[k] for k in keys]
+
+    def embed_documents(self, texts: list) -> list:
+        return self._embed("document", texts, self.underlying.embed_documents)
+
+    def embed_query(self, text: str) -> list:
+        return self._embed("query", [text], lambda t: [self.underlying.embed_query(t[0])])[0]
+
+    def embed_queries(self, texts: list) -> list:
+        """
+        複数の検索クエリを（未キャッシュ分だけ）1回のリクエストでまとめて埋め込む
+        """
+        return self._embed("query", texts, self.underlying.embed_documents)
+
+    def stats(self) -> dict:
+        """
+        ヒット/ミス件数とキャッシュサイズ
+        """
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "bytes": self._total_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
@@ -1,51 +1,67 @@
 import os
-from collect_law_texts import collect_law_texts_list
-import openai
+import asyncio
+from lifetime_index import load_lifetime_index, index_from_law_list, split_items
+from llm_client import chat_completion, chat_completion_async
+from prompt_budget import PromptBudget, PromptSection
+from tracing import span, set_attrs
 from dotenv import load_dotenv
 
 # .envから環境変数を読み込む
 load_dotenv()
 
-def extract_lifetime_info_azure(input_text: str, law_list: list) -> str:
-    """
-    INPUT_TEXT（見積書等）とxmlファイル群の内容をAzure OpenAIに渡し、該当する耐用年数情報を抽出する
-    必要な環境変数:
-      AZURE_OPENAI_API_KEY
-      AZURE_OPENAI_ENDPOINT
-      AZURE_OPENAI_DEPLOYMENT（デプロイメント名）
-      AZURE_OPENAI_API_VERSION（例: 2024-02-15-preview など）
+SYSTEM_PROMPT = "あなたは減価償却資産の法定耐用年数に詳しいAIです。"
+
+
+def build_lifetime_prompt(input_text: str, law_list: list = None, top_k: int = 5) -> tuple:
     """
-    api_key = os.environ.get("AZURE_OPENAI_API_KEY")
-    azure_endpoint = os.environ.get("AZURE_OPENAI_ENDPOINT")
-    deployment = os.environ.get("AZURE_OPENAI_DEPLOYMENT")
-    api_version = os.environ.get("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
+    INPUT_TEXT（見積書等）の各品目について、耐用年数表インデックスから候補行を検索する
+    品目名が細目と完全一致し耐用年数が一意に決まる品目はそのまま回答を作り、
+    残りの品目については候補だけを載せたプロンプトを作る
 
-    if not (api_key and azure_endpoint and deployment):
-        raise ValueError("AZURE_OPENAI_API_KEY, AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_DEPLOYMENT を環境変数で指定してください。")
+    law_list を渡した場合はその内容からインデックスを作る（省略時は document/ の保存済みインデックス）
+
+    Returns:
+        tuple: (完全一致した品目の回答リスト, LLMへのプロンプト（不要ならNone）)
+    """
+    index = index_from_law_list(law_list) if law_list is not None else load_lifetime_index("document")
 
-    client = openai.AzureOpenAI(
-        api_key=api_key,
-        api_version=api_version,
-        azure_endpoint=azure_endpoint,
-    )
+    # 品目ごとに完全一致 → そのまま回答、それ以外 → 候補行をLLMへ
+    exact_results = []
+    candidate_texts = ""
+    unresolved = []
+    for item in split_items(input_text):
+        record = index.exact_match(item)
+        if record is not None:
+            exact_results.append(
+                f"品目名: {item}\n分類: {record.label()}\n細目: {record.detail_label()}\n耐用年数: {record.years}年"
+            )
+            continue
+        unresolved.append(item)
+        candidate_texts += f"【{item} の候補】\n"
+        candidate_texts += "\n".join(r.to_prompt_line() for r in index.search(item, k=top_k)) + "\n\n"
 
-    # すべてのxmlファイルの内容を1つのテキストにまとめる
-    law_texts = ""
-    for item in law_list:
-        law_texts += f"【{item['ファイル名']}】\n{item['内容']}\n\n"
+    set_attrs(exact_matches=len(exact_results), llm_items=len(unresolved), cache_hit=not unresolved)
+    if not unresolved:
+        return exact_results, None
 
+    budget = PromptBudget("extract_lifetime")
+    sections = budget.fit([
+        PromptSection("items_text", "\n".join(unresolved), priority=10, max_tokens=2000),
+        PromptSection("candidate_texts", candidate_texts, priority=5, max_tokens=6000),
+    ])
+    items_text = sections["items_text"]
+    candidate_texts = sections["candidate_texts"]
     prompt = f"""
 あなたは日本の減価償却資産の法定耐用年数に詳しいAIです。
-以下は法定耐用年数に関する法令xmlファイルの全文です。
-
-{law_texts}
+以下は法定耐用年数に関する法令xml（別表）から、各品目に近い行を抜き出した候補一覧です。
 
+{candidate_texts}
 --- ここからINPUT_TEXT ---
-{input_text}
+{items_text}
 --- ここまでINPUT_TEXT ---
 
 【タスク】
-- INPUT_TEXTに記載された各品目について、最も該当する資産分類・細目・耐用年数をxml群から探し、以下の形式で出力してください。
+- INPUT_TEXTに記載された各品目について、最も該当する資産分類・細目・耐用年数を候補一覧から選び、以下の形式で出力してください。
 
 【出力例】
 品目名: ○○○
@@ -54,22 +70,73 @@ def extract_lifetime_info_azure(input_text: str, law_list: list) -> str:
 耐用年数: ○○年
 
 - 必ず全品目について出力してください。
-- xmlに該当がなければ「該当なし」と記載してください。
+- 候補に該当がなければ「該当なし」と記載してください。
 """
+    budget.finalize(prompt)
+    print(f"耐用年数の判定: 完全一致 {len(exact_results)}件 / LLM {len(unresolved)}件")
+    return exact_results, prompt
+
+
+def _require_azure_settings() -> str:
+    deployment = os.environ.get("AZURE_OPENAI_DEPLOYMENT")
+    if not (os.environ.get("AZURE_OPENAI_API_KEY") and os.environ.get("AZURE_OPENAI_ENDPOINT") and deployment):
+        raise ValueError("AZURE_OPENAI_API_KEY, AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_DEPLOYMENT を環境変数で指定してください。")
+    return deployment
+
+
+def extract_lifetime_info_azure(input_text: str, law_list: list = None, top_k: int = 5) -> str:
+    """
+    INPUT_TEXT（見積書等）の各品目について、耐用年数表インデックスから候補行を検索し、
+    候補だけをAzure OpenAIに渡して該当する耐用年数情報を抽出する
+    （品目名が細目と完全一致し耐用年数が一意に決まる品目はLLMを使わない）
+
+    必要な環境変数:
+      AZURE_OPENAI_API_KEY
+      AZURE_OPENAI_ENDPOINT
+      AZURE_OPENAI_DEPLOYMENT（デプロイメント名）
+      AZURE_OPENAI_API_VERSION（例: 2024-02-15-preview など）
+    """
+    with span("lifetime_extraction"):
+        exact_results, prompt = build_lifetime_prompt(input_text, law_list, top_k)
+        if prompt is None:
+            return "\n\n".join(exact_results)
+
+        deployment = _require_azure_settings()
+
+        response = chat_completion(
+            model=deployment,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.2,
+            max_tokens=2048
+        )
+    return "\n\n".join(exact_results + [response.choices[0].message.content])
+
+
+async def extract_lifetime_info_azure_async(input_text: str, law_list: list = None, top_k: int = 5) -> str:
+    """
+    extract_lifetime_info_azure の非同期版（共有の AsyncAzureOpenAI クライアントを使う）
+    """
+    with span("lifetime_extraction"):
+        exact_results, prompt = await asyncio.to_thread(build_lifetime_prompt, input_text, law_list, top_k)
+        if prompt is None:
+            return "\n\n".join(exact_results)
 
-    response = client.chat.completions.create(
-        model=deployment,
-        messages=[
-            {"role": "system", "content": "あなたは減価償却資産の法定耐用年数に詳しいAIです。"},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0.2,
-        max_tokens=2048
-    )
-    return response.choices[0].message.content
+        deployment = _require_azure_settings()
+        response = await chat_completion_async(
+            model=deployment,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.2,
+            max_tokens=2048
+        )
+    return "\n\n".join(exact_results + [response.choices[0].message.content])
 
 if __name__ == "__main__":
-    law_list = collect_law_texts_list("document")
     input_text = "エアコン\nパソコン\n木造住宅"
-    result = extract_lifetime_info_azure(input_text, law_list)
+    result = extract_lifetime_info_azure(input_text)
     print(result)
@@ -1,13 +1,190 @@
 import os
+import json
+import time
+import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 # from dotenv import load_dotenv
-from langchain_community.document_loaders import DirectoryLoader, UnstructuredFileLoader
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.embeddings.huggingface import HuggingFaceEmbeddings
-# from langchain_community.embeddings.azure_openai import AzureOpenAIEmbeddings # 廃止予定
-from langchain_openai import AzureOpenAIEmbeddings  # ← import 元を変更
-from langchain_community.vectorstores.faiss import FAISS
-import streamlit as st
+import numpy as np
+from lazy_import import lazy_object
+from retrieval_service import create_staging_dir, publish_index_dir, read_version_stamp, write_version_stamp
+from hybrid_retrieval import BM25_FILE, BM25Index, save_bm25_index
+from vector_index import (
+    DEFAULT_TRAIN_SIZE, INDEX_TYPES, build_trained_index, read_index_meta, resolve_params, supports_remove,
+    write_index_meta,
+)
+from embedding_cache import CachedEmbeddings
+
+# langchain は読み込みに時間がかかるため、実際にインデックスを作るときに読み込む
+# （ファイルの読み込み・分割用のクラスはプロセスプールのワーカー内でだけ読み込む）
+AzureOpenAIEmbeddings = lazy_object("langchain_openai", "AzureOpenAIEmbeddings")
+FAISS = lazy_object("langchain_community.vectorstores.faiss", "FAISS")
+InMemoryDocstore = lazy_object("langchain_community.docstore.in_memory", "InMemoryDocstore")
+
+# 元ファイルのハッシュとチャンクIDの対応を記録するマニフェスト（storage_dir内）
+MANIFEST_FILE = "manifest.json"
+# 2: チャンクIDに相対パスを含めた（版が違うマニフェストは使わず全件作り直す）
+MANIFEST_VERSION = 2
+# インデックスの種類（flat / hnsw / sq8 / ivfpq）と、埋め込みの次元数（text-embedding-3 系で削減する場合）
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "flat")
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "0")) or None
+
+
+def file_sha256(path: str) -> str:
+    """
+    ファイル内容のSHA-256を返す
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def scan_source_files(data_path: str) -> dict:
+    """
+    data_path 以下のファイルを再帰的に列挙し、{相対パス: SHA-256} を返す
+    """
+    hashes = {}
+    for root, dirs, files in os.walk(data_path):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in sorted(files):
+            if name.startswith("."):
+                continue
+            path = os.path.join(root, name)
+            hashes[os.path.relpath(path, data_path)] = file_sha256(path)
+    return hashes
+
+
+def load_manifest(index_path: str) -> dict | None:
+    path = os.path.join(index_path, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"マニフェストの読み込みに失敗しました（全件再作成します）: {e}")
+        return None
+
+
+def save_manifest(index_path: str, manifest: dict) -> None:
+    path = os.path.join(index_path, MANIFEST_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_and_split_file(path: str, chunk_size: int, chunk_overlap: int) -> list:
+    """
+    1ファイルを読み込み、チャンクに分割して返す（プロセスプールのワーカーで実行）
+    """
+    from langchain_community.document_loaders import UnstructuredFileLoader
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    documents = UnstructuredFileLoader(path).load()
+    return splitter.split_documents(documents)
+
+
+class BuildProgress:
+    """
+    ステージごと（parse: ファイル, chunk: チャンク, embed: 埋め込み）の進捗とスループットを集計・表示する
+    on_progress を渡すと、更新のたびに snapshot() の内容で呼び出す
+    """
+
+    UNITS = {"parse": "files", "chunk": "chunks", "embed": "embeddings"}
+
+    def __init__(self, total_files: int = 0, on_progress=None, interval: float = 2.0):
+        self.started = time.perf_counter()
+        self.total_files = total_files
+        self.counts = {stage: 0 for stage in self.UNITS}
+        self.on_progress = on_progress
+        self.interval = interval
+        self._last_report = 0.0
+
+    def update(self, stage: str, n: int = 1) -> None:
+        self.counts[stage] += n
+        if self.on_progress:
+            self.on_progress(self.snapshot())
+        now = time.perf_counter()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self.report()
+
+    def snapshot(self) -> dict:
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        return {
+            "elapsed_seconds": elapsed,
+            "total_files": self.total_files,
+            **{f"{stage}_count": count for stage, count in self.counts.items()},
+            **{f"{self.UNITS[stage]}_per_second": count / elapsed for stage, count in self.counts.items()},
+        }
+
+    def report(self) -> None:
+        snap = self.snapshot()
+        print(
+            f"[{snap['elapsed_seconds']:.1f}s] "
+            f"parse {snap['parse_count']}/{self.total_files} files ({snap['files_per_second']:.2f} files/s) | "
+            f"chunk {snap['chunk_count']} ({snap['chunks_per_second']:.1f} chunks/s) | "
+            f"embed {snap['embed_count']} ({snap['embeddings_per_second']:.1f} embeddings/s)",
+            flush=True,
+        )
+
+
+def iter_parsed_files(data_path: str, rel_paths: list, chunk_size: int, chunk_overlap: int, workers: int):
+    """
+    ファイルをプロセスプールで並列に解析し、(相対パス, チャンクリスト) を完了順に返すジェネレータ
+    同時に処理中のファイルは workers * 2 件までに抑える
+    """
+    if workers <= 1:
+        for rel_path in rel_paths:
+            yield rel_path, load_and_split_file(os.path.join(data_path, rel_path), chunk_size, chunk_overlap)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        queue = iter(rel_paths)
+        for rel_path in queue:
+            path = os.path.join(data_path, rel_path)
+            pending[pool.submit(load_and_split_file, path, chunk_size, chunk_overlap)] = rel_path
+            if len(pending) >= workers * 2:
+                break
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                rel_path = pending.pop(future)
+                yield rel_path, future.result()
+                next_path = next(queue, None)
+                if next_path is not None:
+                    path = os.path.join(data_path, next_path)
+                    pending[pool.submit(load_and_split_file, path, chunk_size, chunk_overlap)] = next_path
+
+
+def iter_chunk_batches(parsed_files, current_hashes: dict, manifest_files: dict, batch_size: int, progress: BuildProgress):
+    """
+    解析済みファイルからチャンクを取り出し、batch_size 件ずつ (ids, documents) を返すジェネレータ
+    各ファイルのチャンクIDはマニフェストに記録する
+    """
+    ids, documents = [], []
+    for rel_path, split_texts in parsed_files:
+        progress.update("parse")
+        sha256 = current_hashes[rel_path]
+        # 内容が同じ別ファイルでIDが重ならないよう、相対パスと内容のハッシュから作る
+        file_key = hashlib.sha256((rel_path + sha256).encode("utf-8")).hexdigest()[:16]
+        file_ids = [f"{file_key}-{i}" for i in range(len(split_texts))]
+        manifest_files[rel_path] = {"sha256": sha256, "ids": file_ids}
+        for chunk_id, doc in zip(file_ids, split_texts):
+            ids.append(chunk_id)
+            documents.append(doc)
+            progress.update("chunk")
+            if len(documents) >= batch_size:
+                yield ids, documents
+                ids, documents = [], []
+    if documents:
+        yield ids, documents
+
 
 def build_faiss_index(
     # filename: str = "ey-japan-info-sensor-2023-06-03.pdf",
@@ -16,9 +193,22 @@ def build_faiss_index(
     model_name: str = "intfloat/multilingual-e5-large",
     chunk_size: int = 1000,
     chunk_overlap: int = 200,
+    full_rebuild: bool = False,
+    workers: int = None,
+    embed_batch_size: int = 256,
+    embed_concurrency: int = 4,
+    on_progress=None,
+    index_type: str = None,
+    embedding_dimensions: int = None,
+    index_params: dict = None,
+    train_size: int = DEFAULT_TRAIN_SIZE,
 ) -> FAISS:
     """
-    指定されたPDFファイルを読み込み、FAISSインデックスを作成・保存して返す関数
+    指定ディレクトリのファイルからFAISSインデックスを作成・保存して返す関数
+    マニフェストに記録したファイルハッシュと比較し、追加・変更されたファイルだけを埋め込み、
+    削除・変更されたファイルのベクトルはチャンクIDで削除する（差分更新）
+    ファイル解析はプロセスプールで並列に行い、チャンクはバッチ単位で埋め込んでインデックスへ追加するため、
+    コーパス全体をメモリに載せることはない
 
     Parameters:
     - data_dir: str : ファイル格納ディレクトリ（デフォルト: "document"）
@@ -26,6 +216,15 @@ def build_faiss_index(
     - model_name: str : 埋め込みモデル名（デフォルト: multilingual-e5-large）
     - chunk_size: int : テキスト分割チャンクサイズ
     - chunk_overlap: int : チャンクの重なり
+    - full_rebuild: bool : Trueの場合はマニフェストを無視して全件作り直す
+    - workers: int : ファイル解析のプロセス数（デフォルト: CPUコア数）
+    - embed_batch_size: int : 1回の埋め込みリクエストに含めるチャンク数
+    - embed_concurrency: int : 同時に実行する埋め込みリクエスト数の上限
+    - on_progress: callable : 進捗（BuildProgress.snapshot()）を受け取るコールバック
+    - index_type: str : flat / hnsw / sq8 / ivfpq（デフォルト: 環境変数 FAISS_INDEX_TYPE または flat）
+    - embedding_dimensions: int : 埋め込みの出力次元数（text-embedding-3 系のみ。デフォルト: 環境変数 EMBEDDING_DIMENSIONS）
+    - index_params: dict : インデックスのパラメータ（nlist, pq_m, nprobe, hnsw_m, ef_search など）
+    - train_size: int : sq8 / ivfpq の学習に使うベクトル数の上限（先頭から集めたバッチのうちランダムに選ぶ）
 
     Returns:
     - FAISS : 作成されたFAISSインデックスオブジェクト
@@ -41,46 +240,186 @@ def build_faiss_index(
     print(f"ファイル読み込み: {data_path}")
     os.makedirs(index_path, exist_ok=True)
 
-    # 1. ドキュメント読み込み
-    loader = DirectoryLoader(data_path, loader_cls=UnstructuredFileLoader)
-    documents = loader.load()
-    print(f"ドキュメント数: {len(documents)}")
+    index_type = index_type or FAISS_INDEX_TYPE
+    index_params = resolve_params(index_type, index_params)
+    embedding_dimensions = embedding_dimensions or EMBEDDING_DIMENSIONS
 
-    # 2. テキスト分割
-    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-    split_texts = splitter.split_documents(documents)
-    print(f"チャンク数: {len(split_texts)}")
-
-    for i, doc in enumerate(split_texts[:5], 1):
-        print(f"\n----- チャンク {i} -----")
-        # print(doc.page_content)        # 全文
-        print(doc.page_content[:300])  # 300 文字だけ見たい場合
-
-    # 3. 埋め込みモデル読み込み（Azure OpenAI埋め込みに変更）
-    embedding_model = AzureOpenAIEmbeddings(
-        azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
-        azure_deployment=os.environ["AZURE_OPENAI_EMBEDDING_DEPLOYMENT"],
-        api_key=os.environ["AZURE_OPENAI_API_KEY"],
-        chunk_size = 2048,
+    # 1. 埋め込みモデル読み込み（Azure OpenAI埋め込みに変更）
+    # 同じチャンクの再埋め込みを避けるため、ディスクキャッシュでラップする
+    embedding_model = CachedEmbeddings(
+        AzureOpenAIEmbeddings(
+            azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
+            azure_deployment=os.environ["AZURE_OPENAI_EMBEDDING_DEPLOYMENT"],
+            api_key=os.environ["AZURE_OPENAI_API_KEY"],
+            chunk_size = 2048,
+            **({"dimensions": embedding_dimensions} if embedding_dimensions else {}),
+        )
     )
-    print("埋め込みモデル読み込み OK")
+    print(f"埋め込みモデル読み込み OK（インデックス: {index_type}, 次元数: {embedding_dimensions or '既定'}）")
+
+    # 2. マニフェストと現在のファイルを比較（インデックスの種類・次元数が変わった場合は全件作り直す）
+    settings = {
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "embedding_deployment": os.environ["AZURE_OPENAI_EMBEDDING_DEPLOYMENT"],
+        "embedding_dimensions": embedding_dimensions,
+        "index_type": index_type,
+        "index_params": index_params,
+    }
+    current_hashes = scan_source_files(data_path)
+    manifest = None if full_rebuild else load_manifest(index_path)
+    index = None
+    if manifest and manifest.get("version") == MANIFEST_VERSION and manifest.get("settings") == settings:
+        try:
+            index = FAISS.load_local(
+                folder_path=index_path,
+                embeddings=embedding_model,
+                allow_dangerous_deserialization=True
+            )
+        except Exception as e:
+            print(f"既存インデックスを読み込めないため全件再作成します: {e}")
+            index = None
+    # 実際に作成されたインデックスの種類（学習用のベクトルが足りない場合は flat になる）
+    meta = read_index_meta(index_path) if index is not None else {}
+    used_type, used_params = meta.get("index_type", "flat"), meta.get("params", {})
+
+    def changes(files: dict) -> tuple:
+        added = [p for p in current_hashes if p not in files]
+        changed = [p for p in current_hashes if p in files and files[p]["sha256"] != current_hashes[p]]
+        removed = [p for p in files if p not in current_hashes]
+        return added, changed, removed
+
+    added, changed, removed = changes(manifest["files"]) if index is not None else ([], [], [])
+    if index is not None and (changed or removed) and not supports_remove(used_type):
+        # HNSWはベクトルを削除できないため作り直す（埋め込みはキャッシュから取り出すのでAPIは呼ばない）
+        print(f"{used_type} インデックスはベクトルを削除できないため、全件作り直します")
+        index = None
+    if index is None:
+        manifest = {"version": MANIFEST_VERSION, "settings": settings, "files": {}}
 
-    # 4. FAISSインデックス作成
-    index = FAISS.from_documents(documents=split_texts, embedding=embedding_model)
-    print("FAISSインデックス作成完了")
+    old_files = manifest["files"]
+    added, changed, removed = changes(old_files)
+    print(f"ファイル数: {len(current_hashes)}（追加 {len(added)} / 変更 {len(changed)} / 削除 {len(removed)}）")
 
-    # 5. 保存
+    # 3. 削除・変更されたファイルのベクトルを削除
+    stale_ids = [i for p in removed + changed for i in old_files[p]["ids"]]
+    if index is not None and stale_ids:
+        index.delete(stale_ids)
+        print(f"削除したチャンク数: {len(stale_ids)}")
+    for p in removed:
+        del old_files[p]
+
+    # 4. 追加・変更されたファイルだけを並列に解析し、バッチごとに埋め込んでインデックスへ追加
+    targets = added + changed
+    progress = BuildProgress(total_files=len(targets), on_progress=on_progress)
+    workers = workers or os.cpu_count() or 1
+    parsed_files = iter_parsed_files(data_path, targets, chunk_size, chunk_overlap, min(workers, max(len(targets), 1)))
+    batches = iter_chunk_batches(parsed_files, current_hashes, old_files, embed_batch_size, progress)
+
+    def embed_batch(ids, documents):
+        vectors = embedding_model.embed_documents([doc.page_content for doc in documents])
+        return ids, documents, vectors
+
+    # 学習が必要なインデックスは、学習用のベクトルが集まるまでバッチを溜めておく
+    pending_batches = []
+
+    def create_index(batches: list) -> None:
+        nonlocal index, used_type, used_params
+        vectors = np.asarray([v for _, _, _, batch_vectors in batches for v in batch_vectors], dtype=np.float32)
+        faiss_index, used_type, used_params = build_trained_index(index_type, vectors, index_params, train_size)
+        index = FAISS(embedding_model, faiss_index, InMemoryDocstore(), {})
+        for ids, text_embeddings, metadatas, _ in batches:
+            index.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+
+    def add_to_index(future):
+        ids, documents, vectors = future.result()
+        text_embeddings = list(zip([doc.page_content for doc in documents], vectors))
+        metadatas = [doc.metadata for doc in documents]
+        if index is None:
+            pending_batches.append((ids, text_embeddings, metadatas, vectors))
+            if index_type == "flat" or sum(len(b[0]) for b in pending_batches) >= train_size:
+                create_index(pending_batches)
+                pending_batches.clear()
+        else:
+            index.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+        progress.update("embed", len(ids))
+
+    with ThreadPoolExecutor(max_workers=embed_concurrency) as embed_pool:
+        in_flight = set()
+        for ids, documents in batches:
+            in_flight.add(embed_pool.submit(embed_batch, ids, documents))
+            # 同時実行中のバッチが上限に達したら、完了分をインデックスへ追加してから次へ進む
+            if len(in_flight) >= embed_concurrency:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    add_to_index(future)
+        for future in as_completed(in_flight):
+            add_to_index(future)
+    if pending_batches:
+        create_index(pending_batches)
+    progress.report()
+    print(f"埋め込みキャッシュ: {embedding_model.stats()}")
+
+    if index is None:
+        raise ValueError(f"インデックス対象のファイルがありません: {data_path}")
+
+    if not (added or changed or removed) and os.path.exists(os.path.join(index_path, "index.faiss")):
+        if not os.path.exists(os.path.join(index_path, BM25_FILE)):
+            save_bm25_index(BM25Index.from_faiss(index), index_path)
+            # バージョンを更新し、BM25を追加した作業用ディレクトリを rebuild_index が公開するようにする（検索側も読み直す）
+            write_version_stamp(index_path)
+            print("BM25インデックスを作成しました")
+        print("変更がないため、インデックスは更新しませんでした")
+        return index
+
+    # 5. 保存（BM25インデックスは差分ではなく、更新後の全チャンクから作り直す）
     index.save_local(folder_path=index_path)
+    save_bm25_index(BM25Index.from_faiss(index), index_path)
+    write_index_meta(index_path, used_type, embedding_dimensions, used_params, index.index)
+    save_manifest(index_path, manifest)
+    # 検索側（retrieval_service）に差し替えを知らせるバージョンスタンプ
+    write_version_stamp(index_path)
     print(f"インデックス保存済み: {index_path}")
 
     return index
 
 
+def rebuild_index(storage_dir: str = "storage", **build_kwargs) -> bool:
+    """
+    検索に使っている版を複製した作業用ディレクトリで build_faiss_index を実行し、更新（BM25の追加のみの場合を含む）があれば検索に使う版を切り替える
+    切り替えはポインタファイルの置き換え1回で行うため、検索側が作成途中や新旧の混ざったファイルを読むことはない
+    版を切り替えた場合 True、変更がなかった場合 False を返す（build_kwargs は build_faiss_index に渡す）
+    """
+    staging_dir = create_staging_dir(storage_dir)
+    try:
+        before = read_version_stamp(staging_dir)
+        build_faiss_index(storage_dir=staging_dir, **build_kwargs)
+        if read_version_stamp(staging_dir) == before:
+            return False
+        publish_index_dir(staging_dir, storage_dir)
+        return True
+    finally:
+        # 切り替えた場合は版のディレクトリに名前が変わっているため、残っているのは使わなかった作業用ディレクトリだけ
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
 import sys
 import traceback
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="document/docs_for_index からFAISSインデックスを作成する")
+    parser.add_argument("--full", action="store_true", help="マニフェストを無視して全件作り直す")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default=None, help="インデックスの種類（デフォルト: FAISS_INDEX_TYPE）")
+    parser.add_argument("--dimensions", type=int, default=None, help="埋め込みの出力次元数（text-embedding-3 系のみ）")
+    parser.add_argument("--nprobe", type=int, default=None, help="ivfpq の検索時に調べるリスト数")
+    args = parser.parse_args()
     try:
-        build_faiss_index()
+        rebuild_index(
+            full_rebuild=args.full,
+            index_type=args.index_type,
+            embedding_dimensions=args.dimensions,
+            index_params={"nprobe": args.nprobe} if args.nprobe else None,
+        )
         print("\n=== 完了 ===")
     except Exception as e:
         print("\n❌ エラーが発生しました:")
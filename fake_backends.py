@@ -0,0 +1,300 @@
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import asyncio
+import threading
+from types import SimpleNamespace
+from dataclasses import dataclass, field
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from prompt_budget import count_tokens
+
+
+@dataclass
+class FakeConfig:
+    """
+    オフライン用の偽バックエンドの設定（遅延は秒）
+    """
+    llm_latency: float = 0.3                # LLM呼び出しごとの固定遅延（最初のトークンまで）
+    llm_seconds_per_token: float = 0.002    # 出力1トークンあたりの遅延
+    embedding_latency: float = 0.05         # 埋め込みリクエストごとの固定遅延
+    embedding_seconds_per_text: float = 0.0005
+    doc_latency: float = 0.8                # Document Intelligence の解析1回あたりの遅延
+    embedding_dim: int = 256
+    jitter: float = 0.1                     # 遅延のばらつき（割合）
+    account_title: str = "工具器具備品"
+    useful_life: str = "4年"
+    canned: dict = field(default_factory=dict)  # プロンプトに含まれるキーワード -> 固定の応答
+
+
+class CallLog:
+    """
+    偽バックエンドへの呼び出し（種類・プロンプト/出力トークン数・遅延）を記録する
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = []
+
+    def add(self, kind: str, **values) -> None:
+        with self._lock:
+            self.calls.append({"kind": kind, **values})
+
+    def drain(self) -> list:
+        with self._lock:
+            calls, self.calls = self.calls, []
+        return calls
+
+
+_config = FakeConfig()
+call_log = CallLog()
+
+
+def _sleep_seconds(base: float) -> float:
+    return max(0.0, base * (1 + random.uniform(-_config.jitter, _config.jitter)))
+
+
+# --- LLM ---
+_ITEM_PATTERN = re.compile(r"品目名[:：]\s*([^\n]+?)\s*\n\s*・?金額[:：]\s*([^\n]*)")
+_TABLE_ROW_PATTERN = re.compile(r"\|\s*([^|\n]+?)\s*\|\s*([\d,]+円)\s*\|")
+
+
+def _section(prompt: str, title: str) -> str:
+    # 「【title】」から次の「【」までを取り出す
+    start = prompt.find(title)
+    if start < 0:
+        return prompt
+    end = prompt.find("【", start + len(title))
+    return prompt[start:end if end >= 0 else None]
+
+
+def _judge_rows(items: list) -> str:
+    blocks = []
+    for name, amount in items:
+        blocks.append(
+            f"品目名: {name}\n・金額：{amount}\n・勘定科目：{_config.account_title}\n"
+            f"・法定耐用年数：{_config.useful_life}\n・根拠：法定耐用年数表より（オフライン応答）\n"
+        )
+    return "\n".join(blocks) or "該当情報なし\n"
+
+
+def fake_completion_text(messages: list) -> str:
+    """
+    プロンプトの種類に応じて、本番と同じ形式の決まった応答を返す
+    """
+    system = " ".join(m["content"] for m in messages if m["role"] == "system")
+    prompt = "\n".join(m["content"] for m in messages if m["role"] != "system")
+    for keyword, text in _config.canned.items():
+        if keyword in prompt:
+            return text
+    if "品目名と金額" in prompt:
+        # asset_extract_items: 証憑テキストの表から品目と金額を取り出す
+        rows = _TABLE_ROW_PATTERN.findall(prompt)
+        return "\n".join(f"品目名: {name}\n金額: {amount}" for name, amount in rows) or "該当情報なし"
+    if "耐用年数に詳しい" in system:
+        items = [line.strip() for line in _section(prompt, "--- ここからINPUT_TEXT ---").splitlines()[1:]
+                 if line.strip() and "INPUT_TEXT" not in line]
+        return "\n\n".join(
+            f"品目名: {item}\n分類: 器具及び備品\n細目: {item}\n耐用年数: {_config.useful_life}" for item in items
+        )
+    if "【編集後データ】" in prompt:
+        return _judge_rows(_ITEM_PATTERN.findall(_section(prompt, "【編集後データ】")))
+    if "【対象となる証憑テキスト】" in prompt:
+        document = _section(prompt, "【対象となる証憑テキスト】")
+        items = _ITEM_PATTERN.findall(document)
+        if not items:
+            lines = [line.split(",") for line in document.splitlines()[1:] if "," in line]
+            items = [(cols[0].strip(), cols[1].strip()) for cols in lines if cols[0].strip() != "品目名"]
+        return _judge_rows(items)
+    if "要約" in prompt:
+        return "- これまでの会話の要約（オフライン応答）"
+    return "オフライン応答です。" * 20
+
+
+def _fake_response(text: str, prompt_tokens: int):
+    completion_tokens = count_tokens(text)
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=text), finish_reason="stop")],
+        usage=SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens,
+        ),
+    )
+
+
+def _stream_pieces(text: str, size: int = 8) -> list:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def _chunk(content: str):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+
+
+class _FakeCompletions:
+    def create(self, model=None, messages=(), stream=False, **kwargs):
+        text = fake_completion_text(list(messages))
+        prompt_tokens = sum(count_tokens(m.get("content") or "") for m in messages)
+        output_seconds = _sleep_seconds(count_tokens(text) * _config.llm_seconds_per_token)
+        call_log.add("llm", prompt_tokens=prompt_tokens, completion_tokens=count_tokens(text))
+        time.sleep(_sleep_seconds(_config.llm_latency))
+        if not stream:
+            time.sleep(output_seconds)
+            return _fake_response(text, prompt_tokens)
+        pieces = _stream_pieces(text)
+
+        def generate():
+            for piece in pieces:
+                time.sleep(output_seconds / len(pieces))
+                yield _chunk(piece)
+        return generate()
+
+
+class _FakeAsyncCompletions:
+    async def create(self, model=None, messages=(), **kwargs):
+        text = fake_completion_text(list(messages))
+        prompt_tokens = sum(count_tokens(m.get("content") or "") for m in messages)
+        call_log.add("llm", prompt_tokens=prompt_tokens, completion_tokens=count_tokens(text))
+        await asyncio.sleep(
+            _sleep_seconds(_config.llm_latency) + _sleep_seconds(count_tokens(text) * _config.llm_seconds_per_token)
+        )
+        return _fake_response(text, prompt_tokens)
+
+
+class FakeAzureOpenAI:
+    """
+    openai.AzureOpenAI の代わり（chat.completions.create のみ）
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.chat = SimpleNamespace(completions=_FakeCompletions())
+
+
+class FakeAsyncAzureOpenAI:
+    """
+    openai.AsyncAzureOpenAI の代わり（chat.completions.create のみ）
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.chat = SimpleNamespace(completions=_FakeAsyncCompletions())
+
+
+# --- 埋め込み ---
+def fake_embedding(text: str, dim: int) -> list:
+    """
+    文字bigramをハッシュで次元に割り当てた決定的なベクトル（似た文字列ほど近くなる）
+    """
+    vector = np.zeros(dim, dtype=np.float32)
+    text = text or ""
+    for i in range(max(1, len(text) - 1)):
+        digest = hashlib.md5(text[i:i + 2].encode("utf-8")).digest()
+        vector[int.from_bytes(digest[:4], "little") % dim] += 1.0 if digest[4] % 2 else -1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    AzureOpenAIEmbeddings の代わり（同じ引数で作成できる）
+    """
+
+    def __init__(self, *args, azure_deployment: str = "", **kwargs):
+        # 本番の埋め込みキャッシュと混ざらないよう、デプロイメント名を分ける
+        self.azure_deployment = f"fake-{azure_deployment or 'embedding'}"
+        self.model = f"fake-{_config.embedding_dim}"
+
+    def embed_documents(self, texts: list) -> list:
+        call_log.add("embedding", texts=len(texts))
+        time.sleep(_sleep_seconds(_config.embedding_latency + len(texts) * _config.embedding_seconds_per_text))
+        return [fake_embedding(t, _config.embedding_dim) for t in texts]
+
+    def embed_query(self, text: str) -> list:
+        return self.embed_documents([text])[0]
+
+
+# --- Document Intelligence ---
+class _FakeAnalyzeResult(SimpleNamespace):
+    def as_dict(self) -> dict:
+        return json.loads(json.dumps(self, default=lambda o: vars(o)))
+
+
+def fake_analyze_result(file_bytes: bytes):
+    """
+    証憑のバイト列から解析結果を作る
+    UTF-8の「品名,金額」形式のCSVであれば表として扱い、それ以外は固定の見積書を返す
+    """
+    try:
+        lines = [line.split(",") for line in file_bytes.decode("utf-8").splitlines() if "," in line]
+    except UnicodeDecodeError:
+        lines = []
+    rows = [(cols[0].strip(), cols[1].strip()) for cols in lines[1:]] or [
+        ("ノートPC", "165,000円"), ("エアコン", "330,000円"), ("複合機", "550,000円")
+    ]
+    cells = [SimpleNamespace(row_index=0, column_index=0, content="品名"),
+             SimpleNamespace(row_index=0, column_index=1, content="金額")]
+    for i, (name, amount) in enumerate(rows, start=1):
+        amount = amount if amount.endswith("円") else f"{int(amount):,}円"
+        cells.append(SimpleNamespace(row_index=i, column_index=0, content=name))
+        cells.append(SimpleNamespace(row_index=i, column_index=1, content=amount))
+    table = SimpleNamespace(row_count=len(rows) + 1, column_count=2, cells=cells)
+    paragraphs = [SimpleNamespace(content="御見積書", role="title"), SimpleNamespace(content="株式会社サンプル", role=None)]
+    return _FakeAnalyzeResult(tables=[table], paragraphs=paragraphs)
+
+
+class FakeDocumentIntelligenceClient:
+    """
+    azure.ai.documentintelligence.DocumentIntelligenceClient の代わり
+    """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def begin_analyze_document(self, model_id, body, **kwargs):
+        file_bytes = body.read() if hasattr(body, "read") else body
+        call_log.add("document", bytes=len(file_bytes))
+        time.sleep(_sleep_seconds(_config.doc_latency))
+        result = fake_analyze_result(file_bytes)
+        return SimpleNamespace(result=lambda: result)
+
+
+def install(config: FakeConfig = None) -> FakeConfig:
+    """
+    Azure OpenAI・埋め込み・Document Intelligence の呼び出し先を偽バックエンドに差し替える
+    （ベンチマークやオフラインでの動作確認用。環境変数 AZURE_BACKEND=fake でも有効になる）
+    """
+    global _config
+    if config is not None:
+        _config = config
+
+    import llm_client
+    import async_llm
+    import doc_analysis
+    import retrieval_service
+    import faiss_index_builder
+
+    # 共有クライアントを偽物で埋めておく（get_client / get_async_client はそれを返す）
+    llm_client._client = FakeAzureOpenAI()
+    async_llm._client = FakeAsyncAzureOpenAI()
+    retrieval_service.AzureOpenAIEmbeddings = FakeEmbeddings
+    faiss_index_builder.AzureOpenAIEmbeddings = FakeEmbeddings
+    doc_analysis.DocumentIntelligenceClient = FakeDocumentIntelligenceClient
+    for name in ("AZURE_OPENAI_ENDPOINT", "AZURE_OPENAI_API_KEY", "AZURE_OPENAI_DEPLOYMENT",
+                 "AZURE_OPENAI_EMBEDDING_DEPLOYMENT", "DOC_ENDPOINT", "DOC_API_KEY"):
+        os.environ.setdefault(name, "fake")
+    print("偽バックエンドを使用します（Azureには接続しません）")
+    return _config
+
+
+def install_from_env() -> bool:
+    """
+    環境変数 AZURE_BACKEND=fake の場合に偽バックエンドへ差し替える
+    """
+    if os.getenv("AZURE_BACKEND", "").lower() == "fake":
+        install()
+        return True
+    return False
@@ -0,0 +1,223 @@
+import os
+import json
+import math
+import threading
+from collections import Counter, defaultdict
+
+import numpy as np
+from dotenv import load_dotenv
+
+from lifetime_index import normalize_text
+from tracing import span
+
+# .envから環境変数を読み込む
+load_dotenv()
+
+# FAISSインデックスと同じディレクトリに保存する文字bigramのBM25インデックス
+BM25_FILE = "bm25.json"
+BM25_VERSION = 1
+BM25_K1 = 1.5
+BM25_B = 0.75
+# クエリごとに各検索器から取り出す候補数と、Reciprocal Rank Fusion の定数
+HYBRID_FETCH_K = int(os.getenv("HYBRID_FETCH_K", "20"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+# 並べ替えに使うクロスエンコーダー（sentence-transformers のモデル名。未設定なら並べ替えない）
+RERANK_MODEL = os.getenv("RERANK_MODEL", "")
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "20"))
+
+
+def _bigrams(text: str) -> Counter:
+    text = normalize_text(text)
+    return Counter(text[i:i + 2] for i in range(len(text) - 1))
+
+
+class BM25Index:
+    """
+    チャンクの文字bigramによるBM25転置インデックス
+    「器具及び備品」のような会計用語は、埋め込みよりも文字列の一致で拾えることが多い
+    """
+
+    def __init__(self, ids: list, lengths: list, postings: dict):
+        self.ids = ids                  # FAISSのdocstore ID
+        self.lengths = lengths          # チャンクごとのbigram数
+        self.postings = postings        # bigram -> [[チャンク番号, 出現回数], ...]
+        self.avg_length = (sum(lengths) / len(lengths)) if lengths else 0.0
+        total = len(ids)
+        self.idf = {
+            gram: math.log(1 + (total - len(docs) + 0.5) / (len(docs) + 0.5))
+            for gram, docs in postings.items()
+        }
+
+    @classmethod
+    def from_texts(cls, ids: list, texts: list) -> "BM25Index":
+        lengths = []
+        postings = defaultdict(list)
+        for i, text in enumerate(texts):
+            grams = _bigrams(text)
+            lengths.append(sum(grams.values()))
+            for gram, tf in grams.items():
+                postings[gram].append([i, tf])
+        return cls(ids, lengths, dict(postings))
+
+    @classmethod
+    def from_faiss(cls, index) -> "BM25Index":
+        """
+        FAISSインデックスのdocstoreにあるチャンクから作る
+        """
+        ids = [doc_id for _, doc_id in sorted(index.index_to_docstore_id.items())]
+        texts = [index.docstore.search(doc_id).page_content for doc_id in ids]
+        return cls.from_texts(ids, texts)
+
+    def search(self, query: str, k: int = HYBRID_FETCH_K) -> list:
+        """
+        クエリとのBM25スコアが高いチャンクのdocstore IDを最大k件返す
+        """
+        if not self.ids:
+            return []
+        scores = defaultdict(float)
+        for gram in _bigrams(query):
+            idf = self.idf.get(gram)
+            if idf is None:
+                continue
+            for i, tf in self.postings[gram]:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[i] / (self.avg_length or 1.0))
+                scores[i] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+        return [self.ids[i] for i, _ in ranked[:k]]
+
+    def to_dict(self) -> dict:
+        return {"version": BM25_VERSION, "ids": self.ids, "lengths": self.lengths, "postings": self.postings}
+
+
+def save_bm25_index(bm25: BM25Index, storage_dir: str) -> None:
+    path = os.path.join(storage_dir, BM25_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(bm25.to_dict(), f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def load_bm25_index(storage_dir: str, index) -> BM25Index:
+    """
+    保存済みのBM25インデックスを読み込む
+    ないか、FAISSインデックスのチャンクと一致しない場合はdocstoreから作り直す（保存はしない）
+    """
+    path = os.path.join(storage_dir, BM25_FILE)
+    expected = set(index.index_to_docstore_id.values())
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") == BM25_VERSION and set(data["ids"]) == expected:
+            return BM25Index(data["ids"], data["lengths"], data["postings"])
+        print("BM25インデックスがFAISSインデックスと一致しないため作り直します")
+    except FileNotFoundError:
+        print("BM25インデックスがないため、FAISSインデックスのチャンクから作成します")
+    except (OSError, ValueError, KeyError) as e:
+        print(f"BM25インデックスの読み込みに失敗したため作り直します: {e}")
+    return BM25Index.from_faiss(index)
+
+
+def reciprocal_rank_fusion(rankings: list, k: int = RRF_K) -> list:
+    """
+    複数のランキング（IDのリスト）を Reciprocal Rank Fusion で統合し、スコアの高い順のIDを返す
+    """
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] += 1.0 / (k + rank + 1)
+    return [doc_id for doc_id, _ in sorted(scores.items(), key=lambda x: -x[1])]
+
+
+def vector_search(index, embeddings, queries: list, k: int = HYBRID_FETCH_K) -> list:
+    """
+    全クエリを1回のリクエストで埋め込み、FAISSでまとめて検索して、クエリごとのdocstore IDのリストを返す
+    """
+    if index.index.ntotal == 0:
+        return [[] for _ in queries]
+    if hasattr(embeddings, "embed_queries"):
+        vectors = embeddings.embed_queries(queries)
+    else:
+        vectors = [embeddings.embed_query(q) for q in queries]
+    matrix = np.asarray(vectors, dtype=np.float32).reshape(len(queries), -1)
+    if getattr(index, "_normalize_L2", False):
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    _, positions = index.index.search(matrix, min(k, index.index.ntotal))
+    return [
+        [index.index_to_docstore_id[int(p)] for p in row if p >= 0]
+        for row in positions
+    ]
+
+
+class CrossEncoderReranker:
+    """
+    sentence-transformers のクロスエンコーダーで、クエリとチャンクの組をまとめて採点し並べ替える
+    モデルは最初に使うときに1度だけ読み込む
+    """
+
+    def __init__(self, model_name: str = RERANK_MODEL):
+        self.model_name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _get_model(self):
+        with self._lock:
+            if self._model is None:
+                from sentence_transformers import CrossEncoder
+                self._model = CrossEncoder(self.model_name)
+                print(f"クロスエンコーダー読み込み: {self.model_name}")
+        return self._model
+
+    def rerank(self, query: str, documents: list) -> list:
+        if len(documents) <= 1:
+            return documents
+        scores = self._get_model().predict([(query, doc.page_content) for doc in documents])
+        order = sorted(range(len(documents)), key=lambda i: -float(scores[i]))
+        return [documents[i] for i in order]
+
+
+_reranker = None
+_reranker_lock = threading.Lock()
+
+
+def get_reranker() -> CrossEncoderReranker | None:
+    """
+    環境変数 RERANK_MODEL が指定されていれば、プロセス内で共有するクロスエンコーダーを返す
+    """
+    global _reranker
+    if not RERANK_MODEL:
+        return None
+    with _reranker_lock:
+        if _reranker is None:
+            _reranker = CrossEncoderReranker(RERANK_MODEL)
+    return _reranker
+
+
+def hybrid_search(
+    index,
+    bm25: BM25Index,
+    embeddings,
+    query: str,
+    sub_queries: list = (),
+    k: int = 4,
+    fetch_k: int = HYBRID_FETCH_K,
+    reranker: CrossEncoderReranker = None,
+) -> list:
+    """
+    クエリと品目ごとのサブクエリについて、BM25とベクトル検索の結果を Reciprocal Rank Fusion で統合し、
+    上位k件のチャンク（Document）を返す。reranker を渡した場合は統合後の上位候補をクエリで並べ替える
+    """
+    queries = [query] + [q for q in sub_queries if q and q != query]
+    with span("hybrid_search", queries=len(queries), k=k) as attrs:
+        with span("vector_search", queries=len(queries)):
+            rankings = vector_search(index, embeddings, queries, fetch_k)
+        with span("bm25_search", queries=len(queries)):
+            rankings += [bm25.search(q, fetch_k) for q in queries]
+        fused = reciprocal_rank_fusion(rankings)
+        limit = max(k, RERANK_CANDIDATES) if reranker is not None else k
+        # docstore に見つからないIDは文字列が返るため除く
+        candidates = [doc for doc in (index.docstore.search(doc_id) for doc_id in fused[:limit]) if not isinstance(doc, str)]
+        if reranker is not None:
+            with span("rerank", candidates=len(candidates)):
+                candidates = reranker.rerank(query, candidates)
+        attrs["results"] = min(k, len(candidates))
+        return candidates[:k]
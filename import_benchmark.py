@@ -0,0 +1,198 @@
+import os
+import re
+import sys
+import ast
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BASE_DIR, "benchmark_results")
+# 計測結果を1行ずつ追記していく履歴ファイル（前回の結果との比較に使う）
+HISTORY_PATH = os.path.join(RESULTS_DIR, "import_times.jsonl")
+
+# 計測対象: 名前 -> 読み込むモジュール（app は Streamlit で実行するため、先頭の import 文だけを計測する）
+TARGETS = {
+    "app": "app.py",
+    "faiss_index_builder": "faiss_index_builder",
+    "batch_process": "batch_process",
+    "judgement_cache": "judgement_cache",
+    "vector_index": "vector_index",
+}
+
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s+)(\S.*)$")
+
+
+def top_level_imports(path: str) -> str:
+    """
+    スクリプトのモジュール直下にある import 文だけを取り出す（Streamlit の画面処理は実行しない）
+    """
+    with open(path, encoding="utf-8") as f:
+        source = f.read()
+    tree = ast.parse(source)
+    return "\n".join(
+        ast.get_source_segment(source, node)
+        for node in tree.body
+        if isinstance(node, (ast.Import, ast.ImportFrom))
+    )
+
+
+def import_statement(target: str) -> str:
+    if target.endswith(".py"):
+        return top_level_imports(os.path.join(BASE_DIR, target))
+    return f"import {target}"
+
+
+def parse_importtime(stderr: str) -> list:
+    """
+    -X importtime の出力を (モジュール名, 深さ, self[ms], cumulative[ms]) のリストにする
+    """
+    rows = []
+    for line in stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        rows.append((name.strip(), (len(indent) - 1) // 2, int(self_us) / 1000, int(cumulative_us) / 1000))
+    return rows
+
+
+def measure(statement: str) -> dict:
+    """
+    新しいPythonプロセスで statement を -X importtime 付きで実行し、所要時間と重いモジュールを返す
+    """
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=BASE_DIR, capture_output=True, text=True,
+        env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+    )
+    wall_ms = (time.perf_counter() - start) * 1000
+    rows = parse_importtime(result.stderr)
+    if result.returncode != 0:
+        error = [line for line in result.stderr.splitlines() if not line.startswith("import time:")]
+        return {"error": "\n".join(error[-3:]), "wall_ms": wall_ms}
+    return {
+        "wall_ms": wall_ms,
+        # 直接読み込んだモジュール（深さ0）の cumulative の合計 = import にかかった時間
+        "import_ms": sum(cumulative for _, depth, _, cumulative in rows if depth == 0),
+        "modules": len(rows),
+        "top": sorted(
+            ({"module": name, "cumulative_ms": cumulative} for name, depth, _, cumulative in rows if depth == 0),
+            key=lambda x: -x["cumulative_ms"],
+        ),
+    }
+
+
+def benchmark(targets: list, repeat: int = 3, top: int = 10) -> list:
+    """
+    対象ごとに repeat 回計測し、import 時間の中央値と重いモジュールの上位 top 件を返す
+    （1回目はバイトコードのキャッシュ作成などを含むため捨てて、以降の計測を使う）
+    """
+    results = []
+    for name in targets:
+        statement = import_statement(TARGETS[name])
+        measure(statement)
+        runs = [measure(statement) for _ in range(repeat)]
+        failed = [run for run in runs if "error" in run]
+        if failed:
+            print(f"{name}: 読み込みに失敗しました\n{failed[0]['error']}")
+            results.append({"target": name, "error": failed[0]["error"]})
+            continue
+        best = min(runs, key=lambda run: run["import_ms"])
+        results.append({
+            "target": name,
+            "import_ms": statistics.median(run["import_ms"] for run in runs),
+            "wall_ms": statistics.median(run["wall_ms"] for run in runs),
+            "modules": best["modules"],
+            "top": best["top"][:top],
+        })
+    return results
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def load_previous(history_path: str = HISTORY_PATH) -> dict:
+    """
+    履歴ファイルから対象ごとの直近の結果を返す
+    """
+    previous = {}
+    try:
+        with open(history_path, encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                for result in record["results"]:
+                    if "error" not in result:
+                        previous[result["target"]] = result
+    except FileNotFoundError:
+        pass
+    return previous
+
+
+def print_report(results: list, previous: dict) -> None:
+    print(f"\n{'target':<22} {'import(ms)':>11} {'wall(ms)':>9} {'modules':>8}  {'前回比':>7}")
+    for result in results:
+        if "error" in result:
+            print(f"{result['target']:<22} {'失敗':>11}")
+            continue
+        before = previous.get(result["target"])
+        delta = f"{(result['import_ms'] / before['import_ms'] - 1) * 100:+.0f}%" if before and before["import_ms"] else ""
+        print(f"{result['target']:<22} {result['import_ms']:>11.1f} {result['wall_ms']:>9.1f} "
+              f"{result['modules']:>8}  {delta:>7}")
+    for result in results:
+        if result.get("top"):
+            print(f"\n--- {result['target']}: 読み込みに時間がかかるモジュール ---")
+            for row in result["top"]:
+                print(f"{row['cumulative_ms']:>9.1f} ms  {row['module']}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="-X importtime でアプリ・CLIの起動時の import 時間を計測し、履歴に記録する")
+    parser.add_argument("--targets", nargs="+", default=list(TARGETS), choices=list(TARGETS))
+    parser.add_argument("--repeat", type=int, default=3, help="対象ごとの計測回数（中央値を記録する）")
+    parser.add_argument("--top", type=int, default=10, help="表示・記録する重いモジュールの件数")
+    parser.add_argument("--history", default=HISTORY_PATH, help="結果を追記する履歴ファイル（JSONL）")
+    parser.add_argument("--no-record", action="store_true", help="履歴に追記しない")
+    parser.add_argument("--max-regression", type=float, default=None,
+                        help="前回よりこの割合（%%）以上遅くなった対象があれば終了コード1にする")
+    args = parser.parse_args()
+
+    previous = load_previous(args.history)
+    results = benchmark(args.targets, args.repeat, args.top)
+    print_report(results, previous)
+
+    if not args.no_record:
+        os.makedirs(os.path.dirname(args.history) or ".", exist_ok=True)
+        record = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "revision": _git_revision(),
+            "python": sys.version.split()[0],
+            "results": results,
+        }
+        with open(args.history, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        print(f"\n結果を追記しました: {args.history}")
+
+    if args.max_regression is not None:
+        regressed = [
+            result["target"] for result in results
+            if "error" not in result and result["target"] in previous
+            and result["import_ms"] > previous[result["target"]]["import_ms"] * (1 + args.max_regression / 100)
+        ]
+        if regressed:
+            print(f"前回より遅くなりました: {', '.join(regressed)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import uuid
+import threading
+import traceback
+
+from dotenv import load_dotenv
+
+from tracing import start_trace
+
+# .envから環境変数を読み込む
+load_dotenv()
+
+STORAGE_DIR = "storage"
+DATA_DIR = "document/docs_for_index"
+# 再作成ジョブの状態・進捗の保存先（画面の再読み込みやアプリの再起動後も直近の結果を表示できる）
+INDEX_JOB_STATE_PATH = os.getenv("INDEX_JOB_STATE_PATH", "cache/index_job.json")
+# 進捗をファイルへ書き出す最短間隔（秒）
+STATE_WRITE_INTERVAL = 1.0
+
+
+def expected_chunks(progress: dict) -> float | None:
+    """
+    進捗（BuildProgress.snapshot()）から全体のチャンク数を見積もる。まだ1ファイルも解析していなければ None
+    解析の途中は、解析済みファイルあたりのチャンク数から推定する
+    """
+    total_files = progress.get("total_files", 0)
+    parsed = progress.get("parse_count", 0)
+    if not total_files or not parsed:
+        return None
+    chunks = progress.get("chunk_count", 0)
+    return chunks if parsed >= total_files else chunks / parsed * total_files
+
+
+def progress_fraction(progress: dict) -> float:
+    expected = expected_chunks(progress)
+    return min(progress.get("embed_count", 0) / expected, 1.0) if expected else 0.0
+
+
+def estimate_eta(progress: dict) -> float | None:
+    """
+    残り時間（秒）の見積もり（これまでの埋め込みの速さで残りのチャンクを処理する場合）。見積もれない間は None
+    """
+    expected = expected_chunks(progress)
+    rate = progress.get("embeddings_per_second", 0.0)
+    if expected is None or not rate:
+        return None
+    return max(0.0, (expected - progress.get("embed_count", 0)) / rate)
+
+
+class IndexJobManager:
+    """
+    FAISSインデックスの再作成をバックグラウンドのスレッドで実行し、状態・進捗をファイルに保存する
+    同時に実行できる再作成は1件だけ。作成は作業用ディレクトリで行い、完了後に検索に使う版を切り替えるため
+    （faiss_index_builder.rebuild_index）、再作成中も検索は既存のインデックスで応答を続ける
+    """
+
+    def __init__(self, storage_dir: str = STORAGE_DIR, data_dir: str = DATA_DIR, state_path: str = INDEX_JOB_STATE_PATH):
+        self.storage_dir = storage_dir
+        self.data_dir = data_dir
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_write = 0.0
+        state = self.state()
+        if state.get("status") == "running":
+            # 前回のプロセスが実行中のまま終了していた
+            state.update(status="interrupted", finished_at=time.time(), error="アプリの再起動により中断されました")
+            self._write_state(state)
+
+    def state(self) -> dict:
+        """
+        直近のジョブの状態（status: idle / running / succeeded / failed / interrupted）
+        """
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"status": "idle"}
+
+    def _write_state(self, state: dict) -> None:
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.state_path)
+        self._last_write = time.monotonic()
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, **build_kwargs) -> bool:
+        """
+        再作成を開始する（build_kwargs は rebuild_index 経由で build_faiss_index に渡す）。実行中のジョブがあれば開始せず False を返す
+        """
+        with self._lock:
+            if self.is_running():
+                return False
+            state = {
+                "job_id": uuid.uuid4().hex[:12],
+                "status": "running",
+                "started_at": time.time(),
+                "finished_at": None,
+                "progress": {},
+                "eta_seconds": None,
+                "swapped": False,
+                "error": None,
+            }
+            self._write_state(state)
+            self._thread = threading.Thread(
+                target=self._run, args=(state, build_kwargs), name="index-rebuild", daemon=True
+            )
+            self._thread.start()
+        return True
+
+    def _on_progress(self, state: dict, progress: dict) -> None:
+        state["progress"] = progress
+        state["eta_seconds"] = estimate_eta(progress)
+        if time.monotonic() - self._last_write >= STATE_WRITE_INTERVAL:
+            self._write_state(state)
+
+    def _run(self, state: dict, build_kwargs: dict) -> None:
+        import faiss_index_builder
+
+        try:
+            with start_trace("index_rebuild", job_id=state["job_id"]):
+                state["swapped"] = faiss_index_builder.rebuild_index(
+                    storage_dir=self.storage_dir,
+                    data_dir=self.data_dir,
+                    on_progress=lambda progress: self._on_progress(state, progress),
+                    **build_kwargs,
+                )
+            state.update(status="succeeded", eta_seconds=0.0)
+            print(f"インデックス再作成完了（{'差し替えました' if state['swapped'] else '変更なし'}）")
+        except Exception as e:
+            traceback.print_exc()
+            state.update(status="failed", error=f"{type(e).__name__}: {e}")
+        finally:
+            state["finished_at"] = time.time()
+            self._write_state(state)
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_index_job_manager(storage_dir: str = STORAGE_DIR) -> IndexJobManager:
+    """
+    プロセス内で共有する再作成ジョブの管理（Streamlitのセッション間でも同じものを使う）
+    """
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = IndexJobManager(storage_dir)
+    return _manager
@@ -0,0 +1,196 @@
+import os
+import json
+import math
+import threading
+from collections import defaultdict
+
+import pandas as pd
+
+from lifetime_index import normalize_text, split_items
+from tracing import span
+
+# 仕訳例（過去の仕訳実績Excel）の行単位インデックスの保存先
+JOURNAL_INDEX_PATH = "cache/journal_index.json"
+JOURNAL_INDEX_VERSION = 1
+EXAMPLE_DIR = "document/example_accounting_entry/"
+EXAMPLE_EXTENSIONS = (".xlsx", ".xls")
+
+# プロンプトに載せる件数の上限（仕訳例が増えてもプロンプトの大きさは一定）
+DEFAULT_TOP_K = 3
+DEFAULT_MAX_ROWS = 15
+MAX_ROW_CHARS = 300
+
+
+def _ngrams(text: str, n: int = 2) -> set:
+    text = normalize_text(text)
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def _row_text(columns: list, values: list) -> str:
+    parts = []
+    for col, value in zip(columns, values):
+        if value is None or (isinstance(value, float) and math.isnan(value)) or str(value).strip() == "":
+            continue
+        parts.append(f"{col}: {value}")
+    return " / ".join(parts)
+
+
+def parse_journal_file(path: str) -> list:
+    """
+    仕訳例Excelを読み込み、1行ずつ「列名: 値 / …」形式のテキストにしたリストを返す
+    （複数シートがある場合はすべてのシートを対象にする）
+    """
+    with span("excel_load", file=os.path.basename(path)) as attrs:
+        sheets = pd.read_excel(path, sheet_name=None)
+        rows = []
+        for df in sheets.values():
+            columns = [str(c) for c in df.columns]
+            for values in df.itertuples(index=False, name=None):
+                text = _row_text(columns, values)
+                if text:
+                    rows.append(text)
+        attrs["rows"] = len(rows)
+    return rows
+
+
+class JournalIndex:
+    """
+    仕訳例の行とn-gram転置インデックス（IDFで重み付けしたn-gram一致度で検索する）
+    """
+
+    def __init__(self, files: dict):
+        # files: {ファイル名: {"signature": [size, mtime_ns], "rows": [行テキスト, ...]}}
+        self.files = files
+        self.rows = []  # (ファイル名, 行テキスト)
+        for file_name in sorted(files):
+            self.rows.extend((file_name, text) for text in files[file_name]["rows"])
+        self.postings = defaultdict(list)
+        for i, (_, text) in enumerate(self.rows):
+            for gram in _ngrams(text):
+                self.postings[gram].append(i)
+        total = max(1, len(self.rows))
+        self.idf = {gram: math.log(1 + total / len(ids)) for gram, ids in self.postings.items()}
+
+    def search(self, item: str, k: int = DEFAULT_TOP_K) -> list:
+        """
+        品目名に似た仕訳例の行を最大k件、(ファイル名, 行テキスト) で返す
+        """
+        query = _ngrams(item)
+        norm = sum(self.idf.get(gram, 0.0) for gram in query)
+        if not norm:
+            return []
+        scores = defaultdict(float)
+        for gram in query:
+            for i in self.postings.get(gram, ()):
+                scores[i] += self.idf[gram]
+        ranked = sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+        return [self.rows[i] for i, score in ranked[:k] if score / norm >= 0.2]
+
+    def to_dict(self) -> dict:
+        return {"files": self.files}
+
+
+def _file_signature(path: str) -> list:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _save_index(index: JournalIndex, index_path: str) -> None:
+    os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": JOURNAL_INDEX_VERSION, **index.to_dict()}, f, ensure_ascii=False)
+    os.replace(tmp_path, index_path)
+
+
+_lock = threading.Lock()
+_loaded = {}
+
+
+def load_journal_index(example_dir: str = EXAMPLE_DIR, index_path: str = JOURNAL_INDEX_PATH) -> JournalIndex:
+    """
+    保存済みの仕訳例インデックスを読み込む
+    追加・更新されたExcelだけを解析し直し、削除されたファイルの行は取り除く
+    """
+    os.makedirs(example_dir, exist_ok=True)
+    signature = {
+        name: _file_signature(os.path.join(example_dir, name))
+        for name in sorted(os.listdir(example_dir))
+        if name.endswith(EXAMPLE_EXTENSIONS)
+    }
+    with _lock:
+        index = _loaded.get(index_path)
+        if index and {name: f["signature"] for name, f in index.files.items()} == signature:
+            return index
+
+        files = dict(index.files) if index else {}
+        if index is None and os.path.exists(index_path):
+            try:
+                with open(index_path, encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("version") == JOURNAL_INDEX_VERSION:
+                    files = data["files"]
+            except (OSError, ValueError, KeyError) as e:
+                print(f"仕訳例インデックスの読み込みに失敗したため再作成します: {e}")
+
+        updated = {}
+        for name, sig in signature.items():
+            if name in files and files[name]["signature"] == sig:
+                updated[name] = files[name]
+                continue
+            try:
+                rows = parse_journal_file(os.path.join(example_dir, name))
+            except Exception as e:
+                print(f"{name} の読み込み中にエラーが発生しました: {e}")
+                rows = []
+            updated[name] = {"signature": sig, "rows": rows}
+            print(f"仕訳例インデックス更新: {name}（{len(rows)}行）")
+
+        index = JournalIndex(updated)
+        if updated != files:
+            _save_index(index, index_path)
+        _loaded[index_path] = index
+        return index
+
+
+def render_journal_examples(
+    items: list,
+    index: JournalIndex,
+    k: int = DEFAULT_TOP_K,
+    max_rows: int = DEFAULT_MAX_ROWS,
+) -> str:
+    """
+    品目ごとに類似する仕訳例を上位k件ずつ取り出し、プロンプト用のテキストにする
+    全体で max_rows 行までに抑える（品目数が多い場合も各品目の1位から順に載せ、同じ行は1度だけ載せる）
+    """
+    results = [index.search(item, k) for item in items]
+    seen = set()
+    lines = []
+    for rank in range(k):
+        for hits in results:
+            if rank >= len(hits) or hits[rank] in seen:
+                continue
+            seen.add(hits[rank])
+            file_name, text = hits[rank]
+            lines.append(f"- [{file_name}] {text[:MAX_ROW_CHARS]}")
+            if len(lines) >= max_rows:
+                return "\n".join(lines)
+    return "\n".join(lines) if lines else "（類似する仕訳例はありませんでした）"
+
+
+def retrieve_journal_examples(text: str, example_dir: str = EXAMPLE_DIR, k: int = DEFAULT_TOP_K) -> str:
+    """
+    証憑テキスト（または質問文）から品目名を取り出し、類似する過去の仕訳例だけを返す
+    """
+    index = load_journal_index(example_dir)
+    with span("journal_search", rows=len(index.rows)):
+        return render_journal_examples(split_items(text), index, k=k)
+
+
+if __name__ == "__main__":
+    index = load_journal_index()
+    print(f"仕訳例: {len(index.files)}ファイル / {len(index.rows)}行")
+    for item in ["パソコン", "エアコン", "応接セット"]:
+        print(f"==== {item} ====")
+        for file_name, text in index.search(item):
+            print(f"[{file_name}] {text}")
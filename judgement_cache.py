@@ -0,0 +1,446 @@
+import os
+import re
+import csv
+import json
+import time
+import sqlite3
+import argparse
+import threading
+
+from lifetime_index import ALIASES, normalize_text
+
+JUDGEMENT_CACHE_PATH = os.getenv("JUDGEMENT_CACHE_PATH", "cache/judgements.sqlite3")
+# ChangeTitleの修正履歴を取り込むときに1回のトランザクションで登録する件数
+SEED_BATCH_SIZE = 1000
+
+# 金額帯の境界（少額減価償却資産・一括償却資産・中小企業者の特例の判定に効く金額）
+AMOUNT_BANDS = (100_000, 200_000, 300_000)
+# 過去の判定結果として採用しない値
+UNKNOWN_VALUES = ("", "該当情報なし", "不明", "nan", "None")
+
+# 判定結果の行（dict）の列
+JUDGEMENT_FIELDS = ("品目名", "金額", "勘定科目", "法定耐用年数", "根拠")
+
+SOURCE_HUMAN = "human"
+SOURCE_LLM = "llm"
+
+# 証憑から抽出した金額の扱い（asset_judge と同じく、税込の場合は10%の消費税を除いて税抜にする）
+TAX_INCLUDED = "税込"
+TAX_EXCLUDED = "税抜"
+TAX_RATE_PERCENT = 10
+
+
+def parse_amount(value) -> float | None:
+    """
+    「150,000円」「¥150000」などの金額表記を数値にする（読み取れなければNone）
+    """
+    text = str(value or "").replace(",", "").replace("，", "")
+    match = re.search(r"\d+(?:\.\d+)?", text)
+    return float(match.group()) if match else None
+
+
+def amount_band(amount: float | None) -> str:
+    """
+    金額を帯に丸める（金額が読み取れない場合は "unknown"）
+    """
+    if amount is None:
+        return "unknown"
+    lower = 0
+    for upper in AMOUNT_BANDS:
+        if amount < upper:
+            return f"{lower}-{upper}"
+        lower = upper
+    return f"{lower}-"
+
+
+def _without_tax(value: float) -> float:
+    # 1円未満は切り捨てる
+    return value * 100 // (100 + TAX_RATE_PERCENT)
+
+
+def infer_tax_basis(amount, judged_amount) -> str | None:
+    """
+    抽出した金額と、LLMが判定した税抜金額の関係から、抽出した金額が税込・税抜のどちらだったかを返す
+    どちらとも言えない（非課税・一部だけ課税など）場合は None
+    """
+    value, judged = parse_amount(amount), parse_amount(judged_amount)
+    if not value or judged is None:
+        return None
+    if abs(judged - value) <= 1:
+        return TAX_EXCLUDED
+    if abs(judged - _without_tax(value)) <= 1:
+        return TAX_INCLUDED
+    return None
+
+
+def tax_excluded_amount(amount, tax_basis: str | None = None) -> str | None:
+    """
+    証憑から抽出した金額を税抜金額の表記にする。税込・税抜が分からない場合と、金額が読み取れない場合は None
+    金額の表記に「税込」「税抜」とあればそれに従い、なければ tax_basis（過去の判定で分かった金額の扱い）に従う
+    """
+    value = parse_amount(amount)
+    if value is None:
+        return None
+    text = str(amount)
+    if TAX_INCLUDED in text:
+        tax_basis = TAX_INCLUDED
+    elif TAX_EXCLUDED in text:
+        tax_basis = TAX_EXCLUDED
+    if tax_basis == TAX_INCLUDED:
+        value = _without_tax(value)
+    elif tax_basis != TAX_EXCLUDED:
+        return None
+    return f"{int(value):,}円"
+
+
+def cell_text(value) -> str:
+    """
+    表のセルの値を文字列にする（None・NaN などの空のセルは空文字）
+    """
+    if value is None:
+        return ""
+    try:
+        if value != value:
+            return ""
+    except TypeError:
+        # pandas.NA は比較の結果を真偽値にできない
+        return ""
+    return str(value).strip()
+
+
+def item_key(item_name: str) -> str:
+    """
+    品目名を正規化する（表記ゆれと、耐用年数表の読み替え対象の別名を同じキーにまとめる）
+    """
+    name = normalize_text(item_name)
+    return normalize_text(ALIASES.get(name, name))
+
+
+def parse_item_amounts(document_text: str) -> list:
+    """
+    品目抽出結果（「品目名: ● / 金額: ●円」形式）または編集後のCSV（品目名,金額）から
+    (品目名, 金額表記) のリストを取り出す。品目が読み取れなければ空のリスト
+    """
+    lines = [line for line in (document_text or "").splitlines() if line.strip()]
+    if lines and "品目名" in lines[0] and "," in lines[0]:
+        return [
+            (row.get("品目名", "").strip(), (row.get("金額") or "").strip())
+            for row in csv.DictReader(lines)
+            if row.get("品目名", "").strip()
+        ]
+    pattern = re.compile(r"品目名[:：]\s*([^\n]+?)\s*\n\s*・?金額[:：]\s*([^\n]*)")
+    return [(m.group(1).strip(), m.group(2).strip()) for m in pattern.finditer(document_text or "")]
+
+
+def format_judgement_rows(rows: list) -> str:
+    """
+    判定結果の行（dict）を asset_judge のLLM出力と同じ形式のテキストにする
+    （make_df.parse_llm_output_to_dataframe でそのまま表にできる）
+    """
+    blocks = []
+    for row in rows:
+        blocks.append(
+            f"品目名: {row['品目名']}\n"
+            f"・金額：{row['金額']}\n"
+            f"・勘定科目：{row['勘定科目']}\n"
+            f"・法定耐用年数：{row['法定耐用年数']}\n"
+            f"・根拠：{row['根拠']}\n"
+        )
+    return "\n".join(blocks)
+
+
+class JudgementCache:
+    """
+    品目（正規化した品目名＋金額帯）→ 勘定科目・法定耐用年数・根拠 の判定結果キャッシュ（SQLite）
+    人による修正（ChangeTitle）はLLMの判定結果より優先し、LLMの結果で上書きしない
+    """
+
+    def __init__(self, path: str = JUDGEMENT_CACHE_PATH):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.calls_bypassed = 0
+        self.bypassed_tokens = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS judgements ("
+            " item_key TEXT NOT NULL, amount_band TEXT NOT NULL, item_name TEXT NOT NULL,"
+            " account_title TEXT NOT NULL, useful_life TEXT NOT NULL, basis TEXT NOT NULL,"
+            " tax_basis TEXT, source TEXT NOT NULL, token_cost INTEGER NOT NULL,"
+            " hit_count INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL,"
+            " PRIMARY KEY (item_key, amount_band))"
+        )
+        # 取り込み元（ChangeTitleなど）ごとに、取り込み済みの最後のID
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS seed_state (source TEXT PRIMARY KEY, last_id INTEGER NOT NULL)"
+        )
+        self._conn.commit()
+
+    def put(
+        self,
+        item_name: str,
+        amount,
+        account_title: str,
+        useful_life: str,
+        basis: str,
+        source: str = SOURCE_LLM,
+        judged_amount=None,
+        token_cost: int = 0,
+    ) -> bool:
+        """
+        判定結果を登録する。登録した場合 True
+        金額は金額帯のキーにだけ使い、記録しない（金額は証憑ごとに異なるため、返すときはその証憑の金額を使う）
+        judged_amount（判定した税抜金額）があれば、抽出した金額が税込・税抜のどちらだったかを記録する
+        （判定が不明なもの、人による修正済みの品目をLLMの結果で上書きするものは登録しない）
+        """
+        with self._lock, self._conn:
+            return self._upsert(
+                item_name, amount, account_title, useful_life, basis, source, token_cost,
+                infer_tax_basis(amount, judged_amount),
+            )
+
+    def _upsert(self, item_name, amount, account_title, useful_life, basis, source, token_cost, tax_basis=None) -> bool:
+        # 呼び出し側でロックを取り、トランザクションを確定する（複数件を1回のコミットにまとめられるように）
+        if not item_key(item_name) or str(account_title).strip() in UNKNOWN_VALUES:
+            return False
+        key = (item_key(item_name), amount_band(parse_amount(amount)))
+        # キャッシュから返した行を修正した場合に付記が重ならないようにする
+        basis = re.sub(r"（判定キャッシュ: [^）]*）$", "", str(basis).strip())
+        existing = self._conn.execute(
+            "SELECT source FROM judgements WHERE item_key = ? AND amount_band = ?", key
+        ).fetchone()
+        if existing and existing[0] == SOURCE_HUMAN and source != SOURCE_HUMAN:
+            return False
+        self._conn.execute(
+            "INSERT OR REPLACE INTO judgements"
+            " (item_key, amount_band, item_name, account_title, useful_life, basis,"
+            "  tax_basis, source, token_cost, hit_count, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?,"
+            # 金額の扱いが分からない結果（人による修正など）は、同じ品目で分かっている扱いを引き継ぐ
+            "  COALESCE(?, (SELECT tax_basis FROM judgements WHERE item_key = ? AND amount_band = ?)), ?, ?,"
+            "  COALESCE((SELECT hit_count FROM judgements WHERE item_key = ? AND amount_band = ?), 0), ?)",
+            (
+                *key, item_name, str(account_title).strip(), str(useful_life).strip(), str(basis).strip(),
+                tax_basis, *key, source, int(token_cost), *key, time.time(),
+            ),
+        )
+        return True
+
+    def lookup(self, item_name: str, amount) -> dict | None:
+        """
+        品目名・金額に対応する判定結果の行（dict）を返す。なければ None
+        金額は税込・税抜どちらの可能性もあるため、税抜換算した金額帯も探す（人による修正を優先）
+        行の金額はキャッシュではなく、今回の証憑の金額を税抜にしたもの（LLMの判定と同じく税込なら消費税を除く）
+        税込・税抜が分からない場合は証憑の金額をそのまま返し、根拠に換算していないことを書き添える
+        """
+        amount_value = parse_amount(amount)
+        bands = [amount_band(amount_value)]
+        if amount_value is not None:
+            bands.append(amount_band(amount_value / 1.1))
+        key = item_key(item_name)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT amount_band, account_title, useful_life, basis, source, token_cost, tax_basis"
+                f" FROM judgements WHERE item_key = ? AND amount_band IN ({','.join('?' * len(bands))})",
+                (key, *bands),
+            ).fetchall()
+            if not rows:
+                return None
+            row = sorted(rows, key=lambda r: (r[4] != SOURCE_HUMAN, bands.index(r[0])))[0]
+            self._conn.execute(
+                "UPDATE judgements SET hit_count = hit_count + 1 WHERE item_key = ? AND amount_band = ?",
+                (key, row[0]),
+            )
+            self._conn.commit()
+        band, account_title, useful_life, basis, source, token_cost, tax_basis = row
+        label = "人による修正" if source == SOURCE_HUMAN else "過去の判定結果"
+        amount_text = tax_excluded_amount(amount, tax_basis)
+        if amount_text is None:
+            amount_text = str(amount)
+            label += "・金額は税抜に換算していません"
+        return {
+            "品目名": item_name,
+            "金額": amount_text,
+            "勘定科目": account_title,
+            "法定耐用年数": useful_life,
+            "根拠": f"{basis}（判定キャッシュ: {label}）",
+            "token_cost": token_cost,
+        }
+
+    def split(self, items: list) -> tuple:
+        """
+        (品目名, 金額) のリストをキャッシュ済みの判定結果と、LLMで判定が必要な品目に分ける
+
+        Returns:
+            tuple: (キャッシュ済みの行のリスト, 未知の (品目名, 金額) のリスト)
+        """
+        cached_rows = []
+        unknown = []
+        for name, amount in items:
+            row = self.lookup(name, amount)
+            if row is None:
+                unknown.append((name, amount))
+            else:
+                cached_rows.append(row)
+        with self._lock:
+            self.hits += len(cached_rows)
+            self.misses += len(unknown)
+            self.bypassed_tokens += sum(row["token_cost"] for row in cached_rows)
+            if items and not unknown:
+                self.calls_bypassed += 1
+        return cached_rows, unknown
+
+    def record_llm_output(self, items: list, rows: list, token_cost: int = 0) -> int:
+        """
+        asset_judge の判定結果（行のリスト）を登録する。登録した件数を返す
+        token_cost はこの判定に使ったトークン数で、品目数で按分して記録する（キャッシュ命中時の節約量の概算用）
+        """
+        input_amounts = {item_key(name): amount for name, amount in items}
+        per_item = token_cost // max(1, len(rows))
+        count = 0
+        for row in rows:
+            name = str(row.get("品目名", ""))
+            amount = input_amounts.get(item_key(name), row.get("金額"))
+            if self.put(
+                name, amount, row.get("勘定科目", ""), row.get("法定耐用年数", ""), row.get("根拠", ""),
+                source=SOURCE_LLM, judged_amount=row.get("金額"), token_cost=per_item,
+            ):
+                count += 1
+        return count
+
+    def record_correction(self, row: dict) -> bool:
+        """
+        人が修正した判定結果（品目名・金額・勘定科目・法定耐用年数・根拠）を優先度の高い結果として登録する
+        """
+        return self.record_corrections([row]) == 1
+
+    def record_corrections(self, rows) -> int:
+        """
+        人が修正した判定結果の行をまとめて登録する（1つのトランザクションで書き込む）。登録した件数を返す
+        品目名・勘定科目が空の行（追加したが入力していない行など）は登録しない
+        """
+        with self._lock, self._conn:
+            return self._record_corrections(rows)
+
+    def _record_corrections(self, rows) -> int:
+        # 呼び出し側でロックを取り、トランザクションを確定する
+        count = 0
+        for row in rows:
+            values = {column: cell_text(row.get(column)) for column in JUDGEMENT_FIELDS}
+            if not values["品目名"] or not values["勘定科目"]:
+                continue
+            count += self._upsert(
+                values["品目名"], values["金額"], values["勘定科目"],
+                values["法定耐用年数"], values["根拠"], SOURCE_HUMAN, 0, None,
+            )
+        return count
+
+    def seed_from_change_titles(self, batch_size: int = SEED_BATCH_SIZE) -> int:
+        """
+        ChangeTitleテーブルの修正履歴のうち、前回の取り込み以降に追加されたもの（古い順）を人による修正として登録する
+        batch_size 件ごとに、取り込み済みのLogIDと一緒にコミットする（途中で止まっても次回は続きから取り込む）
+        登録した件数を返す
+        """
+        from db_control.crud import iter_rows
+        from db_control.mymodels import ChangeTitle
+
+        with self._lock:
+            state = self._conn.execute(
+                "SELECT last_id FROM seed_state WHERE source = ?", (ChangeTitle.__tablename__,)
+            ).fetchone()
+        count = 0
+        batch = []
+        # 履歴が多くても全件をメモリに載せないよう、古い順に少しずつ読み出す
+        for change in iter_rows(ChangeTitle, order_by="LogID", after_id=state[0] if state else None):
+            batch.append(change)
+            if len(batch) >= batch_size:
+                count += self._seed_change_titles(ChangeTitle.__tablename__, batch)
+                batch = []
+        if batch:
+            count += self._seed_change_titles(ChangeTitle.__tablename__, batch)
+        return count
+
+    def _seed_change_titles(self, source: str, changes: list) -> int:
+        rows = [
+            {
+                "品目名": change.get("New_ItemName") or change.get("Old_ItemName") or "",
+                "金額": change.get("New_Amount"),
+                "勘定科目": change.get("New_AccountTitle", ""),
+                "法定耐用年数": change.get("New_LegalUsefulLife", ""),
+                "根拠": change.get("New_Basis", ""),
+            }
+            for change in changes
+        ]
+        with self._lock, self._conn:
+            count = self._record_corrections(rows)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO seed_state (source, last_id) VALUES (?, ?)", (source, changes[-1]["LogID"])
+            )
+        return count
+
+    def seed_from_batch_state(self, state_path: str) -> int:
+        """
+        batch_process の進捗ファイル（batch_state.json）に残っている過去の判定結果を登録する
+        """
+        from make_df import parse_llm_output_to_dataframe
+
+        with open(state_path, encoding="utf-8") as f:
+            entries = json.load(f)
+        count = 0
+        for entry in entries.values():
+            if entry.get("status") == "done" and entry.get("rag_response"):
+                rows = parse_llm_output_to_dataframe(entry["rag_response"]).to_dict("records")
+                count += self.record_llm_output([], rows)
+        return count
+
+    def stats(self) -> dict:
+        """
+        命中率と、LLMを呼ばずに済んだ品目数・呼び出し数・トークン数（概算）
+        """
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT source, COUNT(*) FROM judgements GROUP BY source").fetchall())
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "calls_bypassed": self.calls_bypassed,
+            "bypassed_tokens": self.bypassed_tokens,
+            "entries_human": counts.get(SOURCE_HUMAN, 0),
+            "entries_llm": counts.get(SOURCE_LLM, 0),
+        }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_judgement_cache(path: str = JUDGEMENT_CACHE_PATH) -> JudgementCache:
+    """
+    プロセスで共有する判定キャッシュを返す（初回に、前回の取り込み以降に追加されたChangeTitleの修正履歴を取り込む）
+    """
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = JudgementCache(path)
+            try:
+                print(f"判定キャッシュ: ChangeTitleから{cache.seed_from_change_titles()}件の修正を取り込みました")
+            except Exception as e:
+                print(f"判定キャッシュ: ChangeTitleの取り込みに失敗しました: {e}")
+            _caches[path] = cache
+    return cache
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="判定キャッシュの取り込みと統計表示")
+    parser.add_argument("--batch-state", nargs="*", default=[], help="取り込む batch_state.json のパス")
+    args = parser.parse_args()
+
+    cache = get_judgement_cache()
+    for state_path in args.batch_state:
+        print(f"{state_path}: {cache.seed_from_batch_state(state_path)}件の判定結果を取り込みました")
+    print(cache.stats())
@@ -0,0 +1,136 @@
+import os
+import re
+from dataclasses import dataclass
+
+import numpy as np
+
+from reference_data import LAW_TEXT_PATH, get_reference_store
+from retrieval_service import get_retrieval_service
+from tracing import span
+
+# 質問・品目に関連する条文として載せる件数
+DEFAULT_TOP_K = 4
+
+ARTICLE_PATTERN = re.compile(r"^(第[一二三四五六七八九十百]+条(?:の[一二三四五六七八九十]+)?)[\s　]")
+PARAGRAPH_PATTERN = re.compile(r"^([０-９0-9]+)[\s　]")
+CAPTION_PATTERN = re.compile(r"^（[^（）]+）$")
+SUPPLEMENT_PATTERN = re.compile(r"^附[\s　]*則")
+ARTICLE_REF_PATTERN = re.compile(r"第[一二三四五六七八九十百]+条(?:の[一二三四五六七八九十]+)?")
+
+
+@dataclass
+class LawChunk:
+    """
+    法令テキストの1項分（号・イロハは項に含める）
+    """
+    article: str        # 条（例: 第三条）。附則は「附則」
+    caption: str        # 条の見出し（例: （中古資産の耐用年数等））
+    paragraph: int      # 項番号（1始まり）
+    text: str
+
+    def label(self) -> str:
+        label = self.article if self.paragraph == 1 else f"{self.article}第{self.paragraph}項"
+        return f"{label}{self.caption}"
+
+    def to_prompt_text(self) -> str:
+        return f"【{self.label()}】\n{self.text}"
+
+
+def parse_law_text(text: str) -> list:
+    """
+    法令テキストを項単位の LawChunk のリストに分割する
+    """
+    chunks = []
+    caption = ""
+    article = ""
+    current = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if CAPTION_PATTERN.match(line):
+            caption = line
+            continue
+        article_match = ARTICLE_PATTERN.match(line)
+        paragraph_match = PARAGRAPH_PATTERN.match(line)
+        if article_match:
+            article = article_match.group(1)
+            current = LawChunk(article, caption, 1, line)
+            chunks.append(current)
+        elif SUPPLEMENT_PATTERN.match(line):
+            article, caption, current = "附則", "", None
+        elif paragraph_match and article:
+            paragraph = int(paragraph_match.group(1).translate(str.maketrans("０１２３４５６７８９", "0123456789")))
+            current = LawChunk(article, caption, paragraph, line)
+            chunks.append(current)
+        elif current is not None:
+            current.text += "\n" + line
+        else:
+            current = LawChunk(article or "前文", caption, 1, line)
+            chunks.append(current)
+    return chunks
+
+
+class LawIndex:
+    """
+    法令テキストの項ごとの埋め込みベクトル（項の数は少ないため、全件とのコサイン類似度で検索する）
+    埋め込みは CachedEmbeddings を通すため、再起動後もAPIを呼ばずに再構築できる
+    """
+
+    def __init__(self, chunks: list, embeddings):
+        self.chunks = chunks
+        self.embeddings = embeddings
+        vectors = np.asarray(
+            embeddings.embed_documents([c.to_prompt_text() for c in chunks]), dtype=np.float32
+        ).reshape(len(chunks), -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.vectors = vectors / np.where(norms == 0, 1, norms)
+
+    def search(self, query: str, k: int = DEFAULT_TOP_K) -> list:
+        """
+        質問・品目に関連する項を最大k件、条文の順に返す
+        質問中で条番号（第○条）が指定されていれば、その条の項を優先する
+        """
+        if not self.chunks or not query.strip():
+            return []
+        query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        query_vector /= np.linalg.norm(query_vector) or 1.0
+        scores = self.vectors @ query_vector
+        referenced = set(ARTICLE_REF_PATTERN.findall(query))
+        for i, chunk in enumerate(self.chunks):
+            if chunk.article in referenced:
+                scores[i] += 1.0
+        top = sorted(np.argsort(-scores)[:k])
+        return [self.chunks[i] for i in top]
+
+
+def _build_law_index(path: str) -> LawIndex:
+    with open(path, encoding="utf-8") as f:
+        chunks = parse_law_text(f.read())
+    print(f"法令インデックス作成: {len(chunks)}項 ({os.path.basename(path)})")
+    return LawIndex(chunks, get_retrieval_service("storage").get_embeddings())
+
+
+def load_law_index(path: str = LAW_TEXT_PATH) -> LawIndex:
+    """
+    法令テキストの項インデックスを返す（ファイルが変わった場合のみ作り直す）
+    """
+    return get_reference_store().get(path, _build_law_index)
+
+
+def retrieve_law_articles(query: str, path: str = LAW_TEXT_PATH, k: int = DEFAULT_TOP_K) -> str:
+    """
+    質問・証憑の品目に関連する条文（項単位）だけをプロンプト用テキストにする
+    """
+    if not os.path.exists(path):
+        return "（法令テキストが見つかりませんでした）"
+    index = load_law_index(path)
+    with span("law_search", k=k):
+        chunks = index.search(query, k)
+    return "\n\n".join(c.to_prompt_text() for c in chunks)
+
+
+if __name__ == "__main__":
+    with open(LAW_TEXT_PATH, encoding="utf-8") as f:
+        for chunk in parse_law_text(f.read()):
+            print(f"{chunk.label()}: {chunk.text[:40]}…")
@@ -0,0 +1,80 @@
+import sys
+import types
+import importlib
+
+# 重い依存（langchain・Azure SDK・pandas など）を、最初に使われるまで読み込まないための仕組み
+# Streamlit の起動直後や CLI の --help では使わないモジュールの読み込み時間を省く
+# （読み込み自体のスレッド間の排他は importlib のモジュールごとのロックに任せる）
+
+
+class LazyModule(types.ModuleType):
+    """
+    属性に最初にアクセスしたときに本物のモジュールを読み込むモジュールの代理
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.__dict__["_lazy_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_lazy_module"]
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__["_lazy_module"] = module
+        return module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.__dict__["_lazy_module"] is not None else "not loaded"
+        return f"<lazy module {self.__name__!r} ({state})>"
+
+
+class LazyObject:
+    """
+    モジュールの属性（クラス・関数）の代理。呼び出し・属性アクセス時にモジュールを読み込む
+    モジュール変数として置いておけば、これまでどおり別の実装に差し替えられる（fake_backends など）
+    """
+
+    def __init__(self, module_name: str, attr: str):
+        self._module_name = module_name
+        self._attr = attr
+        self._target = None
+
+    def resolve(self):
+        if self._target is None:
+            self._target = getattr(importlib.import_module(self._module_name), self._attr)
+        return self._target
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __getattr__(self, attr: str):
+        # __init__ 前（copy など）に自分の属性を探して無限再帰しないようにする
+        if attr in ("_module_name", "_attr", "_target"):
+            raise AttributeError(attr)
+        return getattr(self.resolve(), attr)
+
+    def __repr__(self) -> str:
+        return f"<lazy {self._module_name}.{self._attr}>"
+
+
+def lazy_module(name: str):
+    """
+    モジュールを遅延読み込みする。すでに読み込み済みならそのモジュールを返す
+    """
+    return sys.modules.get(name) or LazyModule(name)
+
+
+def lazy_object(module_name: str, attr: str):
+    """
+    module_name.attr を遅延読み込みする（from module_name import attr の代わり）
+    """
+    module = sys.modules.get(module_name)
+    if module is not None and hasattr(module, attr):
+        return getattr(module, attr)
+    return LazyObject(module_name, attr)
@@ -0,0 +1,388 @@
+import os
+import re
+import csv
+import json
+import unicodedata
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, asdict
+from collections import defaultdict
+
+# 耐用年数表インデックスの保存先（XMLが更新された場合のみ再構築する）
+LIFETIME_INDEX_PATH = "cache/lifetime_index.json"
+LIFETIME_INDEX_VERSION = 1
+
+# 見出し列名 → レコードのフィールド名
+COLUMN_FIELDS = {
+    "番号": "number",
+    "種類": "category",
+    "設備の種類": "category",
+    "構造又は用途": "structure",
+    "細目": "detail",
+    "耐用年数": "years",
+}
+
+# 証憑上の呼び方と別表の表記が大きく異なる品目の読み替え
+ALIASES = {
+    "pc": "パーソナルコンピュータ",
+    "パソコン": "パーソナルコンピュータ",
+    "ノートpc": "パーソナルコンピュータ",
+    "ノートパソコン": "パーソナルコンピュータ",
+    "デスクトップpc": "パーソナルコンピュータ",
+    "コピー機": "複写機",
+    "複合機": "複写機 その他の事務機器",
+    "エアコン": "冷房用又は暖房用機器 冷房、暖房、通風又はボイラー設備",
+}
+
+KANJI_DIGITS = {"〇": 0, "一": 1, "二": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+
+
+@dataclass
+class LifetimeRecord:
+    """
+    耐用年数表（別表）の1行分
+    """
+    table: str              # 別表名（例: 別表第一 機械及び装置以外の有形減価償却資産の耐用年数表）
+    file_name: str          # 元のxmlファイル名
+    category: str           # 種類（別表第二では設備の種類）
+    structure: str          # 構造又は用途
+    heading: str            # 細目の見出し（例: 電子計算機）
+    detail: str             # 細目
+    years: int | None       # 耐用年数（見出し行などで記載がなければNone）
+    number: str = ""        # 番号（別表第二のみ）
+
+    def label(self) -> str:
+        """分類の表示用文字列"""
+        return " / ".join(v for v in (self.category, self.structure) if v)
+
+    def detail_label(self) -> str:
+        """細目の表示用文字列（見出しがあれば付与）"""
+        return " > ".join(v for v in (self.heading, self.detail) if v)
+
+    def to_prompt_line(self) -> str:
+        years = f"{self.years}年" if self.years is not None else "記載なし"
+        return (
+            f"- [{self.table}] 分類: {self.label()} / 細目: {self.detail_label() or '（なし）'}"
+            f" / 耐用年数: {years}"
+        )
+
+
+def normalize_text(text: str) -> str:
+    """
+    全角半角・大文字小文字・空白の揺れを吸収した比較用文字列を返す
+    """
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return re.sub(r"\s+", "", text)
+
+
+def strip_parenthetical(text: str) -> str:
+    """
+    「（サーバー用のものを除く。）」のような括弧書きを取り除く
+    """
+    return re.sub(r"[（(][^（）()]*[）)]", "", text)
+
+
+def kanji_to_int(text: str) -> int | None:
+    """
+    「一五」「五〇」形式の漢数字を整数に変換する
+    """
+    text = normalize_text(text)
+    if text.isdigit():
+        return int(text)
+    if not text or any(ch not in KANJI_DIGITS for ch in text):
+        return None
+    value = 0
+    for ch in text:
+        value = value * 10 + KANJI_DIGITS[ch]
+    return value
+
+
+def _node_text(node) -> str:
+    # ルビ（Rt）は読み仮名なので除外する
+    parts = [node.text or ""]
+    for child in node:
+        if child.tag != "Rt":
+            parts.append(_node_text(child))
+        parts.append(child.tail or "")
+    return "".join(parts)
+
+
+def _cell_text(column) -> str:
+    text = "".join(_node_text(s) for s in column.iter("Sentence"))
+    return text.replace("　", " ").strip()
+
+
+def _expand_rows(table) -> list:
+    """
+    rowspanを展開し、各行を列数分のセル文字列リストにする
+    """
+    rows = []
+    pending = {}  # 列番号 -> [残り行数, 値]
+    ncols = None
+    for row in table.iter("TableRow"):
+        columns = list(row.findall("TableColumn"))
+        if ncols is None:
+            ncols = len(columns)
+        cells = []
+        col_iter = iter(columns)
+        for i in range(ncols):
+            if i in pending:
+                remaining, value = pending[i]
+                cells.append(value)
+                if remaining <= 1:
+                    del pending[i]
+                else:
+                    pending[i] = [remaining - 1, value]
+                continue
+            column = next(col_iter, None)
+            value = _cell_text(column) if column is not None else ""
+            span = int(column.get("rowspan", "1")) if column is not None else 1
+            if span > 1:
+                pending[i] = [span - 1, value]
+            cells.append(value)
+        rows.append(cells)
+    return rows
+
+
+def _is_child_detail(detail: str) -> bool:
+    # 見出し直下の「その他のもの」「〜用のもの」などは見出しに従属する
+    return "のもの" in detail or detail.startswith("その他")
+
+
+def parse_law_xml(content: str, file_name: str = "") -> list:
+    """
+    耐用年数表xml（AppdxTable/TableRow/TableColumn/Sentence）を
+    LifetimeRecordのリストに変換する
+    """
+    root = ET.fromstring(content.encode("utf-8") if isinstance(content, str) else content)
+    records = []
+    for appdx in root.iter("AppdxTable"):
+        title = " ".join(
+            t.strip() for t in (appdx.findtext("AppdxTableTitle"), appdx.findtext("RelatedArticleNum")) if t and t.strip()
+        )
+        for table in appdx.iter("Table"):
+            rows = _expand_rows(table)
+            if not rows:
+                continue
+            fields = [COLUMN_FIELDS.get(name.replace(" ", ""), "") for name in rows[0]]
+            current = {"number": "", "category": "", "structure": ""}
+            heading = ""
+            for cells in rows[1:]:
+                values = {f: v for f, v in zip(fields, cells) if f}
+                if values.get("years") == "年":
+                    continue  # 単位行
+                # 左側の列は空欄なら直前の行を引き継ぐ
+                for key in current:
+                    if values.get(key):
+                        if key != "number" and values[key] != current[key]:
+                            heading = ""
+                        current[key] = values[key]
+                detail = values.get("detail", "")
+                years = kanji_to_int(values.get("years", ""))
+                if detail and heading and not _is_child_detail(detail):
+                    heading = ""
+                record = LifetimeRecord(
+                    table=title,
+                    file_name=file_name,
+                    category=current["category"],
+                    structure=current["structure"],
+                    heading=heading,
+                    detail=detail,
+                    years=years,
+                    number=current["number"],
+                )
+                records.append(record)
+                if detail and years is None:
+                    # 耐用年数の記載がない細目は後続行の見出しになる
+                    heading = record.detail_label()
+    return records
+
+
+def dedupe_records(records: list) -> list:
+    """
+    複数のxmlに同じ別表の行が重複して含まれるため、内容が同じレコードを1件にまとめる
+    """
+    seen = set()
+    unique = []
+    for record in records:
+        key = (record.table, record.category, record.structure, record.heading, record.detail, record.years)
+        if key not in seen:
+            seen.add(key)
+            unique.append(record)
+    return unique
+
+
+def _ngrams(text: str, n: int = 2) -> set:
+    text = "^" + normalize_text(text) + "$"
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def _record_grams(record: LifetimeRecord) -> set:
+    grams = set()
+    for field in (record.category, record.structure, record.heading, record.detail):
+        if field:
+            grams |= _ngrams(field)
+    return grams
+
+
+class LifetimeIndex:
+    """
+    耐用年数表レコードとn-gram転置インデックス
+    """
+
+    def __init__(self, records: list):
+        self.records = records
+        self.postings = defaultdict(list)
+        for i, record in enumerate(records):
+            for gram in _record_grams(record):
+                self.postings[gram].append(i)
+        # 完全一致判定用: 正規化した細目（括弧書き除去）/ 細目のない種類
+        self.exact_keys = defaultdict(list)
+        for i, record in enumerate(records):
+            if record.years is None:
+                continue
+            key = record.detail or record.category
+            for variant in {normalize_text(key), normalize_text(strip_parenthetical(key))}:
+                if variant:
+                    self.exact_keys[variant].append(i)
+
+    def _query_text(self, item: str) -> str:
+        alias = ALIASES.get(normalize_text(item))
+        return f"{item} {alias}" if alias else item
+
+    def exact_match(self, item: str) -> LifetimeRecord | None:
+        """
+        品目名が細目と完全一致し、耐用年数が一意に決まる場合のみレコードを返す
+        """
+        for key in (normalize_text(item), normalize_text(ALIASES.get(normalize_text(item), ""))):
+            ids = self.exact_keys.get(key) if key else None
+            if ids and len({self.records[i].years for i in ids}) == 1:
+                return self.records[ids[0]]
+        return None
+
+    def search(self, item: str, k: int = 5) -> list:
+        """
+        品目名とのn-gram一致度が高い順に最大k件のレコードを返す
+        """
+        query = _ngrams(self._query_text(item))
+        scores = defaultdict(int)
+        for gram in query:
+            for i in self.postings.get(gram, ()):
+                scores[i] += 1
+        ranked = []
+        for i, hits in scores.items():
+            record = self.records[i]
+            # 細目側の一致（Dice係数）を重視し、耐用年数のない見出し行は後回しにする
+            detail = _ngrams(record.detail_label() or record.category)
+            score = 2 * len(query & detail) / (len(query) + len(detail)) + 0.3 * hits / len(query)
+            if record.years is None:
+                score *= 0.5
+            ranked.append((score, i))
+        ranked.sort(key=lambda x: (-x[0], x[1]))
+        return [self.records[i] for _, i in ranked[:k]]
+
+    def to_dict(self) -> dict:
+        return {"records": [asdict(r) for r in self.records]}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LifetimeIndex":
+        return cls([LifetimeRecord(**r) for r in data["records"]])
+
+
+def _source_signature(directory: str) -> dict:
+    signature = {}
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(".xml"):
+            stat = os.stat(os.path.join(directory, filename))
+            signature[filename] = [stat.st_size, stat.st_mtime_ns]
+    return signature
+
+
+def build_lifetime_index(directory: str = "document", index_path: str = LIFETIME_INDEX_PATH) -> LifetimeIndex:
+    """
+    ディレクトリ内の耐用年数表xmlをすべて解析し、インデックスをディスクに保存して返す
+    """
+    records = []
+    for filename in _source_signature(directory):
+        with open(os.path.join(directory, filename), encoding="utf-8") as f:
+            records.extend(parse_law_xml(f.read(), filename))
+    index = LifetimeIndex(dedupe_records(records))
+
+    os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+    data = {
+        "version": LIFETIME_INDEX_VERSION,
+        "sources": _source_signature(directory),
+        **index.to_dict(),
+    }
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, index_path)
+    print(f"耐用年数インデックス作成: {len(index.records)}件 -> {index_path}")
+    return index
+
+
+_loaded = {}
+
+
+def load_lifetime_index(directory: str = "document", index_path: str = LIFETIME_INDEX_PATH) -> LifetimeIndex:
+    """
+    保存済みインデックスを読み込む。xmlが追加・更新されていれば再構築する
+    """
+    signature = _source_signature(directory)
+    cached = _loaded.get(index_path)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    index = None
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == LIFETIME_INDEX_VERSION and data.get("sources") == signature:
+                index = LifetimeIndex.from_dict(data)
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            print(f"耐用年数インデックスの読み込みに失敗したため再作成します: {e}")
+    if index is None:
+        index = build_lifetime_index(directory, index_path)
+    _loaded[index_path] = (signature, index)
+    return index
+
+
+def index_from_law_list(law_list: list) -> LifetimeIndex:
+    """
+    collect_law_texts_list 形式（ファイル名/内容）のリストからメモリ上のインデックスを作る
+    """
+    records = []
+    for item in law_list:
+        records.extend(parse_law_xml(item["内容"], item["ファイル名"]))
+    return LifetimeIndex(dedupe_records(records))
+
+
+def split_items(text: str, limit: int = 50) -> list:
+    """
+    証憑テキスト・抽出結果・CSVから品目名のリストを取り出す
+    """
+    names = re.findall(r"品目名?[:：]\s*([^\n]+)", text)
+    if not names:
+        lines = [line for line in text.splitlines() if line.strip()]
+        if lines and "品目名" in lines[0] and "," in lines[0]:
+            names = [row.get("品目名", "") for row in csv.DictReader(lines)]
+        else:
+            names = lines
+    items = []
+    for name in names:
+        name = name.strip().strip("　").strip()
+        if name and name not in items:
+            items.append(name)
+    return items[:limit]
+
+
+if __name__ == "__main__":
+    index = build_lifetime_index()
+    for item in ["パソコン", "エアコン", "木造住宅", "応接セット"]:
+        print(f"==== {item} ====")
+        exact = index.exact_match(item)
+        if exact:
+            print("完全一致:", exact.to_prompt_line())
+        for record in index.search(item):
+            print(record.to_prompt_line())
@@ -0,0 +1,303 @@
+import os
+import time
+import random
+import asyncio
+import threading
+import httpx
+import openai
+from dotenv import load_dotenv
+
+from prompt_budget import count_tokens
+from tracing import span, set_attrs
+
+# .envから環境変数を読み込む
+load_dotenv()
+
+# Azure OpenAI のクォータ（デプロイメントの設定に合わせて環境変数で変更する）
+AZURE_OPENAI_RPM = int(os.getenv("AZURE_OPENAI_RPM", "60"))
+AZURE_OPENAI_TPM = int(os.getenv("AZURE_OPENAI_TPM", "80000"))
+# 1回の呼び出しのタイムアウト（秒）と、接続プールの大きさ
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "5"))
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def _client_settings() -> dict:
+    return {
+        "api_key": os.environ.get("AZURE_OPENAI_API_KEY"),
+        "api_version": os.environ.get("AZURE_OPENAI_API_VERSION", "2024-02-15-preview"),
+        "azure_endpoint": os.environ.get("AZURE_OPENAI_ENDPOINT"),
+        # 再試行はレート制限と連動させるため chat_completion 側で行う
+        "max_retries": 0,
+    }
+
+
+def http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_CONNECTIONS,
+        keepalive_expiry=60,
+    )
+
+
+def http_timeout() -> httpx.Timeout:
+    return httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+
+
+def get_client() -> openai.AzureOpenAI:
+    """
+    プロセスで共有する AzureOpenAI クライアントを返す
+    （keep-aliveの接続プールを使い回すため、呼び出しごとにクライアントを作らない）
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = openai.AzureOpenAI(
+                **_client_settings(),
+                http_client=httpx.Client(limits=http_limits(), timeout=http_timeout()),
+            )
+    return _client
+
+
+class RateLimiter:
+    """
+    1分あたりのリクエスト数・トークン数のトークンバケット
+    429応答を受けた場合は Retry-After の間、全呼び出しをまとめて待たせる
+    """
+
+    def __init__(self, requests_per_minute: int = AZURE_OPENAI_RPM, tokens_per_minute: int = AZURE_OPENAI_TPM):
+        self.capacity = {"requests": float(requests_per_minute), "tokens": float(tokens_per_minute)}
+        self.available = dict(self.capacity)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        for key, capacity in self.capacity.items():
+            self.available[key] = min(capacity, self.available[key] + capacity * elapsed / 60)
+
+    def try_acquire(self, tokens: int) -> float:
+        """
+        枠が空いていれば消費して0を返し、空いていなければ待つべき秒数を返す
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.paused_until:
+                return self.paused_until - now
+            need = {"requests": 1.0, "tokens": float(min(tokens, self.capacity["tokens"]))}
+            wait = max(
+                (need[key] - self.available[key]) * 60 / self.capacity[key]
+                for key in need
+            )
+            if wait > 0:
+                return wait
+            for key in need:
+                self.available[key] -= need[key]
+            return 0.0
+
+    def acquire(self, tokens: int) -> None:
+        while (wait := self.try_acquire(tokens)) > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens: int) -> None:
+        while (wait := self.try_acquire(tokens)) > 0:
+            await asyncio.sleep(wait)
+
+    def refund(self, tokens: int) -> None:
+        # 見積もりより実際の使用トークンが少なかった分を戻す
+        with self._lock:
+            self.available["tokens"] = min(self.capacity["tokens"], self.available["tokens"] + max(0, tokens))
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+_limiter = RateLimiter()
+
+
+def get_rate_limiter() -> RateLimiter:
+    return _limiter
+
+
+def iter_completion_text(stream):
+    """
+    stream=True で呼び出した chat.completions の応答から、テキストの差分を届いた順に返す
+    （Azureではコンテンツフィルタ結果だけのチャンクが混ざるため choices が空のものは読み飛ばす）
+    """
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta is not None and delta.content:
+            yield delta.content
+
+
+def format_api_error(e: Exception) -> str:
+    """
+    OpenAI APIのエラー内容を画面表示用の文字列にする
+    """
+    import traceback
+    error_message = f"OpenAI APIリクエストでエラーが発生しました。\n"
+    error_message += f"型: {type(e)}\n"
+    error_message += f"内容: {str(e)}\n"
+    tb = traceback.format_exc()
+    error_message += f"トレースバック:\n{tb}\n"
+    # openaiのAPIエラーの場合、response属性があれば詳細も出す
+    if hasattr(e, "response") and hasattr(e.response, "text"):
+        error_message += f"APIレスポンス: {e.response.text}\n"
+    return error_message
+
+
+def _retry_after_seconds(e: Exception) -> float | None:
+    # 429応答の Retry-After / retry-after-ms ヘッダーがあればその秒数を返す
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def is_retryable_error(e: Exception) -> bool:
+    """
+    レート制限（429）・タイムアウト・接続エラー・5xx など、再試行で回復しうるエラーかどうか
+    """
+    if isinstance(e, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    status = getattr(e, "status_code", None) or getattr(getattr(e, "response", None), "status_code", None)
+    return status == 429 or (isinstance(status, int) and status >= 500)
+
+
+def _backoff_delay(e: Exception, attempt: int, base_delay: float, max_delay: float) -> float:
+    delay = _retry_after_seconds(e)
+    if delay is None:
+        delay = min(max_delay, base_delay * (2 ** attempt)) * random.uniform(0.5, 1.0)
+    if isinstance(e, openai.RateLimitError) or getattr(e, "status_code", None) == 429:
+        # 他の呼び出しも同じ時間待たせ、クォータ超過中に再送が集中しないようにする
+        _limiter.pause(delay)
+    return delay
+
+
+def call_with_retry(func, *args, retries: int = LLM_RETRIES, base_delay: float = 1.0, max_delay: float = 60.0, **kwargs):
+    """
+    func を呼び出し、再試行可能なエラーの場合は指数バックオフ（ジッター付き）で再試行する
+    Retry-After ヘッダーがあればその時間だけ待つ
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt >= retries or not is_retryable_error(e):
+                raise
+            delay = _backoff_delay(e, attempt, base_delay, max_delay)
+            print(f"再試行します（{attempt + 1}/{retries}, {delay:.1f}秒後）: {type(e).__name__}: {e}")
+            set_attrs(retries=attempt + 1)
+            time.sleep(delay)
+
+
+async def call_with_retry_async(func, *args, retries: int = LLM_RETRIES, base_delay: float = 1.0, max_delay: float = 60.0, **kwargs):
+    """
+    call_with_retry の非同期版（func はコルーチン関数）
+    """
+    for attempt in range(retries + 1):
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            if attempt >= retries or not is_retryable_error(e):
+                raise
+            delay = _backoff_delay(e, attempt, base_delay, max_delay)
+            print(f"再試行します（{attempt + 1}/{retries}, {delay:.1f}秒後）: {type(e).__name__}: {e}")
+            set_attrs(retries=attempt + 1)
+            await asyncio.sleep(delay)
+
+
+def _estimate_request_tokens(messages: list, max_tokens: int) -> int:
+    return sum(count_tokens(m.get("content") or "") for m in messages) + max_tokens
+
+
+def _settle_usage(response, estimated: int, attrs: dict) -> None:
+    usage = getattr(response, "usage", None)
+    if usage is not None and getattr(usage, "total_tokens", None):
+        _limiter.refund(estimated - usage.total_tokens)
+        attrs["prompt_tokens"] = usage.prompt_tokens
+        attrs["completion_tokens"] = usage.completion_tokens
+
+
+def chat_completion(
+    messages: list,
+    model: str = None,
+    temperature: float = 0.2,
+    max_tokens: int = 2048,
+    stream: bool = False,
+    timeout: float = None,
+    retries: int = LLM_RETRIES,
+):
+    """
+    共有クライアントで chat.completions.create を呼び出す
+    レート制限（RPM/TPM）の枠を確保してから送信し、429・タイムアウト等はバックオフして再試行する
+    stream=True の場合はストリームを返す（再試行は最初の応答を受け取るまで）
+    呼び出しは「llm_call」スパンとして記録する（ストリームの場合は応答開始までの時間）
+    """
+    estimated = _estimate_request_tokens(messages, max_tokens)
+
+    def create():
+        _limiter.acquire(estimated)
+        return get_client().chat.completions.create(
+            model=model or os.environ.get("AZURE_OPENAI_DEPLOYMENT"),
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=stream,
+            timeout=timeout or LLM_TIMEOUT,
+        )
+
+    with span("llm_call", stream=stream, max_tokens=max_tokens) as attrs:
+        response = call_with_retry(create, retries=retries)
+        if stream:
+            attrs["prompt_tokens"] = estimated - max_tokens
+        else:
+            _settle_usage(response, estimated, attrs)
+    return response
+
+
+async def chat_completion_async(
+    messages: list,
+    model: str = None,
+    temperature: float = 0.2,
+    max_tokens: int = 2048,
+    timeout: float = None,
+    retries: int = LLM_RETRIES,
+):
+    """
+    chat_completion の非同期版（共有の AsyncAzureOpenAI クライアントを使う）
+    """
+    from async_llm import get_async_client
+
+    estimated = _estimate_request_tokens(messages, max_tokens)
+
+    async def create():
+        await _limiter.acquire_async(estimated)
+        return await get_async_client().chat.completions.create(
+            model=model or os.environ.get("AZURE_OPENAI_DEPLOYMENT"),
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            timeout=timeout or LLM_TIMEOUT,
+        )
+
+    with span("llm_call", stream=False, max_tokens=max_tokens) as attrs:
+        response = await call_with_retry_async(create, retries=retries)
+        _settle_usage(response, estimated, attrs)
+    return response
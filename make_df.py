@@ -3,6 +3,8 @@ from dotenv import load_dotenv
 import pandas as pd
 import re
 
+from tracing import span
+
 
 # .env 読み込み
 load_dotenv()
@@ -17,16 +19,56 @@ def parse_llm_output_to_dataframe(text: str) -> pd.DataFrame:
         r"・根拠[:：]\s*(.*?)\n(?=\s*品目名|$)",  # 次の品目名または終端まで
         re.DOTALL
     )
-    rows = []
-    for match in pattern.finditer(text):
-        rows.append({
-            "品目名": match.group(1).strip(),
-            "金額": match.group(2).strip(),
-            "勘定科目": match.group(3).strip(),
-            "法定耐用年数": match.group(4).strip(),
-            "根拠": match.group(5).strip(),
-        })
-    return pd.DataFrame(rows)
+    with span("parse", chars=len(text)) as attrs:
+        rows = []
+        for match in pattern.finditer(text):
+            rows.append({
+                "品目名": match.group(1).strip(),
+                "金額": match.group(2).strip(),
+                "勘定科目": match.group(3).strip(),
+                "法定耐用年数": match.group(4).strip(),
+                "根拠": match.group(5).strip(),
+            })
+        attrs["rows"] = len(rows)
+        return pd.DataFrame(rows)
+
+class LLMOutputRowStream:
+    """
+    ストリーミング中のLLM出力を受け取り、品目名ブロックが完成した時点で行（dict）を返す
+    次の「品目名」が現れた時点で直前のブロックは完成したとみなす
+
+    使い方:
+        rows = LLMOutputRowStream()
+        for token in asset_judge_stream(...):
+            new_rows = rows.feed(token)
+        new_rows = rows.close()
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.rows = []
+        self._last_start = 0
+
+    def _parse(self, text: str) -> list:
+        parsed = parse_llm_output_to_dataframe(text).to_dict("records")
+        new_rows = parsed[len(self.rows):]
+        self.rows.extend(new_rows)
+        return new_rows
+
+    def feed(self, token: str) -> list:
+        self.text += token
+        last_start = self.text.rfind("品目名")
+        if last_start <= self._last_start:
+            return []
+        self._last_start = last_start
+        # 最後の「品目名」より前は完成したブロックのみ
+        return self._parse(self.text[:last_start].rstrip() + "\n")
+
+    def close(self) -> list:
+        return self._parse(self.text.rstrip() + "\n")
+
+    def dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame(self.rows)
 
 def parse_extracted_items_to_dataframe(text: str) -> pd.DataFrame:
     pattern = re.compile(r"品目名:\s*(.*?)\s+金額:\s*([\d,]+円|該当情報なし)")
@@ -0,0 +1,128 @@
+import os
+import threading
+from dataclasses import dataclass
+
+import tiktoken
+from dotenv import load_dotenv
+
+# .envから環境変数を読み込む
+load_dotenv()
+
+# gpt-4o 系のトークナイザー（別モデルを使う場合は環境変数で変更）
+PROMPT_ENCODING = os.getenv("PROMPT_ENCODING", "o200k_base")
+# プロンプト全体の既定の上限トークン数（呼び出しごとに上書き可能）
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "24000"))
+# 指示文・出力形式などセクション以外の固定部分に見込むトークン数
+PROMPT_TEMPLATE_RESERVE = int(os.getenv("PROMPT_TEMPLATE_RESERVE", "1000"))
+TRUNCATION_MARK = "\n…（文字数制限のため省略）…\n"
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def get_encoding() -> tiktoken.Encoding:
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding(PROMPT_ENCODING)
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """
+    テキストのトークン数を数える
+    """
+    return len(get_encoding().encode(text or "", disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int, keep: str = "head") -> str:
+    """
+    テキストを max_tokens トークン以内に切り詰める
+    keep="head" は先頭を、keep="tail" は末尾（会話履歴の最新部分など）を残す
+    """
+    encoding = get_encoding()
+    tokens = encoding.encode(text or "", disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    mark_tokens = len(encoding.encode(TRUNCATION_MARK))
+    kept = max(0, max_tokens - mark_tokens)
+    if keep == "tail":
+        return TRUNCATION_MARK + encoding.decode(tokens[len(tokens) - kept:], errors="ignore")
+    return encoding.decode(tokens[:kept], errors="ignore") + TRUNCATION_MARK
+
+
+@dataclass
+class PromptSection:
+    """
+    プロンプトの1セクション（優先度の低いものから切り詰める）
+    """
+    name: str
+    text: str
+    priority: int = 0               # 大きいほど残す
+    max_tokens: int | None = None   # セクションごとの上限
+    min_tokens: int = 0             # 全体の予算が足りない場合でも残すトークン数
+    keep: str = "head"              # 切り詰め時に先頭/末尾のどちらを残すか
+
+
+class PromptBudget:
+    """
+    セクションごとにトークン数を数え、上限（セクション別・全体）に収まるよう優先度の低い順に切り詰める
+
+    使い方:
+        budget = PromptBudget("asset_judge")
+        s = budget.fit([PromptSection("law", law_text, priority=1, max_tokens=6000), ...])
+        prompt = f"...{s['law']}..."
+        budget.finalize(prompt)
+    """
+
+    def __init__(self, label: str, total_tokens: int = None, reserve_tokens: int = PROMPT_TEMPLATE_RESERVE):
+        self.label = label
+        self.total_tokens = total_tokens or PROMPT_TOKEN_BUDGET
+        self.reserve_tokens = reserve_tokens
+        self.usage = {}  # セクション名 -> (元のトークン数, 切り詰め後のトークン数)
+        self.prompt_tokens = 0
+
+    def fit(self, sections: list) -> dict:
+        """
+        セクション名 -> 切り詰め後のテキスト の辞書を返す
+        """
+        texts = {}
+        counts = {}
+        original = {}
+        for section in sections:
+            text = section.text or ""
+            original[section.name] = count_tokens(text)
+            if section.max_tokens is not None and original[section.name] > section.max_tokens:
+                text = truncate_tokens(text, section.max_tokens, section.keep)
+            texts[section.name] = text
+            counts[section.name] = count_tokens(text)
+
+        available = self.total_tokens - self.reserve_tokens
+        overflow = sum(counts.values()) - available
+        for section in sorted(sections, key=lambda s: s.priority):
+            if overflow <= 0:
+                break
+            target = max(section.min_tokens, counts[section.name] - overflow)
+            if target >= counts[section.name]:
+                continue
+            texts[section.name] = truncate_tokens(texts[section.name], target, section.keep)
+            new_count = count_tokens(texts[section.name])
+            overflow -= counts[section.name] - new_count
+            counts[section.name] = new_count
+
+        self.usage = {name: (original[name], counts[name]) for name in counts}
+        return texts
+
+    def finalize(self, prompt: str) -> int:
+        """
+        組み立て後のプロンプト全体のトークン数を数えてログに出す
+        """
+        self.prompt_tokens = count_tokens(prompt)
+        details = ", ".join(
+            f"{name}={after}" + (f"(元{before})" if before != after else "")
+            for name, (before, after) in self.usage.items()
+        )
+        print(f"[prompt] {self.label}: {self.prompt_tokens}/{self.total_tokens}トークン ({details})")
+        return self.prompt_tokens
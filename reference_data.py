@@ -0,0 +1,170 @@
+import os
+import csv
+import hashlib
+import threading
+import pandas as pd
+
+from tracing import span
+
+LAW_TEXT_PATH = "document/減価償却に関する法令.txt"
+ACCOUNT_TITLES_PATH = "document/勘定科目一覧.csv"
+EXAMPLE_DIR = "document/example_accounting_entry/"
+
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ReferenceStore:
+    """
+    参照データ（法令テキスト・勘定科目一覧・仕訳例Excelなど）を1度だけ読み込み、
+    プロンプト用に整形した結果と合わせてメモリに保持する
+    ファイルのmtime/サイズが変わった場合のみハッシュを確認し、内容が変わっていれば読み直す
+    """
+
+    def __init__(self):
+        # 整形用のloaderが元データを同じストアから取得するため再入可能なロックにする
+        self._lock = threading.RLock()
+        self._entries = {}  # (path, loader名) -> {"stat", "sha256", "value"}
+        self.load_count = 0
+
+    def get(self, path: str, loader):
+        """
+        path を loader(path) で読み込んだ結果を返す（変更がなければキャッシュを返す）
+        """
+        key = (os.path.abspath(path), getattr(loader, "__qualname__", repr(loader)))
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry["stat"] == signature:
+                return entry["value"]
+            sha256 = _file_sha256(path)
+            if entry and entry["sha256"] == sha256:
+                # 触られただけで内容は同じ
+                entry["stat"] = signature
+                return entry["value"]
+            value = loader(path)
+            self._entries[key] = {"stat": signature, "sha256": sha256, "value": value}
+            self.load_count += 1
+            return value
+
+    def invalidate(self, path: str = None) -> None:
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                return
+            target = os.path.abspath(path)
+            for key in [k for k in self._entries if k[0] == target]:
+                del self._entries[key]
+
+
+_store = ReferenceStore()
+
+
+def get_reference_store() -> ReferenceStore:
+    return _store
+
+
+# --- 個別の読み込み関数（ReferenceStore経由で呼ばれる） ---
+def _read_text(path: str) -> str:
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def _read_account_titles(path: str) -> list:
+    with open(path, encoding="utf-8-sig") as f:
+        return list(csv.DictReader(f))
+
+
+def _render_account_titles(path: str) -> str:
+    account_texts = "【勘定科目一覧】\n"
+    for row in get_account_titles(path):
+        account_texts += f"{row['勘定科目']}: {row['解説']}\n"
+    return account_texts
+
+
+def _read_excel(path: str) -> pd.DataFrame:
+    with span("excel_load", file=os.path.basename(path)) as attrs:
+        df = pd.read_excel(path)
+        attrs["rows"] = len(df)
+    return df
+
+
+def _render_excel(path: str) -> str:
+    return _store.get(path, _read_excel).to_string(index=False)
+
+
+# --- 公開API ---
+def get_law_text(path: str = LAW_TEXT_PATH) -> str:
+    """
+    減価償却に関する法令テキスト（見つからない場合はその旨のメッセージ）
+    """
+    if not os.path.exists(path):
+        return "（法令テキストが見つかりませんでした）"
+    return _store.get(path, _read_text)
+
+
+def get_account_titles(path: str = ACCOUNT_TITLES_PATH) -> list:
+    """
+    勘定科目一覧CSVの行（dict）のリスト
+    """
+    return _store.get(path, _read_account_titles)
+
+
+def get_account_texts(path: str = ACCOUNT_TITLES_PATH) -> str:
+    """
+    勘定科目一覧のプロンプト用テキスト
+    """
+    return _store.get(path, _render_account_titles)
+
+
+def get_accounting_example_frames(example_dir: str = EXAMPLE_DIR) -> dict:
+    """
+    仕訳例Excelを {ファイル名: DataFrame} で返す（変更のあったファイルだけ読み直す）
+    """
+    os.makedirs(example_dir, exist_ok=True)
+    frames = {}
+    for file in sorted(os.listdir(example_dir)):
+        if not file.endswith(('.xlsx', '.xls')):
+            continue
+        try:
+            frames[file] = _store.get(os.path.join(example_dir, file), _read_excel)
+        except Exception as e:
+            print(f"{file} の読み込み中にエラーが発生しました: {e}")
+    return frames
+
+
+def get_accounting_examples_text(example_dir: str = EXAMPLE_DIR) -> str:
+    """
+    仕訳例Excelすべてをプロンプト用テキストにまとめる
+    """
+    os.makedirs(example_dir, exist_ok=True)
+    accounting_examples_text = ""
+    for file in sorted(os.listdir(example_dir)):
+        if not file.endswith(('.xlsx', '.xls')):
+            continue
+        try:
+            rendered = _store.get(os.path.join(example_dir, file), _render_excel)
+        except Exception as e:
+            print(f"{file} の読み込み中にエラーが発生しました: {e}")
+            continue
+        accounting_examples_text += f"\n■ {file} の仕訳例:\n"
+        accounting_examples_text += rendered
+        accounting_examples_text += "\n"
+    return accounting_examples_text
+
+
+def get_xml_texts(directory: str = "document") -> dict:
+    """
+    ディレクトリ内のxmlファイルを {ファイル名: 内容} で返す
+    """
+    return {
+        filename: _store.get(os.path.join(directory, filename), _read_text)
+        for filename in sorted(os.listdir(directory))
+        if filename.endswith('.xml')
+    }
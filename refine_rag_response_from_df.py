@@ -1,12 +1,15 @@
 import pandas as pd
 import os
 from dotenv import load_dotenv
-from openai import OpenAI  # ← 新しいクライアントのインポート
-from make_df import parse_llm_output_to_dataframe   
-import openai
+from llm_client import chat_completion, iter_completion_text
+from prompt_budget import PromptBudget, PromptSection, count_tokens
+from tracing import span, start_trace
 load_dotenv()
 
-def refine_rag_response_from_df(df: pd.DataFrame, history_text: str = "") -> str:
+def build_refine_prompt(df: pd.DataFrame, history_text: str = "") -> str:
+    """
+    編集済みの判定結果から、固定資産台帳登録用の整理を依頼するプロンプトを組み立てる
+    """
     # DataFrame を整形済み文字列に変換
     items_text = ""
     for _, row in df.iterrows():
@@ -16,7 +19,12 @@ def refine_rag_response_from_df(df: pd.DataFrame, history_text: str = "") -> str
         ・法定耐用年数: {row["法定耐用年数"]}
         ・根拠: {row["根拠"]}
     """
-    print(items_text)
+
+    budget = PromptBudget("refine_rag_response")
+    s = budget.fit([
+        PromptSection("items_text", items_text, priority=10, max_tokens=12000),
+        PromptSection("history_text", history_text, priority=1, max_tokens=3000, keep="tail"),
+    ])
 
     prompt = f"""
         あなたは日本の会計に精通した経理アシスタントAIです。
@@ -30,9 +38,9 @@ def refine_rag_response_from_df(df: pd.DataFrame, history_text: str = "") -> str
         - 出力形式は下記の通り。
 
         【編集後データ】
-        {items_text}
+        {s['items_text']}
 
-        {history_text}
+        {s['history_text']}
 
         【出力形式】
         以下の形式で出力してください：
@@ -43,38 +51,52 @@ def refine_rag_response_from_df(df: pd.DataFrame, history_text: str = "") -> str
         ・法定耐用年数：4年  
         ・根拠：〇〇〇〇
         """
+    budget.finalize(prompt)
+    return prompt
+
+def refine_rag_response_from_df(df: pd.DataFrame, history_text: str = "") -> str:
+    with start_trace("refine", items=len(df)):
+        with span("prompt_build"):
+            prompt = build_refine_prompt(df, history_text)
+
+        deployment = os.environ.get("AZURE_OPENAI_DEPLOYMENT")
+
+        response = chat_completion(
+            model=deployment,
+            messages=[
+                {"role": "system", "content": "あなたは会計処理の専門AIです。"},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.1,
+            max_tokens=2048
+        )
+        response_text = response.choices[0].message.content
+
+    return response_text
+
+def refine_rag_response_from_df_stream(df: pd.DataFrame, history_text: str = ""):
+    """
+    refine_rag_response_from_df のストリーミング版。最終整理結果のトークンを届いた順に返すジェネレータ
+    """
+    with start_trace("refine", items=len(df)):
+        with span("prompt_build"):
+            prompt = build_refine_prompt(df, history_text)
+
+        deployment = os.environ.get("AZURE_OPENAI_DEPLOYMENT")
 
-    api_key = os.environ.get("AZURE_OPENAI_API_KEY")
-    azure_endpoint = os.environ.get("AZURE_OPENAI_ENDPOINT")
-    deployment = os.environ.get("AZURE_OPENAI_DEPLOYMENT")
-    api_version = os.environ.get("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
-    # 新しいクライアントで初期化
-    client = openai.AzureOpenAI(
-        api_key=api_key,
-        api_version=api_version,
-        azure_endpoint=azure_endpoint,
-    )
-
-    # chat.completions.create に変更
-    response = client.chat.completions.create(
-        model=deployment,
-        messages=[
-            {"role": "system", "content": "あなたは会計処理の専門AIです。"},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0.1,
-        max_tokens=2048
-    )
-    print("responseの内容を出力")
-    print(response)
-    
-    response_text = response.choices[0].message.content
-    print("response_textの内容を出力")
-    print(response_text)
-    # 表形式に変換
-    df = parse_llm_output_to_dataframe(response_text)
-    # 表示
-    print("\n=== 表形式に整形（台帳登録用）===")
-    print(df)
-
-    return response_text
\ No newline at end of file
+        stream = chat_completion(
+            model=deployment,
+            messages=[
+                {"role": "system", "content": "あなたは会計処理の専門AIです。"},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.1,
+            max_tokens=2048,
+            stream=True
+        )
+        response_text = ""
+        with span("llm_stream") as attrs:
+            for token in iter_completion_text(stream):
+                response_text += token
+                yield token
+            attrs["completion_tokens"] = count_tokens(response_text)
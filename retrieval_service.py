@@ -0,0 +1,290 @@
+import os
+import time
+import uuid
+import shutil
+import threading
+from dotenv import load_dotenv
+
+from lazy_import import lazy_object
+from embedding_cache import CachedEmbeddings
+from hybrid_retrieval import load_bm25_index, hybrid_search, get_reranker
+from vector_index import read_index_meta, apply_search_params
+from tracing import span
+
+load_dotenv()
+
+# langchain のFAISS・埋め込みクライアントは読み込みに時間がかかるため、インデックスを最初に使うときに読み込む
+FAISS = lazy_object("langchain_community.vectorstores.faiss", "FAISS")
+AzureOpenAIEmbeddings = lazy_object("langchain_community.embeddings.azure_openai", "AzureOpenAIEmbeddings")
+
+STORAGE_DIR = "storage"
+EMBEDDING_DEPLOYMENT = "text-embedding-3-large-astena"
+# faiss_index_builder.py が保存完了後に書き込むバージョンスタンプ
+VERSION_FILE = "index.version"
+INDEX_FILES = ("index.faiss", "index.pkl")
+# 版ごとのインデックスを置くディレクトリ（storage_dir/versions/<版>）と、検索に使う版を指すポインタファイル
+# ポインタファイルがなければ storage_dir 直下のインデックスを使う（従来の配置）
+VERSIONS_DIR = "versions"
+CURRENT_FILE = "CURRENT"
+# 残しておく版の数（切り替えの直前に旧版を読み込み始めた検索が、読み終える前に消されないようにする）
+KEEP_VERSIONS = 2
+STAGING_PREFIX = "building-"
+
+
+def write_version_stamp(storage_dir: str = STORAGE_DIR) -> str:
+    """
+    インデックス保存完了の印としてバージョンスタンプを書き込む
+    （一時ファイル経由で置き換えるため、読み手が書きかけを見ることはない）
+    """
+    version = str(time.time_ns())
+    path = os.path.join(storage_dir, VERSION_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(tmp_path, path)
+    return version
+
+
+def read_version_stamp(storage_dir: str = STORAGE_DIR) -> str | None:
+    try:
+        with open(os.path.join(storage_dir, VERSION_FILE), encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _read_current(storage_dir: str) -> str | None:
+    try:
+        with open(os.path.join(storage_dir, CURRENT_FILE), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def resolve_index_dir(storage_dir: str = STORAGE_DIR) -> str:
+    """
+    検索に使うインデックスのディレクトリを返す（ポインタファイルが指す版、なければ storage_dir 自体）
+    """
+    current = _read_current(storage_dir)
+    return os.path.join(storage_dir, VERSIONS_DIR, current) if current else storage_dir
+
+
+def create_staging_dir(storage_dir: str = STORAGE_DIR) -> str:
+    """
+    検索に使っているインデックスを作業用ディレクトリ（storage_dir/versions/building-*）に複製して返す
+    差分更新はこの複製に対して行い、検索中の版のファイルは書き換えない
+    """
+    current_dir = resolve_index_dir(storage_dir)
+    staging_dir = os.path.join(storage_dir, VERSIONS_DIR, STAGING_PREFIX + uuid.uuid4().hex[:12])
+    os.makedirs(os.path.dirname(staging_dir), exist_ok=True)
+    if os.path.isdir(current_dir):
+        shutil.copytree(
+            current_dir, staging_dir, ignore=shutil.ignore_patterns(VERSIONS_DIR, CURRENT_FILE, "*.tmp")
+        )
+    else:
+        os.makedirs(staging_dir)
+    return staging_dir
+
+
+def publish_index_dir(staging_dir: str, storage_dir: str = STORAGE_DIR) -> str:
+    """
+    作成し終えた作業用ディレクトリを版のディレクトリにし、ポインタファイルをその版に切り替える
+    切り替えはポインタファイルの os.replace 1回だけなので、検索側は必ず旧版か新版のどちらか一方を丸ごと読む
+    切り替えた版のディレクトリを返す
+    """
+    version = read_version_stamp(staging_dir) or str(time.time_ns())
+    version_dir = os.path.join(storage_dir, VERSIONS_DIR, version)
+    os.replace(staging_dir, version_dir)
+    path = os.path.join(storage_dir, CURRENT_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(tmp_path, path)
+    _prune_versions(storage_dir, version)
+    return version_dir
+
+
+def _prune_versions(storage_dir: str, current: str) -> None:
+    # 作業用ディレクトリ（作成中の別ジョブ）は消さない。版の名前はバージョンスタンプ（time_ns）なので数値順に並ぶ
+    versions_path = os.path.join(storage_dir, VERSIONS_DIR)
+    versions = sorted(
+        (name for name in os.listdir(versions_path) if name.isdigit()), key=int, reverse=True
+    )
+    for name in versions[KEEP_VERSIONS:]:
+        if name != current:
+            shutil.rmtree(os.path.join(versions_path, name), ignore_errors=True)
+
+
+class RetrievalService:
+    """
+    FAISSインデックスと埋め込みクライアントをプロセス内で1度だけ読み込んで共有する
+    storage/ のポインタファイルが別の版を指した場合（または従来の配置でファイルが書き換えられた場合）は、
+    次回アクセス時に新しいインデックスへ差し替える
+    """
+
+    def __init__(self, storage_dir: str = STORAGE_DIR, embedding_deployment: str = EMBEDDING_DEPLOYMENT):
+        self.storage_dir = storage_dir
+        self.embedding_deployment = embedding_deployment
+        self._lock = threading.Lock()
+        self._embeddings = None
+        self._dimensions = None
+        self._index = None
+        self._bm25 = None
+        self._signature = None
+        self.index_dir = None
+        self.load_count = 0
+        self.last_load_seconds = 0.0
+        self.total_load_seconds = 0.0
+
+    def _current_signature(self) -> tuple:
+        """
+        (読み込むディレクトリ, 版の識別子) を返す
+        ポインタファイルが指す版のディレクトリは書き換えられないため、版の名前だけで判定する
+        従来の配置ではバージョンスタンプを優先し、なければファイルのmtime/サイズで判定する
+        """
+        current = _read_current(self.storage_dir)
+        if current:
+            return os.path.join(self.storage_dir, VERSIONS_DIR, current), ("current", current)
+        version = read_version_stamp(self.storage_dir)
+        if version is not None:
+            return self.storage_dir, ("version", version)
+        signature = []
+        for name in INDEX_FILES:
+            try:
+                stat = os.stat(os.path.join(self.storage_dir, name))
+                signature.append((name, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append((name, None, None))
+        return self.storage_dir, ("mtime", tuple(signature))
+
+    def _embeddings_for(self, dimensions: int | None):
+        # インデックス作成時と同じ出力次元数の埋め込みクライアントを返す（次元数が変わらなければ使い回す）
+        if self._embeddings is not None and self._dimensions == dimensions:
+            return self._embeddings
+        # 繰り返しの質問は埋め込みキャッシュから返す
+        return CachedEmbeddings(
+            AzureOpenAIEmbeddings(
+                chunk_size=2048,
+                azure_deployment=self.embedding_deployment,
+                **({"dimensions": dimensions} if dimensions else {}),
+            )
+        )
+
+    def get_embeddings(self):
+        """
+        埋め込みクライアント（キャッシュ付きAzureOpenAIEmbeddings）を返す
+        次元数はインデックスのメタデータ（index_meta.json）に従う
+        """
+        if self._embeddings is None:
+            with self._lock:
+                if self._embeddings is None:
+                    self._dimensions = read_index_meta(resolve_index_dir(self.storage_dir)).get("dimensions")
+                    self._embeddings = self._embeddings_for(self._dimensions)
+        return self._embeddings
+
+    def get_index(self) -> FAISS:
+        """
+        読み込み済みのFAISSインデックスを返す。storage/ が更新されていれば読み直す
+        """
+        _, signature = self._current_signature()
+        if self._index is not None and signature == self._signature:
+            return self._index
+
+        with self._lock:
+            # 他スレッドが先に読み込んでいればそれを使う
+            index_dir, signature = self._current_signature()
+            if self._index is not None and signature == self._signature:
+                return self._index
+            start = time.perf_counter()
+            try:
+                # インデックスの種類・検索パラメータ・埋め込みの次元数は作成時のメタデータに従う
+                meta = read_index_meta(index_dir)
+                embeddings = self._embeddings_for(meta.get("dimensions"))
+                with span("faiss_load", storage_dir=index_dir, index_type=meta.get("index_type")):
+                    index = FAISS.load_local(
+                        folder_path=index_dir,
+                        embeddings=embeddings,
+                        allow_dangerous_deserialization=True
+                    )
+                    apply_search_params(index.index, meta)
+                with span("bm25_load", storage_dir=index_dir):
+                    bm25 = load_bm25_index(index_dir, index)
+            except Exception as e:
+                if self._index is None:
+                    raise
+                # 書き込み途中などで読めない場合は既存のインデックスで応答を続ける
+                print(f"FAISSインデックスの再読み込みに失敗したため、既存のインデックスを使用します: {e}")
+                return self._index
+            elapsed = time.perf_counter() - start
+            self._index = index
+            self._bm25 = bm25
+            self._embeddings = embeddings
+            self._dimensions = meta.get("dimensions")
+            self._signature = signature
+            self.index_dir = index_dir
+            self.load_count += 1
+            self.last_load_seconds = elapsed
+            self.total_load_seconds += elapsed
+            print(
+                f"FAISSインデックス読み込み: {index_dir}（{meta.get('index_type')}, {index.index.ntotal}件, "
+                f"{elapsed:.3f}秒, {self.load_count}回目）"
+            )
+            return index
+
+    def similarity_search(self, query: str, k: int = 2) -> list:
+        index = self.get_index()
+        with span("similarity_search", k=k) as attrs:
+            docs = index.similarity_search(query, k=k)
+            attrs["results"] = len(docs)
+        return docs
+
+    def hybrid_search(self, query: str, sub_queries: list = (), k: int = 4) -> list:
+        """
+        BM25とベクトル検索を組み合わせて、クエリ・サブクエリ（品目ごと）に関連するチャンクを最大k件返す
+        サブクエリの埋め込みは1回のリクエストにまとめる。RERANK_MODEL 指定時はクロスエンコーダーで並べ替える
+        """
+        self.get_index()
+        with self._lock:
+            # 差し替え途中でも、FAISSとBM25は同じ版の組を使う
+            index, bm25 = self._index, self._bm25
+        return hybrid_search(
+            index, bm25, self.get_embeddings(), query, sub_queries, k=k, reranker=get_reranker()
+        )
+
+    def stats(self) -> dict:
+        """
+        読み込み回数と所要時間（ディスク読み込みが発生していないかの確認用）
+        """
+        return {
+            "storage_dir": self.storage_dir,
+            "index_dir": self.index_dir,
+            "load_count": self.load_count,
+            "last_load_seconds": self.last_load_seconds,
+            "total_load_seconds": self.total_load_seconds,
+            "loaded": self._index is not None,
+            "embedding_cache": self._embeddings.stats() if self._embeddings is not None else None,
+        }
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def get_retrieval_service(storage_dir: str = STORAGE_DIR) -> RetrievalService:
+    """
+    storage_dir ごとにプロセス内で共有される RetrievalService を返す
+    """
+    key = os.path.abspath(storage_dir)
+    with _services_lock:
+        service = _services.get(key)
+        if service is None:
+            service = RetrievalService(storage_dir)
+            _services[key] = service
+        return service
+
+
+if __name__ == "__main__":
+    service = get_retrieval_service()
+    for _ in range(3):
+        docs = service.similarity_search("器具及び備品 耐用年数", k=2)
+        print(len(docs), service.stats())
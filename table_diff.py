@@ -0,0 +1,142 @@
+from dataclasses import dataclass
+
+import pandas as pd
+
+# 行の対応付けに使う列（st.data_editor では非表示にする。ユーザーが追加した行は空になる）
+ROW_KEY = "_row_key"
+# 判定結果の表の列と、ChangeTitle テーブルの列の対応
+JUDGEMENT_COLUMNS = {
+    "品目名": "ItemName",
+    "金額": "Amount",
+    "勘定科目": "AccountTitle",
+    "法定耐用年数": "LegalUsefulLife",
+    "根拠": "Basis",
+}
+NUMERIC_COLUMNS = ("金額",)
+
+
+def with_row_keys(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    表の各行に行キー（元の行番号の文字列）を付ける
+    """
+    df = df.reset_index(drop=True).copy()
+    df[ROW_KEY] = [str(i) for i in range(len(df))]
+    return df
+
+
+def strip_row_keys(df: pd.DataFrame) -> pd.DataFrame:
+    return df.drop(columns=[ROW_KEY], errors="ignore").reset_index(drop=True)
+
+
+def parse_amounts(values: pd.Series) -> pd.Series:
+    """
+    「150,000円」「¥150000」などの金額表記を列ごとまとめて数値にする（読み取れなければ0.0）
+    """
+    text = values.astype("string").fillna("").str.replace(r"[,，]", "", regex=True)
+    numbers = text.str.extract(r"(\d+(?:\.\d+)?)", expand=False).fillna("").astype(str)
+    return pd.to_numeric(numbers, errors="coerce").fillna(0.0).astype("float64")
+
+
+def _normalize(df: pd.DataFrame, columns: list) -> pd.DataFrame:
+    # 比較用に列ごとに正規化する（金額は数値、それ以外は前後空白を除いた文字列。欠損は空文字）
+    normalized = {}
+    for column in columns:
+        values = df[column] if column in df.columns else pd.Series("", index=df.index)
+        if column in NUMERIC_COLUMNS:
+            normalized[column] = parse_amounts(values)
+        else:
+            normalized[column] = values.astype("string").fillna("").str.strip()
+    return pd.DataFrame(normalized, index=df.index)
+
+
+@dataclass
+class TableDiff:
+    """
+    元の表と編集後の表の差分（行キーで対応付け済み）
+    """
+    inserted: pd.DataFrame      # 編集後にだけある行
+    deleted: pd.DataFrame       # 元の表にだけある行
+    old: pd.DataFrame           # 変更された行の変更前（インデックスは行キー）
+    new: pd.DataFrame           # 変更された行の変更後（インデックスは行キー）
+    changed_cells: pd.DataFrame # 変更された行 × 列 の変更有無
+
+    @property
+    def is_empty(self) -> bool:
+        return self.inserted.empty and self.deleted.empty and self.new.empty
+
+    def summary(self) -> dict:
+        return {"inserted": len(self.inserted), "deleted": len(self.deleted), "modified": len(self.new)}
+
+    def corrected_rows(self) -> list:
+        """
+        人による修正として扱う行（変更・追加された行の編集後の値）
+        追加した行の空のセル（None / NaN）は空文字にする
+        """
+        rows = pd.concat([self.new, self.inserted]).astype(object)
+        return rows.where(rows.notna(), "").to_dict("records")
+
+    def to_change_logs(self, timestamp: str, remarks: str = "Streamlit経由で修正") -> list:
+        """
+        ChangeTitle テーブルにまとめて挿入できる行（dict）のリストにする
+        変更は変更前後、追加は変更後のみ、削除は変更前のみを記録する
+        """
+        def frame(rows: pd.DataFrame, prefix: str) -> pd.DataFrame:
+            data = {}
+            for column, name in JUDGEMENT_COLUMNS.items():
+                values = rows[column] if column in rows.columns else pd.Series("", index=rows.index)
+                if column in NUMERIC_COLUMNS:
+                    data[f"{prefix}_{name}"] = parse_amounts(values)
+                else:
+                    data[f"{prefix}_{name}"] = values.astype("string").fillna("")
+            return pd.DataFrame(data, index=rows.index)
+
+        def blank(rows: pd.DataFrame, prefix: str) -> pd.DataFrame:
+            return pd.DataFrame(
+                {f"{prefix}_{name}": (0.0 if column in NUMERIC_COLUMNS else "") for column, name in JUDGEMENT_COLUMNS.items()},
+                index=rows.index,
+            )
+
+        parts = []
+        if not self.new.empty:
+            parts.append(pd.concat([frame(self.old, "Old"), frame(self.new, "New")], axis=1).assign(
+                TargetRecordID=self.new.index.astype(str), Remarks=remarks,
+            ))
+        if not self.inserted.empty:
+            parts.append(pd.concat([blank(self.inserted, "Old"), frame(self.inserted, "New")], axis=1).assign(
+                TargetRecordID=[f"new{i}" for i in range(len(self.inserted))], Remarks=f"{remarks}（行追加）",
+            ))
+        if not self.deleted.empty:
+            parts.append(pd.concat([frame(self.deleted, "Old"), blank(self.deleted, "New")], axis=1).assign(
+                TargetRecordID=self.deleted.index.astype(str), Remarks=f"{remarks}（行削除）",
+            ))
+        if not parts:
+            return []
+        logs = pd.concat(parts, ignore_index=True).assign(OperationTimestamp=timestamp)
+        return logs.astype(object).to_dict("records")
+
+
+def diff_tables(original: pd.DataFrame, edited: pd.DataFrame, columns: list = None) -> TableDiff:
+    """
+    with_row_keys で行キーを付けた元の表と編集後の表を、行キーで対応付けて列単位でまとめて比較する
+    行キーが空（ユーザーが追加した行）または重複している行は追加、編集後にない行キーは削除として扱う
+    """
+    columns = columns or list(JUDGEMENT_COLUMNS)
+    original = original.set_index(ROW_KEY)
+    keys = edited[ROW_KEY] if ROW_KEY in edited.columns else pd.Series(pd.NA, index=edited.index)
+    is_new = keys.isna() | keys.duplicated() | ~keys.isin(original.index)
+    inserted = strip_row_keys(edited[is_new])
+    edited = edited[~is_new].set_index(ROW_KEY)
+
+    deleted = original.loc[original.index.difference(edited.index, sort=False)]
+    common = original.index.intersection(edited.index, sort=False)
+    before = _normalize(original.loc[common], columns)
+    after = _normalize(edited.loc[common], columns)
+    changed_cells = before.ne(after)
+    modified = changed_cells.any(axis=1)
+    return TableDiff(
+        inserted=inserted,
+        deleted=deleted,
+        old=original.loc[common[modified.to_numpy()]],
+        new=edited.loc[common[modified.to_numpy()]],
+        changed_cells=changed_cells[modified],
+    )
@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import functools
+import threading
+import contextlib
+from collections import defaultdict, deque
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dotenv import load_dotenv
+
+# .envから環境変数を読み込む
+load_dotenv()
+
+# トレースの出力先（空文字なら出力しない）と、Prometheus形式のメトリクスを公開するポート（未設定なら公開しない）
+TRACE_JSONL_PATH = os.getenv("TRACE_JSONL_PATH", "cache/traces.jsonl")
+METRICS_PORT = os.getenv("METRICS_PORT", "")
+# ヒストグラムの区切り（秒）
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_current_trace = ContextVar("current_trace", default=None)
+_current_span = ContextVar("current_span", default=None)
+
+
+class Trace:
+    """
+    1回の処理（固定資産判定・チャット応答など）に含まれるスパンの集まり
+    """
+
+    def __init__(self, name: str, **attrs):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = attrs
+        self.started_at = time.time()
+        self.duration_ms = None
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span: dict) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s["start"])
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": self.duration_ms,
+            "attrs": self.attrs,
+            "spans": spans,
+        }
+
+    def rows(self) -> list:
+        """
+        画面表示用に、スパンを開始順の行（ステージ名・開始からの経過・所要時間・属性）で返す
+        """
+        depth = {}
+        rows = []
+        for span in self.to_dict()["spans"]:
+            depth[span["span_id"]] = depth.get(span["parent_id"], -1) + 1
+            rows.append({
+                "ステージ": "　" * depth[span["span_id"]] + span["name"],
+                "開始(ms)": round((span["start"] - self.started_at) * 1000, 1),
+                "所要時間(ms)": round(span["duration_ms"], 1),
+                **{k: v for k, v in span["attrs"].items()},
+            })
+        return rows
+
+
+class _Metrics:
+    """
+    スパン名ごとの件数・所要時間ヒストグラム・トークン数・キャッシュ命中数の集計（Prometheusテキスト形式で出力）
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.errors = defaultdict(int)
+        self.buckets = defaultdict(lambda: [0] * len(LATENCY_BUCKETS))
+        self.tokens = defaultdict(int)         # (stage, kind) -> トークン数
+        self.cache = defaultdict(int)          # (stage, "hit"/"miss") -> 件数
+
+    def observe(self, span: dict) -> None:
+        name = span["name"]
+        seconds = span["duration_ms"] / 1000
+        attrs = span["attrs"]
+        with self._lock:
+            self.count[name] += 1
+            self.seconds[name] += seconds
+            if span.get("error"):
+                self.errors[name] += 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    self.buckets[name][i] += 1
+            for kind in ("prompt_tokens", "completion_tokens"):
+                if isinstance(attrs.get(kind), int):
+                    self.tokens[(name, kind)] += attrs[kind]
+            if "cache_hit" in attrs:
+                self.cache[(name, "hit" if attrs["cache_hit"] else "miss")] += 1
+
+    def render(self) -> str:
+        lines = [
+            "# HELP pipeline_stage_seconds Duration of pipeline stages",
+            "# TYPE pipeline_stage_seconds histogram",
+        ]
+        with self._lock:
+            for name in sorted(self.count):
+                for bound, value in zip(LATENCY_BUCKETS, self.buckets[name]):
+                    lines.append(f'pipeline_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {value}')
+                lines.append(f'pipeline_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {self.count[name]}')
+                lines.append(f'pipeline_stage_seconds_sum{{stage="{name}"}} {self.seconds[name]:.6f}')
+                lines.append(f'pipeline_stage_seconds_count{{stage="{name}"}} {self.count[name]}')
+            lines += ["# HELP pipeline_stage_errors_total Failed pipeline stages", "# TYPE pipeline_stage_errors_total counter"]
+            for name, value in sorted(self.errors.items()):
+                lines.append(f'pipeline_stage_errors_total{{stage="{name}"}} {value}')
+            lines += ["# HELP pipeline_tokens_total LLM tokens by stage", "# TYPE pipeline_tokens_total counter"]
+            for (name, kind), value in sorted(self.tokens.items()):
+                lines.append(f'pipeline_tokens_total{{stage="{name}",kind="{kind}"}} {value}')
+            lines += ["# HELP pipeline_cache_total Cache lookups by stage", "# TYPE pipeline_cache_total counter"]
+            for (name, result), value in sorted(self.cache.items()):
+                lines.append(f'pipeline_cache_total{{stage="{name}",result="{result}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = _Metrics()
+_recent_traces = deque(maxlen=50)
+_export_lock = threading.Lock()
+
+
+def _export(trace: Trace) -> None:
+    _recent_traces.append(trace)
+    if not TRACE_JSONL_PATH:
+        return
+    try:
+        os.makedirs(os.path.dirname(TRACE_JSONL_PATH) or ".", exist_ok=True)
+        line = json.dumps(trace.to_dict(), ensure_ascii=False, default=str)
+        with _export_lock, open(TRACE_JSONL_PATH, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        print(f"トレースの書き込みに失敗しました: {e}")
+
+
+def _reset(var: ContextVar, token, value) -> None:
+    # ジェネレータ内でyieldをまたいだ場合など、別のコンテキストで終了したときは値を戻すだけにする
+    try:
+        var.reset(token)
+    except ValueError:
+        var.set(value)
+
+
+@contextlib.contextmanager
+def start_trace(name: str, **attrs):
+    """
+    トレースを開始する。内側の span() はこのトレースに記録され、終了時にJSONLへ出力される
+    既にトレース中であれば、新しいトレースは作らずスパンとして記録する
+    """
+    parent = _current_trace.get()
+    if parent is not None:
+        with span(name, **attrs):
+            yield parent
+        return
+    trace = Trace(name, **attrs)
+    token = _current_trace.set(trace)
+    start = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        trace.duration_ms = (time.perf_counter() - start) * 1000
+        _reset(_current_trace, token, None)
+        _export(trace)
+
+
+@contextlib.contextmanager
+def span(name: str, **attrs):
+    """
+    処理の区間を計測する。yield される辞書に属性（トークン数・キャッシュ命中など）を追加できる
+    トレース外で呼ばれた場合は、このスパンだけのトレースとして出力する
+    """
+    trace = _current_trace.get()
+    own_trace = None
+    if trace is None:
+        own_trace = trace = Trace(name)
+    parent = _current_span.get()
+    record = {
+        "span_id": uuid.uuid4().hex[:16],
+        "parent_id": parent["span_id"] if parent else None,
+        "name": name,
+        "start": time.time(),
+        "duration_ms": 0.0,
+        "attrs": dict(attrs),
+    }
+    token = _current_span.set(record)
+    start = time.perf_counter()
+    try:
+        yield record["attrs"]
+    except BaseException as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record["duration_ms"] = (time.perf_counter() - start) * 1000
+        _reset(_current_span, token, parent)
+        trace.add(record)
+        metrics.observe(record)
+        if own_trace is not None:
+            own_trace.duration_ms = record["duration_ms"]
+            _export(own_trace)
+
+
+def set_attrs(**attrs) -> None:
+    """
+    実行中のスパンに属性を追加する（スパン外では何もしない）
+    """
+    record = _current_span.get()
+    if record is not None:
+        record["attrs"].update(attrs)
+
+
+def traced(name: str = None):
+    """
+    関数（同期・コルーチン）の呼び出しをスパンとして記録するデコレータ
+    """
+    def decorator(func):
+        span_name = name or func.__name__
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def recent_traces(name: str = None) -> list:
+    """
+    直近のトレース（新しい順）
+    """
+    return [t for t in reversed(_recent_traces) if name is None or t.name == name]
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("", "/metrics"):
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port: int = None) -> int | None:
+    """
+    Prometheus形式のメトリクスを http://localhost:<port>/metrics で公開する（プロセスで1度だけ起動）
+    port を省略した場合は環境変数 METRICS_PORT を使い、未設定なら起動しない
+    """
+    global _server
+    port = port or (int(METRICS_PORT) if METRICS_PORT else None)
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+            except OSError as e:
+                # Streamlitの再実行などで既に起動済みの場合
+                print(f"メトリクスサーバーを起動できませんでした（port {port}）: {e}")
+                return None
+            threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+            print(f"メトリクス: http://127.0.0.1:{port}/metrics")
+    return port
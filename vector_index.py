@@ -0,0 +1,268 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+# FAISSインデックスの種類（flat: 全件比較, hnsw: グラフ探索, sq8: 8bitスカラー量子化, ivfpq: 転置リスト＋直積量子化）
+INDEX_TYPES = ("flat", "hnsw", "sq8", "ivfpq")
+# インデックスの種類・パラメータと埋め込みの次元数を記録するメタデータ（storage_dir内、検索側もこれに従う）
+INDEX_META_FILE = "index_meta.json"
+INDEX_META_VERSION = 1
+DEFAULT_PARAMS = {
+    "hnsw": {"hnsw_m": 32, "ef_construction": 80, "ef_search": 64},
+    "sq8": {},
+    "ivfpq": {"nlist": None, "pq_m": None, "pq_nbits": 8, "nprobe": 16},
+}
+# 学習に使うベクトル数の上限（これを超える分は学習後にそのまま追加する）
+DEFAULT_TRAIN_SIZE = 20000
+# 直積量子化の学習に最低限必要なベクトル数（2 ** pq_nbits）に満たない場合は flat にする
+MIN_TRAIN_VECTORS = 256
+
+
+def resolve_params(index_type: str, params: dict = None) -> dict:
+    """
+    インデックスの種類ごとの既定値に、指定されたパラメータを上書きして返す
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"index_type は {', '.join(INDEX_TYPES)} のいずれかを指定してください: {index_type}")
+    return {**DEFAULT_PARAMS.get(index_type, {}), **(params or {})}
+
+
+def supports_remove(index_type: str) -> bool:
+    """
+    ベクトルの削除（差分更新）に対応しているか（HNSWは削除できないため、変更時は作り直す）
+    """
+    return index_type != "hnsw"
+
+
+def needs_training(index_type: str) -> bool:
+    return index_type in ("sq8", "ivfpq")
+
+
+def _pq_subquantizers(dim: int) -> int:
+    # 次元数を割り切れる最大のサブ量子化器数
+    for m in (64, 48, 32, 16, 8, 4, 2, 1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def create_index(index_type: str, dim: int, params: dict, n_train: int = 0):
+    """
+    未学習のFAISSインデックスを作る（L2距離。埋め込みは正規化済みなのでコサイン類似度と同じ順位になる）
+    IVFのリスト数（nlist）を省略した場合は学習ベクトル数から決める
+    """
+    import faiss
+
+    if index_type == "flat":
+        return faiss.IndexFlatL2(dim)
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, params["hnsw_m"])
+        index.hnsw.efConstruction = params["ef_construction"]
+        index.hnsw.efSearch = params["ef_search"]
+        return index
+    if index_type == "sq8":
+        return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2)
+    nlist = params.get("nlist") or max(1, min(4096, int(4 * np.sqrt(max(n_train, 1)))))
+    # 1リストあたり最低39件の学習ベクトルがあるよう制限する
+    nlist = max(1, min(nlist, n_train // 39 or 1))
+    params["nlist"] = nlist
+    params["pq_m"] = params.get("pq_m") or _pq_subquantizers(dim)
+    index = faiss.IndexIVFPQ(faiss.IndexFlatL2(dim), dim, nlist, params["pq_m"], params["pq_nbits"])
+    index.nprobe = min(params["nprobe"], nlist)
+    return index
+
+
+def train_index(index, vectors: np.ndarray, train_size: int = DEFAULT_TRAIN_SIZE, seed: int = 0) -> float:
+    """
+    ベクトルからランダムに最大 train_size 件を取り出してインデックスを学習させ、所要時間（秒）を返す
+    """
+    if index.is_trained:
+        return 0.0
+    rng = np.random.default_rng(seed)
+    sample = vectors if len(vectors) <= train_size else vectors[rng.choice(len(vectors), train_size, replace=False)]
+    start = time.perf_counter()
+    index.train(np.ascontiguousarray(sample, dtype=np.float32))
+    return time.perf_counter() - start
+
+
+def build_trained_index(index_type: str, vectors: np.ndarray, params: dict = None, train_size: int = DEFAULT_TRAIN_SIZE):
+    """
+    学習用ベクトルから指定した種類のインデックスを作って学習させ、(インデックス, 実際に使った種類, パラメータ) を返す
+    ベクトル数が学習に足りない場合は flat にする
+    """
+    params = resolve_params(index_type, params)
+    if index_type == "ivfpq" and len(vectors) < MIN_TRAIN_VECTORS:
+        print(f"学習用のベクトルが{len(vectors)}件しかないため、ivfpq ではなく flat インデックスを使います")
+        index_type, params = "flat", {}
+    index = create_index(index_type, vectors.shape[1], params, n_train=min(len(vectors), train_size))
+    if needs_training(index_type):
+        elapsed = train_index(index, vectors, train_size)
+        print(f"FAISSインデックス学習: {index_type}（{min(len(vectors), train_size)}件, {elapsed:.2f}秒）")
+    return index, index_type, params
+
+
+def apply_search_params(index, meta: dict) -> None:
+    """
+    メタデータに記録された検索時のパラメータ（nprobe / efSearch）を読み込んだインデックスに設定する
+    """
+    import faiss
+
+    params = meta.get("params", {})
+    space = faiss.ParameterSpace()
+    if meta.get("index_type") == "ivfpq" and params.get("nprobe"):
+        space.set_index_parameter(index, "nprobe", params["nprobe"])
+    if meta.get("index_type") == "hnsw" and params.get("ef_search"):
+        space.set_index_parameter(index, "efSearch", params["ef_search"])
+
+
+def read_index_meta(storage_dir: str) -> dict:
+    """
+    インデックスのメタデータを返す（ない場合は従来の flat・既定次元とみなす）
+    """
+    try:
+        with open(os.path.join(storage_dir, INDEX_META_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"index_type": "flat", "dimensions": None, "params": {}}
+
+
+def write_index_meta(storage_dir: str, index_type: str, dimensions: int | None, params: dict, index) -> dict:
+    meta = {
+        "version": INDEX_META_VERSION,
+        "index_type": index_type,
+        "dimensions": dimensions,
+        "dim": index.d,
+        "ntotal": index.ntotal,
+        "params": params,
+    }
+    path = os.path.join(storage_dir, INDEX_META_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+    return meta
+
+
+def index_bytes(index) -> int:
+    """
+    インデックスのシリアライズ後の大きさ（メモリ使用量の目安）
+    """
+    import faiss
+
+    return int(faiss.serialize_index(index).nbytes)
+
+
+# --- ベンチマーク ---
+def synthetic_vectors(n: int, dim: int, clusters: int = 64, seed: int = 0) -> np.ndarray:
+    """
+    トピックごとに集まった、正規化済みの埋め込みに似たベクトルを作る
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, n)] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def load_vectors(storage_dir: str) -> np.ndarray:
+    """
+    保存済みのFAISSインデックスからベクトルを取り出す（flat インデックスのみ）
+    """
+    import faiss
+
+    index = faiss.read_index(os.path.join(storage_dir, "index.faiss"))
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def compare_index_types(
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    k: int = 4,
+    index_types: tuple = INDEX_TYPES,
+    params: dict = None,
+) -> list:
+    """
+    flat（厳密検索）を正解として、インデックスの種類ごとに recall@k・大きさ・作成時間・1件ずつの検索時間を比較する
+    """
+    exact = create_index("flat", vectors.shape[1], {})
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+
+    rows = []
+    for index_type in index_types:
+        start = time.perf_counter()
+        index, used_type, used_params = build_trained_index(index_type, vectors, (params or {}).get(index_type))
+        index.add(vectors)
+        build_seconds = time.perf_counter() - start
+
+        latencies = []
+        found = np.empty_like(truth)
+        for i, query in enumerate(queries):
+            t = time.perf_counter()
+            _, found[i] = index.search(query.reshape(1, -1), k)
+            latencies.append(time.perf_counter() - t)
+        recall = np.mean([len(set(found[i]) & set(truth[i])) / k for i in range(len(queries))])
+        latencies_ms = np.array(latencies) * 1000
+        rows.append({
+            "index_type": used_type,
+            "params": used_params,
+            "recall_at_k": float(recall),
+            "index_mb": index_bytes(index) / 1024 / 1024,
+            "build_seconds": build_seconds,
+            "query_p50_ms": float(np.percentile(latencies_ms, 50)),
+            "query_p95_ms": float(np.percentile(latencies_ms, 95)),
+        })
+    return rows
+
+
+def print_comparison(rows: list, k: int) -> None:
+    print(f"{'index':<8} {'recall@' + str(k):>9} {'MB':>9} {'build(s)':>9} {'p50(ms)':>9} {'p95(ms)':>9}")
+    for row in rows:
+        print(
+            f"{row['index_type']:<8} {row['recall_at_k']:>9.3f} {row['index_mb']:>9.1f} {row['build_seconds']:>9.2f}"
+            f" {row['query_p50_ms']:>9.3f} {row['query_p95_ms']:>9.3f}"
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="FAISSインデックスの種類ごとの recall@k・メモリ・検索時間を比較する")
+    parser.add_argument("--vectors", type=int, default=50000, help="合成ベクトルの件数")
+    parser.add_argument("--dim", type=int, nargs="+", default=[3072, 1024], help="次元数（複数指定で比較）")
+    parser.add_argument("--storage", default=None, help="合成ベクトルの代わりに保存済みの flat インデックスのベクトルを使う")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--types", nargs="+", default=list(INDEX_TYPES), choices=INDEX_TYPES)
+    parser.add_argument("--output", default=None, help="結果JSONの出力先")
+    args = parser.parse_args()
+
+    results = []
+    if args.storage:
+        # 版ごとの配置（storage/CURRENT）の場合は検索に使っている版のベクトルを使う
+        from retrieval_service import resolve_index_dir
+        args.storage = resolve_index_dir(args.storage)
+    datasets = [("storage", load_vectors(args.storage))] if args.storage else [
+        (f"synthetic-{dim}", synthetic_vectors(args.vectors, dim)) for dim in args.dim
+    ]
+    rng = np.random.default_rng(1)
+    for name, vectors in datasets:
+        # 質問は既存のチャンクに近いベクトルとして作る
+        picked = vectors[rng.choice(len(vectors), min(args.queries, len(vectors)), replace=False)]
+        queries = picked + 0.05 * rng.standard_normal(picked.shape).astype(np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        print(f"\n=== {name}: {len(vectors)}件 × {vectors.shape[1]}次元 ===")
+        rows = compare_index_types(vectors, queries.astype(np.float32), args.k, tuple(args.types))
+        print_comparison(rows, args.k)
+        results.append({"dataset": name, "vectors": len(vectors), "dim": int(vectors.shape[1]), "rows": rows})
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n結果: {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())